@@ -30,6 +30,17 @@ urlpatterns = [
     # RestAPI urls
     url(r'^api/v1/UDPTraffics/$', app_api.UDPTrafficListCreateApiView.as_view()),
     url(r'^api/v1/UDPTraffics/(?P<pk>[0-9]+)/$', app_api.UDPTrafficDetailApiView.as_view()),
+    url(r'^api/v1/UDPTraffics/(?P<pk>[0-9]+)/stats/$', app_api.UDPTrafficStatRangeApiView.as_view()),
+    url(r'^api/v1/UDPTraffics/(?P<pk>[0-9]+)/live/$', app_api.UDPTrafficLiveStatApiView.as_view()),
+    url(r'^api/v1/UDPTrafficGroups/$', app_api.UDPTrafficGroupListCreateApiView.as_view()),
+    url(r'^api/v1/UDPTrafficGroups/(?P<pk>[0-9]+)/$', app_api.UDPTrafficGroupDetailApiView.as_view()),
+    url(r'^api/v1/TCPTraffics/$', app_api.TCPTrafficListCreateApiView.as_view()),
+    url(r'^api/v1/TCPTraffics/(?P<pk>[0-9]+)/$', app_api.TCPTrafficDetailApiView.as_view()),
+    url(r'^api/v1/TCPTraffics/(?P<pk>[0-9]+)/stats/$', app_api.TCPTrafficStatRangeApiView.as_view()),
+    url(r'^api/v1/TCPTraffics/(?P<pk>[0-9]+)/live/$', app_api.TCPTrafficLiveStatApiView.as_view()),
     url(r'^api/v1/UDPServers/$', app_api.UDPServerListCreateApiView.as_view()),
-    url(r'^api/v1/UDPServers/(?P<pk>[0-9]+)/$', app_api.UDPServerDetailApiView.as_view())
+    url(r'^api/v1/UDPServers/(?P<pk>[0-9]+)/$', app_api.UDPServerDetailApiView.as_view()),
+    url(r'^api/v1/TCPServers/$', app_api.TCPServerListCreateApiView.as_view()),
+    url(r'^api/v1/TCPServers/(?P<pk>[0-9]+)/$', app_api.TCPServerDetailApiView.as_view()),
+    url(r'^api/v1/TCPServers/(?P<pk>[0-9]+)/stats/$', app_api.TCPServerStatsApiView.as_view())
 ]
@@ -0,0 +1,240 @@
+"""
+asyncio UDP traffic engine.
+
+UDPTraffic runs the sender loop, the epoll reader thread and the reporting thread side by
+side, all touching the same tracker and counters. AsyncUDPTraffic does the same work in one
+event loop: the pool sockets become DatagramProtocol endpoints, the sender is a coroutine
+woken by the pacer, and stats are expired and reported from the same loop, so nothing is
+shared between threads. The blocking HTTP post is the only thing handed to an executor, and
+it only sees the finished list of records.
+
+It uses the same packet format, tracker and interval bookkeeping as UDPTraffic, so the stat
+records are identical. uvloop is used when it is installed.
+"""
+import time
+import asyncio
+
+from UDPTraffic.udptraffic import UDPTraffic
+from UDPTraffic.socketpool import UDPSocketPool
+from UDPTraffic.pacer import TokenBucketPacer
+from UDPTraffic.tracker import InFlightTracker, ring_capacity
+from UDPTraffic.packet import PacketBuilder
+from UDPTraffic.timestamps import CLOCK_USER
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class _EchoProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every echo received on a pool socket to the engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagram_received(self, data, addr):
+        self.engine._handle_reply(data, time.monotonic_ns())
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) on a connectionless socket, the packet is lost
+        self.engine.log.debug("UDP socket error: %s" % exc)
+
+
+class AsyncUDPTraffic(UDPTraffic):
+    """
+    UDPTraffic on an asyncio event loop. Configure it like UDPTraffic, then call start(),
+    which blocks until stop() is called from another thread.
+
+    .. python::
+    Example Usage
+    u = AsyncUDPTraffic('10.1.1.125', 1234, 10000)
+    u.udp_port_range_start = 20000
+    u.udp_port_range_stop = 35000
+    u.start()
+    """
+    # The loop's timers fire with about a millisecond of resolution, so the pacer is allowed
+    # to release the packets of this many seconds at once
+    TIMER_SLACK = 0.005
+
+    def __init__(self, destination_ip, destination_port, packet_rate):
+        """
+        Constructor
+        :param destination_ip: (string) IP address to send traffic to (BIG-IP VIP)
+        :param destination_port: (integer) Port to send traffic to
+        :param packet_rate: (integer) Packets per second
+        :return: None
+        """
+        super(AsyncUDPTraffic, self).__init__(destination_ip, destination_port, packet_rate)
+        # Run on uvloop when it is installed
+        self.use_uvloop = True
+        self.loop = None
+        self.transports = []
+        self._next_transport = 0
+        self._sender = None
+        self._done = None
+
+    def start(self):
+        """
+        Start sending UDP traffic and run the event loop until stop() is called and the stats
+        of the last packets are queued.
+        :return: None
+        """
+        self._stopped.clear()
+        if self._stop_requested:
+            # stop() came first
+            self._stopped.set()
+            return
+        self.sending_client_data = True
+        self.tracker = InFlightTracker(self.tracker_capacity or
+                                       ring_capacity(self._peak_rate(), self.client_read_timeout + 2))
+        self.packet_builder = PacketBuilder(self.flow_id, self.payload_size)
+        self._reset_counters()
+        # The reader is not a thread of its own, its CPU time is not measured
+        self.reader_cpu_ns = None
+        # The event loop watches the sockets, no epoll_obj
+        self.socket_pool = UDPSocketPool(self.udp_port_range_start, self.udp_port_range_stop)
+        self.socket_pool.open()
+        self.log.info("Socket pool: %(pool_sockets)s sockets, %(open_fds)s fds open, "
+                      "fd limit %(fd_limit)s" % self.socket_pool.fd_usage())
+        if self.batch_size > 1:
+            self.log.info("Batched I/O is not used by the asyncio engine, sending packet by packet")
+        # Datagram protocols never see ancillary data, so no kernel timestamps either
+        if self.timestamping != CLOCK_USER:
+            self.log.warning("Kernel timestamps are not available in the asyncio engine, "
+                             "timing packets in user space")
+        self.clock_source = CLOCK_USER
+
+        if uvloop is not None and self.use_uvloop:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        self.log.info("Event loop: %s" % type(self.loop).__name__)
+        self.read_client_data = True
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+            self.socket_pool.close()
+            self._stopped.set()
+
+    def stop(self):
+        """
+        Stop sending traffic and wait until the echoes of the last packets are in and their
+        stats are queued. Thread safe.
+        :return: None
+        """
+        self._stop_requested = True
+        self.sending_client_data = False
+        # Wake the sender up from its sleep
+        try:
+            if self._sender is not None:
+                self.loop.call_soon_threadsafe(self._sender.cancel)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+        if not self._stopped.wait(self.client_read_timeout + 5):
+            self.log.warning("Traffic did not stop in %d seconds" % (self.client_read_timeout + 5))
+
+    async def _run(self):
+        """
+        Private method
+        Open an endpoint per pool socket, then send and report until stopped.
+        :return: None
+        """
+        self.transports = []
+        self._next_transport = 0
+        for sock in self.socket_pool.sockets:
+            transport, protocol = await self.loop.create_datagram_endpoint(lambda: _EchoProtocol(self),
+                                                                           sock=sock)
+            self.transports.append(transport)
+        self._done = asyncio.Event()
+        reporter = None
+        if self.report_stats:
+            reporter = self.loop.create_task(self._report_stat_async())
+        self._sender = self.loop.create_task(self._send_client_traffic_async())
+        try:
+            try:
+                await self._sender
+            except asyncio.CancelledError:
+                # stop() woke the sender up
+                pass
+            # Wait for the last echoes like the threaded engine, see UDPTraffic._draining()
+            stop_ns = time.monotonic_ns()
+            self._end_sending(stop_ns)
+            now = stop_ns
+            while self._draining(stop_ns, now):
+                await asyncio.sleep(0.001)
+                now = time.monotonic_ns()
+            self._flush_intervals(now)
+            self.log.info("Traffic stopped, %d of %d packets acked, %.1f ms after the last send" %
+                          (self.acked_packets, self.sent_packets, (time.monotonic_ns() - stop_ns) / 10 ** 6))
+        finally:
+            self.read_client_data = False
+            self._sender = None
+            # The reporter posts what the flush queued, then returns
+            self._done.set()
+            if reporter is not None:
+                await reporter
+            for transport in self.transports:
+                # The pool owns the sockets and closes them
+                transport.abort()
+
+    async def _send_client_traffic_async(self):
+        """
+        Private method
+        Send every packet the pacer allows, then sleep until the next one is due or the
+        interval ends. Runs until self.sending_client_data is set to False.
+        :return: None
+        """
+        self.log.info("Starting client traffic coroutine")
+        self.log.info("Traffic destination: %s:%d" % (self.destination_ip,
+                                                      self.destination_port))
+        burst = max(self.pacing_burst, int(self._peak_rate() * self.TIMER_SLACK))
+        self.pacer = TokenBucketPacer(self.packet_rate, burst)
+        self._reset_intervals()
+        destination = (self.destination_ip, self.destination_port)
+        transports = self.transports
+        while self.sending_client_data is True:
+            now = time.monotonic_ns()
+            count = self.pacer.due(now)
+            if count:
+                for i in range(count):
+                    transports[self._next_transport].sendto(self._next_packet(), destination)
+                    self._next_transport += 1
+                    if self._next_transport == len(transports):
+                        self._next_transport = 0
+                self.pacer.grant(count, now)
+            if now >= self._next_rate_update:
+                self._update_rate(now)
+            if now >= self._next_interval:
+                self._close_interval(now)
+
+            wake = self.pacer.next_send_time()
+            if wake is None or wake > self._next_interval:
+                wake = self._next_interval
+            wake = min(wake, self._next_rate_update)
+            await asyncio.sleep(max(wake - time.monotonic_ns(), 0) / 10 ** 9)
+
+    async def _report_stat_async(self):
+        """
+        Private method
+        Post queued stat records to the harness controller every report_interval seconds
+        until the last stats of the run are queued, then post those. The post runs in the
+        default executor so a slow controller does not stall the sender.
+        :return: None
+        """
+        self.log.info("Start posting stat to harness controller")
+        self.reporter = self._make_reporter()
+        try:
+            while not self._done.is_set():
+                try:
+                    await asyncio.wait_for(self._done.wait(), self.report_interval)
+                except asyncio.TimeoutError:
+                    pass
+                data_list = self._drain_stat_queue()
+                await self.loop.run_in_executor(None, self.reporter.post, data_list)
+        finally:
+            self.reporter.close()
@@ -0,0 +1,358 @@
+"""
+Batched datagram I/O.
+
+sendmmsg(2) and recvmmsg(2) move a whole batch of datagrams per system call. They are
+reached through ctypes so no extension module has to be built on the agent. On platforms
+without them (or when batching is switched off) the same interface is served by plain
+per-packet sendto()/recv() calls.
+"""
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import socket
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    HAVE_MMSG = hasattr(_libc, "sendmmsg") and hasattr(_libc, "recvmmsg")
+except (OSError, TypeError):
+    _libc = None
+    HAVE_MMSG = False
+
+# Largest datagram the receive side will accept; anything longer is truncated
+MAX_DATAGRAM = 2048
+# recvmmsg() flag: block for the first datagram only, then return what is queued
+MSG_WAITFORONE = 0x10000
+# Room for any peer address (struct sockaddr_storage)
+_SOCKADDR_STORAGE = 128
+# struct cmsghdr followed by a struct timespec, as found in a control buffer
+_CMSG_TIMESPEC = struct.Struct("@Niiqq")
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+if HAVE_MMSG:
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int,
+                               ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+
+
+def _sockaddr_in(address):
+    """
+    :param address: (tuple) (ip, port) IPv4 address
+    :return: (_SockAddrIn) The address in its C representation
+    """
+    addr = _SockAddrIn()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port = socket.htons(address[1])
+    addr.sin_addr[:] = socket.inet_aton(address[0])
+    return addr
+
+
+class MMsgBatch(object):
+    """
+    A preallocated vector of datagram slots flushed with one sendmmsg() or filled with one
+    recvmmsg(). One instance must only be used by one thread at a time.
+
+    Per-datagram fields are written through flat integer views of the C arrays and only when
+    they change, because every ctypes structure access costs more than the syscall it saves.
+    """
+    _IOV_WORDS = ctypes.sizeof(_IOVec) // ctypes.sizeof(ctypes.c_size_t)
+    _MSG_WORDS = ctypes.sizeof(_MMsgHdr) // ctypes.sizeof(ctypes.c_uint)
+    _MSG_LEN_WORD = _MMsgHdr.msg_len.offset // ctypes.sizeof(ctypes.c_uint)
+    _NAMELEN_WORD = _MsgHdr.msg_namelen.offset // ctypes.sizeof(ctypes.c_uint)
+    _SIZE_WORDS = ctypes.sizeof(_MMsgHdr) // ctypes.sizeof(ctypes.c_size_t)
+    _CONTROLLEN_WORD = _MsgHdr.msg_controllen.offset // ctypes.sizeof(ctypes.c_size_t)
+    # _address while the slots hold the peer addresses of an echo()
+    _ECHO = object()
+
+    def __init__(self, size, slot_size=MAX_DATAGRAM, control_size=0):
+        """
+        Constructor
+        :param size: (integer) Maximum number of datagrams per system call
+        :param slot_size: (integer) Size of each datagram buffer
+        :param control_size: (integer) Size of each ancillary data buffer, for recv_timestamped()
+        :return: None
+        """
+        self.size = size
+        self.slot_size = slot_size
+        self.buffers = [bytearray(slot_size) for i in range(size)]
+        self._views = [memoryview(buf) for buf in self.buffers]
+        self._c_buffers = [(ctypes.c_char * slot_size).from_buffer(buf) for buf in self.buffers]
+        self._iov = (_IOVec * size)()
+        self._msgs = (_MMsgHdr * size)()
+        for i in range(size):
+            self._iov[i].iov_base = ctypes.addressof(self._c_buffers[i])
+            self._iov[i].iov_len = slot_size
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iov[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+        self._iov_words = (ctypes.c_size_t * (size * self._IOV_WORDS)).from_address(
+            ctypes.addressof(self._iov))
+        self._msg_words = (ctypes.c_uint * (size * self._MSG_WORDS)).from_address(
+            ctypes.addressof(self._msgs))
+        self.control_size = control_size
+        if control_size:
+            self._controls = [bytearray(control_size) for i in range(size)]
+            self._c_controls = [(ctypes.c_char * control_size).from_buffer(buf) for buf in self._controls]
+            for i in range(size):
+                self._msgs[i].msg_hdr.msg_control = ctypes.addressof(self._c_controls[i])
+            self._size_words = (ctypes.c_size_t * (size * self._SIZE_WORDS)).from_address(
+                ctypes.addressof(self._msgs))
+        self._lengths = [slot_size] * size
+        # True while every slot is set up for receiving (full length, no address)
+        self._recv_ready = True
+        self._address = None
+        self._c_address = None
+        self._names = None
+
+    def _set_address(self, address):
+        if address is self._address or address == self._address:
+            return
+        self._address = address
+        if address is self._ECHO:
+            if self._names is None:
+                self._names = (ctypes.c_char * (_SOCKADDR_STORAGE * self.size))()
+            base = ctypes.addressof(self._names)
+            for i in range(self.size):
+                self._msgs[i].msg_hdr.msg_name = base + i * _SOCKADDR_STORAGE
+            return
+        if address is None:
+            self._c_address = None
+            name, namelen = None, 0
+        else:
+            self._c_address = _sockaddr_in(address)
+            name, namelen = ctypes.addressof(self._c_address), ctypes.sizeof(_SockAddrIn)
+        for i in range(self.size):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = name
+            hdr.msg_namelen = namelen
+
+    def _set_control_length(self, length):
+        if self.control_size:
+            words = self._size_words
+            for i in range(self.size):
+                words[i * self._SIZE_WORDS + self._CONTROLLEN_WORD] = length
+
+    def send(self, sock, datagrams, address):
+        """
+        Send all datagrams to one destination with as few sendmmsg() calls as possible.
+        :param sock: (socket) Socket to send from
+        :param datagrams: (list) bytes-like payloads, at most self.size of them
+        :param address: (tuple) (ip, port) destination
+        :return: (integer) Number of datagrams sent
+        """
+        # Nothing but the payload goes out
+        self._set_control_length(0)
+        self._set_address(address)
+        self._recv_ready = False
+        count = len(datagrams)
+        buffers = self.buffers
+        lengths = self._lengths
+        for i in range(count):
+            data = datagrams[i]
+            length = len(data)
+            buffers[i][:length] = data
+            if lengths[i] != length:
+                lengths[i] = length
+                self._iov_words[i * self._IOV_WORDS + 1] = length
+
+        sent = 0
+        fd = sock.fileno()
+        while sent < count:
+            result = _libc.sendmmsg(fd, ctypes.byref(self._msgs[sent]), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, "sendmmsg: %s" % errno.errorcode.get(err, err))
+            sent += result
+        return sent
+
+    def recv(self, sock):
+        """
+        Read every datagram already queued on the socket, up to self.size, without blocking.
+        :param sock: (socket) Socket to read from
+        :return: (list) Received payloads as bytes, empty if nothing was queued
+        """
+        if not self._recv_ready:
+            self._set_address(None)
+            for i in range(self.size):
+                self._lengths[i] = self.slot_size
+                self._iov_words[i * self._IOV_WORDS + 1] = self.slot_size
+            self._recv_ready = True
+        result = _libc.recvmmsg(sock.fileno(), self._msgs, self.size, socket.MSG_DONTWAIT, None)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, "recvmmsg: %s" % errno.errorcode.get(err, err))
+        words = self._msg_words
+        step = self._MSG_WORDS
+        offset = self._MSG_LEN_WORD
+        views = self._views
+        return [views[i][:words[i * step + offset]].tobytes() for i in range(result)]
+
+    def recv_timestamped(self, sock, cmsg_level, cmsg_type):
+        """
+        Like recv(), also returning the timespec each datagram carries as ancillary data,
+        e.g. the SO_TIMESTAMPNS receive time. Needs control_size.
+        :param sock: (socket) Socket to read from
+        :param cmsg_level: (integer) Level of the timestamp control message (SOL_SOCKET)
+        :param cmsg_type: (integer) Type of the timestamp control message
+        :return: (tuple) (payloads, timestamps in ns, None for datagrams without one)
+        """
+        # The kernel shrinks msg_controllen to what it used
+        self._set_control_length(self.control_size)
+        payloads = self.recv(sock)
+        words = self._size_words
+        step = self._SIZE_WORDS
+        offset = self._CONTROLLEN_WORD
+        stamps = []
+        for i in range(len(payloads)):
+            stamp = None
+            if words[i * step + offset] >= _CMSG_TIMESPEC.size:
+                length, level, kind, seconds, nanoseconds = _CMSG_TIMESPEC.unpack_from(self._controls[i])
+                if level == cmsg_level and kind == cmsg_type:
+                    stamp = seconds * 10 ** 9 + nanoseconds
+            stamps.append(stamp)
+        return payloads, stamps
+
+
+    def echo(self, sock, flags=socket.MSG_DONTWAIT, stamp=None):
+        """
+        Send every queued datagram, up to self.size, back where it came from, byte for byte.
+        The datagrams are received with one recvmmsg() and returned with one sendmmsg()
+        from the same slots, without copying them.
+        :param sock: (socket) Socket to echo on
+        :param flags: (integer) recvmmsg() flags, MSG_WAITFORONE blocks for the first datagram
+        :param stamp: (callable) Optional stamp(buffer, length, rx_ns) -> new length, called on
+            every datagram before it is echoed, with the monotonic ns time it was received
+        :return: (integer) Number of datagrams echoed, 0 if nothing was queued
+        """
+        self._set_control_length(0)
+        self._set_address(self._ECHO)
+        self._recv_ready = False
+        words = self._msg_words
+        iov_words = self._iov_words
+        lengths = self._lengths
+        step = self._MSG_WORDS
+        namelen = self._NAMELEN_WORD
+        for i in range(self.size):
+            words[i * step + namelen] = _SOCKADDR_STORAGE
+            if lengths[i] != self.slot_size:
+                lengths[i] = self.slot_size
+                iov_words[i * self._IOV_WORDS + 1] = self.slot_size
+        fd = sock.fileno()
+        count = _libc.recvmmsg(fd, self._msgs, self.size, flags, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, "recvmmsg: %s" % errno.errorcode.get(err, err))
+        rx_ns = time.monotonic_ns() if stamp is not None else 0
+        offset = self._MSG_LEN_WORD
+        buffers = self.buffers
+        for i in range(count):
+            length = words[i * step + offset]
+            if stamp is not None:
+                length = stamp(buffers[i], length, rx_ns)
+            lengths[i] = length
+            iov_words[i * self._IOV_WORDS + 1] = length
+
+        sent = 0
+        while sent < count:
+            result = _libc.sendmmsg(fd, ctypes.byref(self._msgs[sent]), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Send buffer full, drop the rest like a busy server would
+                    break
+                raise OSError(err, "sendmmsg: %s" % errno.errorcode.get(err, err))
+            sent += result
+        return count
+
+
+class SimpleBatch(object):
+    """
+    Per-packet fallback with the same interface as MMsgBatch.
+    """
+
+    def __init__(self, size, slot_size=MAX_DATAGRAM):
+        self.size = size
+        self.slot_size = slot_size
+        self._buffer = None
+        self._view = None
+
+    def send(self, sock, datagrams, address):
+        for data in datagrams:
+            sock.sendto(data, 0, address)
+        return len(datagrams)
+
+    def recv(self, sock):
+        received = []
+        while len(received) < self.size:
+            try:
+                received.append(sock.recv(self.slot_size, socket.MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                break
+        return received
+
+    def echo(self, sock, flags=socket.MSG_DONTWAIT, stamp=None):
+        if self._buffer is None:
+            self._buffer = bytearray(self.slot_size)
+            self._view = memoryview(self._buffer)
+        # Like MSG_WAITFORONE: only the first read may block
+        recv_flags = 0 if flags & MSG_WAITFORONE else socket.MSG_DONTWAIT
+        count = 0
+        while count < self.size:
+            try:
+                length, address = sock.recvfrom_into(self._buffer, self.slot_size, recv_flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            if stamp is not None:
+                length = stamp(self._buffer, length, time.monotonic_ns())
+            sock.sendto(self._view[:length], address)
+            recv_flags = socket.MSG_DONTWAIT
+            count += 1
+        return count
+
+
+def make_batch(size, slot_size=MAX_DATAGRAM):
+    """
+    :param size: (integer) Datagrams per system call
+    :param slot_size: (integer) Size of each datagram buffer
+    :return: MMsgBatch when the platform supports it and size > 1, otherwise SimpleBatch
+    """
+    if HAVE_MMSG and size > 1:
+        return MMsgBatch(size, slot_size)
+    return SimpleBatch(size, slot_size)
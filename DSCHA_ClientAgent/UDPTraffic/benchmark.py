@@ -0,0 +1,724 @@
+#!/bin/env python
+"""
+Loopback micro-benchmarks for the UDP traffic engine.
+
+Run from the project directory, e.g.
+    python -m UDPTraffic.benchmark socket_pool
+Every benchmark talks to sockets on 127.0.0.1 only and prints one line per variant.
+"""
+import sys
+import time
+import select
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from UDPTraffic.socketpool import UDPSocketPool, open_fd_count
+from UDPTraffic.batchio import MMsgBatch, SimpleBatch, HAVE_MMSG, MAX_DATAGRAM, make_batch
+from UDPTraffic.pacer import TokenBucketPacer
+from UDPTraffic.tracker import InFlightTracker, ring_capacity
+from UDPTraffic.packet import PacketBuilder, parse_header
+
+
+def _sink():
+    """
+    :return: (socket) A UDP socket bound to an ephemeral loopback port that nobody reads
+    """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    return sink
+
+
+def _report(name, packets, elapsed, extra=""):
+    print("%-28s %10d pkts %8.3f s %12.0f pps %s" % (name, packets, elapsed, packets / elapsed, extra))
+
+
+def bench_socket_pool(packets=20000, port_start=41000, port_stop=43000):
+    """
+    Compare one bound socket per packet against the pre-bound round-robin socket pool.
+    """
+    sink = _sink()
+    destination = sink.getsockname()
+
+    epoll_obj = select.epoll()
+    port = port_start
+    start = time.perf_counter()
+    for sequence in range(packets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", port))
+        epoll_obj.register(sock.fileno(), select.EPOLLIN)
+        sock.sendto(bytes(str(sequence), "utf-8"), 0, destination)
+        epoll_obj.unregister(sock.fileno())
+        sock.close()
+        port += 1
+        if port == port_stop:
+            port = port_start
+    _report("socket per packet", packets, time.perf_counter() - start)
+
+    pool = UDPSocketPool(port_start, port_stop, epoll_obj, bind_ip="127.0.0.1")
+    pool.open()
+    start = time.perf_counter()
+    for sequence in range(packets):
+        pool.next_socket().sendto(bytes(str(sequence), "utf-8"), 0, destination)
+    _report("socket pool", packets, time.perf_counter() - start,
+            "(%d sockets, %s fds open)" % (len(pool), open_fd_count()))
+    pool.close()
+    epoll_obj.close()
+    sink.close()
+
+
+def bench_batch_io(packets=200000, batch_size=64):
+    """
+    Compare per-packet sendto()/recv() against sendmmsg()/recvmmsg() batches on loopback.
+    """
+    if not HAVE_MMSG:
+        print("sendmmsg/recvmmsg not available on this platform")
+        return
+    payloads = [bytes(str(sequence), "utf-8") for sequence in range(batch_size)]
+    for name, batch in (("per packet", SimpleBatch(batch_size)),
+                        ("mmsg batch of %d" % batch_size, MMsgBatch(batch_size))):
+        sink = _sink()
+        sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        destination = sink.getsockname()
+        sent = 0
+        received = 0
+        send_time = 0.0
+        recv_time = 0.0
+        while sent < packets:
+            start = time.perf_counter()
+            sent += batch.send(sender, payloads, destination)
+            send_time += time.perf_counter() - start
+            # Drain before the receive buffer overflows so recv is measured on real datagrams
+            if sent % (batch_size * 32) == 0:
+                start = time.perf_counter()
+                replies = batch.recv(sink)
+                while replies:
+                    received += len(replies)
+                    replies = batch.recv(sink)
+                recv_time += time.perf_counter() - start
+        _report("send " + name, sent, send_time)
+        _report("recv " + name, received, recv_time)
+        sender.close()
+        sink.close()
+
+
+def bench_pacer(rates=(1000, 10000, 50000), seconds=1.0):
+    """
+    Pacing accuracy of TokenBucketPacer without I/O, against the old burst-then-sleep(1ms) loop.
+    """
+    for rate in rates:
+        pacer = TokenBucketPacer(rate)
+        stop = time.monotonic_ns() + int(seconds * 10 ** 9)
+        sent = 0
+        start = time.perf_counter()
+        while pacer.wait(1, stop):
+            sent += 1
+        stats = pacer.pop_stats()
+        _report("pacer %d pps" % rate, sent, time.perf_counter() - start,
+                "gap %.1f/%.1f us, mean error %.1f us, max %.1f us" %
+                (stats["achieved_gap_us"], stats["target_gap_us"], stats["pacing_error_us"],
+                 stats["max_pacing_error_us"]))
+
+        # Old loop: all packets at the top of the second, longest gap is the rest of the second
+        start = time.perf_counter()
+        burst_end = None
+        for i in range(rate):
+            burst_end = time.perf_counter()
+        _report("burst loop %d pps" % rate, rate, 1.0,
+                "burst lasts %.1f us, then idle %.1f ms" %
+                ((burst_end - start) * 10 ** 6, (1 - (burst_end - start)) * 1000))
+
+
+def _dictionary_bookkeeping(packets):
+    dictionary = {}
+    for sequence in range(1, packets + 1):
+        dictionary[str(sequence)] = [time.time(), None, None]
+    for sequence in range(1, packets + 1):
+        key = str(bytes(str(sequence), "utf-8"), "utf-8")
+        if key in dictionary:
+            dictionary[key][1] = time.time()
+    for sequence in range(1, packets + 1):
+        key = str(sequence)
+        if dictionary[key][1] is not None:
+            pass
+        del dictionary[key]
+    return dictionary
+
+
+def _tracker_bookkeeping(packets):
+    tracker = InFlightTracker(ring_capacity(packets, 1))
+    builder = PacketBuilder()
+    for sequence in range(1, packets + 1):
+        now = time.monotonic_ns()
+        tracker.sent(sequence, now)
+        builder.build(sequence, now)
+    for sequence in range(1, packets + 1):
+        header = parse_header(builder.build(sequence, 0))
+        tracker.ack(header[1], time.monotonic_ns() - header[2])
+    tracker.expire(1, packets + 1)
+    return tracker
+
+
+def bench_payload(packets=200000):
+    """
+    Building and sending padded packets: a header plus padding concatenated per packet, as
+    PacketBuilder used to, against its in-place preallocated buffers for fixed sizes, then
+    IMIX and uniform sizes in place. Memory is the peak traced by tracemalloc while building.
+    """
+    import tracemalloc
+
+    from UDPTraffic.packet import HEADER, MAGIC, VERSION
+
+    sink = _sink()
+    destination = sink.getsockname()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for size in (64, 1472, "imix", '{"type": "uniform", "min": 64, "max": 1472}'):
+        builders = [("in place", PacketBuilder(7, size))]
+        if isinstance(size, int):
+            builders.insert(0, ("concatenated", None))
+        for name, builder in builders:
+            if builder is None:
+                padding = bytes(PacketBuilder(7, size).payload_size - HEADER.size)
+
+                def build(sequence, send_ns):
+                    return HEADER.pack(MAGIC, 7, sequence, send_ns, 0, VERSION) + padding
+            else:
+                build = builder.build
+            tracemalloc.start()
+            for sequence in range(1000):
+                build(sequence, 0)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            start = time.perf_counter()
+            for sequence in range(packets):
+                build(sequence, 0)
+            built = time.perf_counter() - start
+            start = time.perf_counter()
+            sent = 0
+            for sequence in range(packets // 10):
+                data = build(sequence, 0)
+                sock.sendto(data, 0, destination)
+                sent += len(data)
+            _report("%s %s" % (size if len(str(size)) < 8 else "uniform", name), packets // 10,
+                    time.perf_counter() - start,
+                    "build %.2f us, %.0f B mean payload, %d B peak allocated" %
+                    (built / packets * 10 ** 6, sent * 10.0 / packets, peak))
+    sock.close()
+    sink.close()
+
+
+def bench_tracker(packets=200000):
+    """
+    Send/ack/expire bookkeeping: the old str-keyed dictionary against InFlightTracker with the
+    binary packet header.
+    Memory is the peak traced by tracemalloc in a second, untimed run.
+    """
+    import tracemalloc
+    for name, bookkeeping in (("dict of lists", _dictionary_bookkeeping),
+                              ("InFlightTracker", _tracker_bookkeeping)):
+        start = time.perf_counter()
+        bookkeeping(packets)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        bookkeeping(packets)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _report(name, packets, elapsed, "peak %.1f MB" % (peak / 2 ** 20))
+
+
+def _legacy_reader(epoll_obj, connections, state):
+    # The reader before it blocked in epoll: poll(0), one recv per ready fd, sleep 1 ms
+    cpu_start = time.thread_time_ns()
+    while state["running"]:
+        for fd, event in epoll_obj.poll(0):
+            if event & select.EPOLLIN:
+                header = parse_header(connections[fd].recv(1024))
+                if header is not None:
+                    state["received"] += 1
+        time.sleep(.001)
+    state["cpu_ns"] = time.thread_time_ns() - cpu_start
+
+
+def bench_reader(rates=(0, 1000, 10000), seconds=2.0, sockets=64, port_start=43000):
+    """
+    Reader CPU time per received packet (and per idle second) for the old poll(0) + sleep(1ms)
+    loop against the blocking, draining epoll reader of UDPTraffic.
+    """
+    from UDPTraffic.udptraffic import UDPTraffic
+
+    for rate in rates:
+        for name in ("poll(0)+sleep reader", "blocking epoll reader"):
+            epoll_obj = select.epoll()
+            pool = UDPSocketPool(port_start, port_start + sockets, epoll_obj, bind_ip="127.0.0.1")
+            pool.open()
+            state = {"running": True, "received": 0, "cpu_ns": 0}
+            if name.startswith("poll"):
+                reader = threading.Thread(target=_legacy_reader,
+                                          args=(epoll_obj, pool.connections, state))
+            else:
+                udp = UDPTraffic("127.0.0.1", port_start, rate)
+                udp.epoll_obj = epoll_obj
+                udp.connections = pool.connections
+                udp.tracker = InFlightTracker(ring_capacity(rate, 4))
+                udp._reset_counters()
+                udp.recv_batch = make_batch(UDPTraffic.READ_BATCH)
+                udp.read_client_data = True
+                reader = threading.Thread(target=udp._read_server_msg)
+            reader.start()
+
+            blaster = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            builder = PacketBuilder()
+            stop = time.monotonic_ns() + int(seconds * 10 ** 9)
+            sent = 0
+            if rate:
+                pacer = TokenBucketPacer(rate, burst=8)
+                while pacer.wait(1, stop):
+                    sent += 1
+                    blaster.sendto(builder.build(sent, time.monotonic_ns()),
+                                   pool.sockets[sent % sockets].getsockname())
+            else:
+                time.sleep(seconds)
+            time.sleep(0.2)
+
+            if name.startswith("poll"):
+                state["running"] = False
+                reader.join()
+                received, cpu_ns = state["received"], state["cpu_ns"]
+            else:
+                udp.read_client_data = False
+                reader.join()
+                received, cpu_ns = udp.received_packets, udp.reader_cpu_ns
+            if received:
+                extra = "%.2f us CPU per packet" % (cpu_ns / received / 1000)
+            else:
+                extra = "%.1f ms CPU per idle second" % (cpu_ns / seconds / 10 ** 6)
+            _report("%s %d pps" % (name, rate), max(received, 1), seconds, extra)
+            blaster.close()
+            pool.close()
+            epoll_obj.close()
+
+
+def bench_histogram(values=1000000):
+    """
+    Cost of recording a latency in the histogram, against summing it as avg_latency does.
+    """
+    from UDPTraffic.histogram import LatencyHistogram
+
+    latencies = [(i * 7919) % 5000000 + 20000 for i in range(values)]
+    start = time.perf_counter()
+    total = 0
+    for latency in latencies:
+        total += latency
+    _report("sum only", values, time.perf_counter() - start)
+
+    histogram = LatencyHistogram()
+    record = histogram.record
+    start = time.perf_counter()
+    for latency in latencies:
+        record(latency)
+    _report("histogram record", values, time.perf_counter() - start,
+            "%d buckets, %.1f KB" % (histogram.size, histogram.size * 8 / 1024.0))
+    start = time.perf_counter()
+    stats = histogram.stats()
+    compact = histogram.to_compact()
+    _report("percentiles + compact", 1, time.perf_counter() - start,
+            "p99.9 %.6f s, compact form %d bytes" % (stats["latency_p999"], len(compact)))
+
+
+def _echo_server(address, ready):
+    """
+    Process target: echo every datagram on address back to its sender.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    ready.set()
+    while True:
+        data, peer = sock.recvfrom(MAX_DATAGRAM)
+        sock.sendto(data, peer)
+
+
+def bench_engines(rates=(1000, 10000, 50000), seconds=5.0, port_start=44000, ports=256):
+    """
+    Threaded UDPTraffic against AsyncUDPTraffic, sending to an echo server in a child process.
+    Prints the rate achieved, drops and latency from the stat records and the engine
+    process' CPU time per packet.
+    """
+    from UDPTraffic.udptraffic import UDPTraffic
+    from UDPTraffic.asyncudp import AsyncUDPTraffic
+
+    address = ("127.0.0.1", port_start - 1)
+    ready = multiprocessing.Event()
+    echo = multiprocessing.Process(target=_echo_server, args=(address, ready))
+    echo.daemon = True
+    echo.start()
+    ready.wait(5)
+    try:
+        for rate in rates:
+            for name, engine in (("threaded", UDPTraffic), ("asyncio", AsyncUDPTraffic)):
+                udp = engine(address[0], address[1], rate)
+                udp.log.setLevel("WARNING")
+                udp.report_stats = False
+                udp.udp_port_range_start = port_start
+                udp.udp_port_range_stop = port_start + ports
+                stopper = threading.Timer(seconds, udp.stop)
+                stopper.start()
+                cpu = time.process_time()
+                start = time.perf_counter()
+                udp.start()
+                stopper.join()
+                elapsed = time.perf_counter() - start
+                cpu = time.process_time() - cpu
+                records = []
+                while len(records) < seconds - udp.client_read_timeout - 1:
+                    records.append(udp.stat_queue.get(timeout=5))
+                sent = sum(record["packets_sent"] for record in records)
+                received = sum(record["packets_receive"] for record in records)
+                latency = sum(record["avg_latency"] * record["packets_receive"] for record in records)
+                extra = "%.0f pps achieved, %d/%d dropped, %.0f us latency, %.1f us CPU per packet" % (
+                    sum(record["achieved_pps"] for record in records) / len(records),
+                    sent - received, sent, latency / max(received, 1) * 10 ** 6,
+                    cpu / max(udp.packet_sequence - udp.sequence_start, 1) * 10 ** 6)
+                _report("%s %d pps" % (name, rate), udp.packet_sequence - udp.sequence_start, seconds, extra)
+    finally:
+        echo.terminate()
+
+
+def bench_multiflow(flows=50, rate=100, seconds=5.0, port_start=47000, ports=256):
+    """
+    flows UDPTraffic engines side by side (as flows Celery tasks would run them, here threads of
+    one process) against one MultiFlowUDPTraffic with the same flows, sending to an echo server
+    in a child process. Prints the packets sent and echoed and the CPU time per packet.
+    """
+    from UDPTraffic.udptraffic import UDPTraffic
+    from UDPTraffic.multiflow import MultiFlowUDPTraffic
+
+    address = ("127.0.0.1", port_start - 1)
+    ready = multiprocessing.Event()
+    echo = multiprocessing.Process(target=_echo_server, args=(address, ready))
+    echo.daemon = True
+    echo.start()
+    ready.wait(5)
+    try:
+        for name in ("%d engines" % flows, "1 multi-flow engine"):
+            if name.startswith("1 "):
+                engines = [MultiFlowUDPTraffic([(address[0], address[1], rate, i + 1) for i in range(flows)])]
+                engines[0].udp_port_range_start = port_start
+                engines[0].udp_port_range_stop = port_start + ports
+            else:
+                engines = []
+                for i in range(flows):
+                    udp = UDPTraffic(address[0], address[1], rate)
+                    udp.flow_id = i + 1
+                    udp.udp_port_range_start = port_start + i * ports // flows
+                    udp.udp_port_range_stop = port_start + (i + 1) * ports // flows
+                    engines.append(udp)
+            threads = []
+            for udp in engines:
+                udp.log.setLevel("WARNING")
+                udp.report_stats = False
+                threads.append(threading.Thread(target=udp.start))
+            cpu = time.process_time()
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            for udp in engines:
+                udp.stop()
+            for thread in threads:
+                thread.join()
+            cpu = time.process_time() - cpu
+            records = []
+            for udp in engines:
+                records.extend(udp.stat_queue.drain())
+            sent = sum(record["packets_sent"] for record in records)
+            received = sum(record["packets_receive"] for record in records)
+            _report(name, sent, seconds, "%d/%d dropped, %.1f us CPU per packet" %
+                    (sent - received, sent, cpu / max(sent, 1) * 10 ** 6))
+    finally:
+        echo.terminate()
+
+
+def bench_echo_server(seconds=2.0, window=64, port=45000):
+    """
+    Echoes per second and server CPU per echo for the socketserver echo server against
+    SO_REUSEPORT workers, per packet and batched, with a client keeping window datagrams in
+    flight. The client is usually the bottleneck, the CPU column shows the server's cost.
+    """
+    import resource
+
+    from UDPTraffic.udpserver import UDPEchoServer, ReusePortEchoServer
+
+    variants = (("socketserver", None),
+                ("reuseport 1 worker", (1, 1)),
+                ("reuseport 1 worker mmsg", (1, 32)),
+                ("reuseport 2 workers mmsg", (2, 32)))
+    builder = PacketBuilder(payload_size=64)
+    for i, (name, options) in enumerate(variants):
+        address = ("127.0.0.1", port + i)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if options is None:
+            server = UDPEchoServer(*address)
+            process = multiprocessing.Process(target=server.start)
+            process.daemon = True
+            process.start()
+        else:
+            server = ReusePortEchoServer(address[0], address[1], *options)
+            process = threading.Thread(target=server.start)
+            process.daemon = True
+            process.start()
+        time.sleep(0.5)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(0.2)
+        echoed = 0
+        corrupted = 0
+        stop = time.perf_counter() + seconds
+        while time.perf_counter() < stop:
+            for sequence in range(window):
+                client.sendto(builder.build(sequence, 0), address)
+            for sequence in range(window):
+                try:
+                    data = client.recv(MAX_DATAGRAM)
+                except socket.timeout:
+                    break
+                echoed += 1
+                if len(data) != builder.payload_size or parse_header(data) is None:
+                    corrupted += 1
+        client.close()
+        if options is None:
+            process.terminate()
+            process.join()
+        else:
+            server.stop()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+        _report(name, echoed, seconds, "%.2f us server CPU per echo, %d corrupted" %
+                (cpu / max(echoed, 1) * 10 ** 6, corrupted))
+
+
+def bench_reporter(minutes=1, report_interval=5):
+    """
+    Requests, TCP connections and body bytes a minute of stat records costs the controller:
+    a plain requests.post every report_interval seconds against StatReporter.
+    """
+    import json
+    import tempfile
+    import requests
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from UDPTraffic.histogram import LatencyHistogram
+    from UDPTraffic.reporter import StatReporter
+
+    counters = {"requests": 0, "connections": 0, "bytes": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            counters["connections"] += 1
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            self.rfile.read(length)
+            counters["requests"] += 1
+            counters["bytes"] += length + len(str(self.headers))
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/api/v1/udptrafficstat/" % server.server_port
+
+    # One record per second, shaped like the engine's (with a shipped histogram)
+    histogram = LatencyHistogram()
+    for value in range(20000, 120000, 7):
+        histogram.record(value)
+    record = {"app_id": 1, "byte_sent": 640000, "packets_sent": 10000, "packets_receive": 9998,
+              "drop_packets": 2, "avg_latency": 4.1234e-05, "pkt_time": "2018-01-01 00:00:00.000000",
+              "interval": 1, "achieved_pps": 10000.0, "latency_histogram": histogram.to_compact()}
+    record.update(histogram.stats())
+    batches = [[dict(record, interval=second + i) for i in range(report_interval)]
+               for second in range(0, 60 * minutes, report_interval)]
+
+    def plain(batch):
+        requests.post(url, json={"data_list": batch})
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        reporter = StatReporter(url, spool_dir)
+        for name, post in (("requests.post", plain), ("StatReporter", reporter.post)):
+            for key in counters:
+                counters[key] = 0
+            start = time.perf_counter()
+            for batch in batches:
+                post(batch)
+            elapsed = time.perf_counter() - start
+            print("%-28s %6d requests/min %6d connections/min %9d bytes/min %8.1f ms" %
+                  (name, counters["requests"] / minutes, counters["connections"] / minutes,
+                   counters["bytes"] / minutes, elapsed * 1000))
+        reporter.close()
+    server.shutdown()
+    server.server_close()
+
+
+def _stat_record(histogram):
+    """
+    :param histogram: (LatencyHistogram) Histogram the record ships
+    :return: (dict) A shard stat record with every SharedStatRing field
+    """
+    from UDPTraffic.statqueue import RECORD_FIELDS
+    from UDPTraffic.reorder import REORDER_BUCKETS
+
+    record = {}
+    for key, fmt in RECORD_FIELDS:
+        record[key] = 1.5 if fmt == "d" else 12345 if fmt == "q" else "2018-01-01 00:00:00.000000"
+    record["clock_source"] = "user"
+    record["outages"] = []
+    record["reorder_distance"] = [0] * REORDER_BUCKETS
+    record["latency_histogram"] = histogram
+    return record
+
+
+def _put_records(stat_queue, records, compact):
+    """
+    Process target: put records copies of a stat record on stat_queue.
+    """
+    from UDPTraffic.histogram import LatencyHistogram
+
+    histogram = LatencyHistogram()
+    for value in range(20000, 120000, 7):
+        histogram.record(value)
+    for i in range(records):
+        stat_queue.put(_stat_record(histogram.to_compact() if compact else histogram))
+
+
+def bench_stat_queue(records=20000):
+    """
+    Cost of handing one stat record from the sender to its consumer: multiprocessing.Queue
+    against StatQueue within a process, and multiprocessing.Queue (with the compact histogram
+    shards used to ship) against SharedStatRing from a shard process to its parent.
+    """
+    from UDPTraffic.histogram import LatencyHistogram
+    from UDPTraffic.statqueue import StatQueue, SharedStatRing
+
+    record = _stat_record(None)
+    del record["latency_histogram"]
+    for name, stat_queue in (("multiprocessing.Queue", multiprocessing.Queue()), ("StatQueue", StatQueue())):
+        start = time.perf_counter()
+        for i in range(records // 100):
+            for j in range(100):
+                stat_queue.put(record)
+            for j in range(100):
+                stat_queue.get(timeout=5)
+        elapsed = time.perf_counter() - start
+        _report("%s in process" % name, records, elapsed, "%.2f us per record" % (elapsed / records * 10 ** 6))
+
+    shard_records = records // 10
+    for name, stat_queue, compact in (("multiprocessing.Queue", multiprocessing.Queue(), True),
+                                      ("SharedStatRing", SharedStatRing(shard_records), False)):
+        producer = multiprocessing.Process(target=_put_records, args=(stat_queue, shard_records, compact))
+        producer.start()
+        # Time from the first record on, the producer's setup is not part of the handoff
+        record = stat_queue.get(timeout=10)
+        start = time.perf_counter()
+        cpu = time.process_time()
+        for i in range(shard_records - 1):
+            record = stat_queue.get(timeout=10)
+            histogram = record["latency_histogram"]
+            if not isinstance(histogram, LatencyHistogram):
+                histogram = LatencyHistogram.from_compact(histogram)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        producer.join()
+        _report("%s from shard" % name, shard_records, elapsed,
+                "%.2f us per record, %.2f us parent CPU, %d dropped" %
+                (elapsed / shard_records * 10 ** 6, cpu / shard_records * 10 ** 6,
+                 getattr(stat_queue, "dropped", 0)))
+
+
+def bench_stop_start(cycles=3, rate=10000, seconds=1.5, port_start=46000, ports=256):
+    """
+    Start -> stop -> start cycle of each engine against an echo server: time from start() to
+    the first packet, from stop() to its return, and whether the stats of every packet sent
+    made it into the stat records. The old stop() slept client_read_timeout (2 s) and lost
+    the intervals not expired yet.
+    """
+    from UDPTraffic.udptraffic import UDPTraffic
+    from UDPTraffic.asyncudp import AsyncUDPTraffic
+    from UDPTraffic.sharded import ShardedUDPTraffic
+    from UDPTraffic.udpserver import ReusePortEchoServer
+
+    server = ReusePortEchoServer("127.0.0.1", port_start - 1, workers=1)
+    server_thread = threading.Thread(target=server.start)
+    server_thread.daemon = True
+    server_thread.start()
+    time.sleep(0.5)
+    try:
+        for name, engine in (("threaded", UDPTraffic), ("asyncio", AsyncUDPTraffic),
+                             ("sharded", ShardedUDPTraffic)):
+            for cycle in range(cycles):
+                udp = engine("127.0.0.1", port_start - 1, rate)
+                udp.log.setLevel("WARNING")
+                udp.report_stats = False
+                udp.udp_port_range_start = port_start
+                udp.udp_port_range_stop = port_start + ports
+                runner = threading.Thread(target=udp.start)
+                start = time.perf_counter()
+                runner.start()
+                # The shards' packets are counted in the shard processes
+                while engine is not ShardedUDPTraffic and not udp.sent_packets and runner.is_alive():
+                    time.sleep(0.0005)
+                first_packet = time.perf_counter() - start
+                time.sleep(seconds)
+                stop = time.perf_counter()
+                udp.stop()
+                stopped = time.perf_counter() - stop
+                runner.join()
+                records = udp.stat_queue.drain()
+                sent = sum(record["packets_sent"] for record in records)
+                received = sum(record["packets_receive"] for record in records)
+                if engine is ShardedUDPTraffic:
+                    first_packet = "        -"
+                else:
+                    first_packet = "%6.1f ms" % (first_packet * 1000)
+                print("%-10s cycle %d: first packet %s, stop %7.1f ms, %d records, %d sent, %d echoed" %
+                      (name, cycle, first_packet, stopped * 1000, len(records), sent, received))
+    finally:
+        server.stop()
+
+
+BENCHMARKS = {
+    "echo_server": bench_echo_server,
+    "engines": bench_engines,
+    "histogram": bench_histogram,
+    "reader": bench_reader,
+    "reporter": bench_reporter,
+    "tracker": bench_tracker,
+    "pacer": bench_pacer,
+    "payload": bench_payload,
+    "socket_pool": bench_socket_pool,
+    "stat_queue": bench_stat_queue,
+    "stop_start": bench_stop_start,
+    "multiflow": bench_multiflow,
+    "batch_io": bench_batch_io,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDP traffic engine loopback benchmarks")
+    parser.add_argument("names", nargs="*", default=sorted(BENCHMARKS),
+                        help="benchmarks to run (%s)" % ", ".join(sorted(BENCHMARKS)))
+    args = parser.parse_args(argv)
+    for name in args.names:
+        print("== %s" % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Clock offset estimation.
+
+The echo server stamps packets with its own clock, so one-way latencies need the offset
+between the server clock and the client's. ClockOffsetEstimator derives it from the traffic
+itself, NTP style: a packet sent at t0 and echoed back at t3, received by the server at rx
+and sent at tx, gives
+
+    delay  = (t3 - t0) - (tx - rx)
+    offset = ((rx - t0) + (tx - t3)) / 2
+
+The offset is exact when both directions took equally long, and off by at most delay / 2
+otherwise, so the estimate is the offset of the sample with the smallest delay, the one least
+disturbed by queuing. Only the best sample of each of the last few windows is kept, so the
+estimate follows clock drift without storing samples.
+
+With this offset the forward and return latencies of the quietest packet come out equal.
+Their absolute split is therefore an assumption, but a path that gets slower shows up as a
+change in its own direction only.
+"""
+import collections
+
+
+class ClockOffsetEstimator(object):
+    """
+    .. python::
+    Example Usage
+    estimator = ClockOffsetEstimator()
+    estimator.add(send_ns, rx_ns, tx_ns, receive_ns)   # For every echo
+    estimator.rotate()                                  # Once per interval
+    forward_ns = rx_ns - send_ns - estimator.offset()
+    """
+    # Windows the minimum delay sample is taken from
+    WINDOWS = 10
+
+    def __init__(self, windows=WINDOWS):
+        """
+        Constructor
+        :param windows: (integer) Number of windows (rotate() calls) a sample is kept for
+        :return: None
+        """
+        self._windows = collections.deque(maxlen=windows)
+        self._delay = None
+        self._offset = None
+        self._best = None
+
+    def add(self, t0, rx, tx, t3):
+        """
+        Take one echo into account.
+        :param t0: (integer) Client send time, client clock in ns
+        :param rx: (integer) Server receive time, server clock in ns
+        :param tx: (integer) Server send time, server clock in ns
+        :param t3: (integer) Client receive time, client clock in ns
+        :return: None
+        """
+        delay = (t3 - t0) - (tx - rx)
+        if self._delay is None or delay < self._delay:
+            self._delay = delay
+            self._offset = ((rx - t0) + (tx - t3)) // 2
+
+    def rotate(self):
+        """
+        Close the current window, dropping the oldest one.
+        :return: None
+        """
+        if self._delay is not None:
+            self._windows.append((self._delay, self._offset))
+        self._delay = None
+        self._offset = None
+        self._best = min(self._windows) if self._windows else None
+
+    def offset(self):
+        """
+        :return: (integer) Server clock minus client clock in ns, None before the first echo
+        """
+        best = self._best
+        if self._delay is not None and (best is None or self._delay < best[0]):
+            best = (self._delay, self._offset)
+        return best[1] if best is not None else None
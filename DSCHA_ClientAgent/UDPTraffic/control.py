@@ -0,0 +1,233 @@
+"""
+Cooperative task control.
+
+Revoking a Celery task with SIGKILL stops traffic by killing the pool process: sockets and
+the final stats are lost and the worker has to be respawned. Instead, every traffic and
+server task listens on a control socket named after its celery_id, and the API asks it to
+stop. The task stops its engine (which drains the last echoes and flushes its stats) and,
+once the engine is down, answers "stopped" so the API knows the worker slot is free again.
+
+The control sockets are Unix datagram sockets in the Linux abstract namespace, so nothing
+is left behind on disk and the API and the Celery worker only need to share a host.
+
+Tasks may take other commands too, e.g. adding a flow to a running multi-flow engine. A
+command is its name followed by a space and a JSON argument; send_command() waits for the
+task to answer "ok" or "error <reason>". A command that returns something, such as a
+server's counters, answers "ok <JSON result>", which query() decodes.
+"""
+import json
+import socket
+import logging
+import threading
+
+# Abstract socket name of a task's control channel
+ADDRESS = "\0DSCHA_ClientAgent/control/%s"
+STOP = b"stop"
+STOPPED = b"stopped"
+OK = b"ok"
+ERROR = b"error"
+# Largest command a channel reads
+MAX_MESSAGE = 65536
+# Seconds request_stop() waits for a task to confirm it stopped
+STOP_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class ControlChannel(object):
+    """
+    The task side of the control socket.
+
+    .. python::
+    Example Usage
+    channel = ControlChannel(celery_id)
+    channel.listen(udp.stop)   # udp.stop() runs when the API asks the task to stop
+    udp.start()
+    channel.close()            # Confirms the stop to whoever asked
+    """
+
+    def __init__(self, celery_id):
+        """
+        Constructor
+        :param celery_id: (string) Id of the task the channel belongs to
+        :return: None
+        """
+        self.celery_id = celery_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(ADDRESS % celery_id)
+        # Addresses of the callers waiting for STOPPED
+        self._waiting = []
+        self._thread = None
+
+    def listen(self, on_stop, commands=None):
+        """
+        Watch the channel from a daemon thread and call on_stop once a stop is requested.
+        :param on_stop: (callable) Stops the task, called from the watching thread
+        :param commands: (dict) Other commands the task takes, name -> callable taking the
+            decoded JSON argument, returning None or a JSON serializable result and raising
+            ValueError to refuse it
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._watch, args=(on_stop, commands or {}))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self, on_stop, commands):
+        """
+        Private method
+        :param on_stop: (callable) Called on the first stop request
+        :param commands: (dict) Other commands, see listen()
+        :return: None
+        """
+        stopping = False
+        while True:
+            try:
+                command, address = self.sock.recvfrom(MAX_MESSAGE)
+            except OSError:
+                return
+            if not command:
+                # Shut down by close()
+                return
+            if command != STOP:
+                self._run_command(command, address, commands)
+                continue
+            if address:
+                self._waiting.append(address)
+            if not stopping:
+                stopping = True
+                logger.info("Stop requested for task %s" % self.celery_id)
+                on_stop()
+
+    def _run_command(self, message, address, commands):
+        """
+        Private method
+        Run a command other than stop and answer the caller.
+        :param message: (bytes) Command name and JSON argument
+        :param address: (string) Address of the caller, empty if it does not wait for an answer
+        :param commands: (dict) Commands the task takes, see listen()
+        :return: None
+        """
+        name, sep, argument = message.partition(b" ")
+        name = name.decode("utf-8", "replace")
+        handler = commands.get(name)
+        if handler is None:
+            reply = ERROR + b" unknown command"
+        else:
+            try:
+                result = handler(json.loads(argument.decode("utf-8")) if argument else None)
+                reply = OK
+                if result is not None:
+                    reply += b" " + json.dumps(result).encode("utf-8")
+            except ValueError as e:
+                reply = ERROR + b" " + str(e).encode("utf-8")
+            except Exception as e:
+                logger.exception("Command %s of task %s failed" % (name, self.celery_id))
+                reply = ERROR + b" " + str(e).encode("utf-8")
+        if address:
+            try:
+                self.sock.sendto(reply, address)
+            except OSError:
+                # The caller gave up waiting
+                pass
+
+    def close(self):
+        """
+        Tell every caller waiting in request_stop() that the task stopped, and close the channel.
+        :return: None
+        """
+        for address in self._waiting:
+            try:
+                self.sock.sendto(STOPPED, address)
+            except OSError:
+                # The caller gave up waiting
+                pass
+        self._waiting = []
+        # shutdown() wakes the watching thread up, close() alone would not
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def request_stop(celery_id, timeout=STOP_TIMEOUT):
+    """
+    Ask a task to stop and wait for it to confirm.
+    :param celery_id: (string) Id of the task
+    :param timeout: (number) Seconds to wait for the confirmation
+    :return: (boolean) True once the task stopped, False if it is not listening (not started
+        yet, already gone or not cooperative) or did not stop in time
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        # Autobind to an abstract address the task can answer to
+        sock.bind("")
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(STOP, ADDRESS % celery_id)
+            return sock.recv(64) == STOPPED
+        except OSError:
+            # Also socket.timeout
+            return False
+    finally:
+        sock.close()
+
+
+def _call(celery_id, name, argument, timeout):
+    """
+    Private method
+    Send a command to a running task and wait for its answer.
+    :param celery_id: (string) Id of the task
+    :param name: (string) Command name
+    :param argument: (object) JSON serializable argument
+    :param timeout: (number) Seconds to wait for the answer
+    :return: (bytes) JSON result, empty if the command returned nothing, None if the task
+        refused the command, is not listening or did not answer in time
+    """
+    message = name.encode("utf-8")
+    if argument is not None:
+        message += b" " + json.dumps(argument).encode("utf-8")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.bind("")
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(message, ADDRESS % celery_id)
+            reply = sock.recv(MAX_MESSAGE)
+        except OSError:
+            return None
+    finally:
+        sock.close()
+    status, sep, result = reply.partition(b" ")
+    if status != OK:
+        logger.warning("Task %s refused %s: %s" % (celery_id, name, reply.decode("utf-8", "replace")))
+        return None
+    return result
+
+
+def send_command(celery_id, name, argument=None, timeout=STOP_TIMEOUT):
+    """
+    Send a command to a running task and wait for its answer.
+    :param celery_id: (string) Id of the task
+    :param name: (string) Command name, see ControlChannel.listen()
+    :param argument: (object) JSON serializable argument
+    :param timeout: (number) Seconds to wait for the answer
+    :return: (boolean) True if the task ran the command, False if it refused it, is not
+        listening or did not answer in time
+    """
+    return _call(celery_id, name, argument, timeout) is not None
+
+
+def query(celery_id, name, argument=None, timeout=STOP_TIMEOUT):
+    """
+    Send a command that returns a result to a running task, e.g. "stats" to a TCP server.
+    :param celery_id: (string) Id of the task
+    :param name: (string) Command name, see ControlChannel.listen()
+    :param argument: (object) JSON serializable argument
+    :param timeout: (number) Seconds to wait for the answer
+    :return: (object) The decoded result, None if the command returned nothing or failed
+    """
+    result = _call(celery_id, name, argument, timeout)
+    if not result:
+        return None
+    return json.loads(result.decode("utf-8"))
@@ -0,0 +1,192 @@
+"""
+Latency histogram.
+
+LatencyHistogram is a fixed-size, log-bucketed (HDR-style) histogram of nanosecond values.
+Values below 2 ** SUB_BITS get a bucket each; above that every power of two is split into
+2 ** (SUB_BITS - 1) linear sub-buckets, so any value is stored with a relative error below
+1 / 2 ** (SUB_BITS - 1) (1.6% with the default of 7 bits). Recording is a couple of integer
+operations and an array increment: no allocation, whatever the value.
+
+Histograms with the same layout merge by adding their counts, so intervals and shards can be
+combined exactly, and to_compact()/from_compact() turn one into a short string for shipping.
+"""
+import sys
+import zlib
+import base64
+import struct
+from array import array
+
+SUB_BITS = 7
+# Largest value tracked precisely (2 ** 36 ns is about 68 seconds); larger values are
+# counted in the last bucket
+MAX_BITS = 36
+# Percentiles reported in stat records, as (stat key suffix, percentile)
+PERCENTILES = (("p50", 50.0), ("p90", 90.0), ("p99", 99.0), ("p999", 99.9))
+
+_COMPACT_HEADER = struct.Struct("!BBBQQ")
+_COMPACT_VERSION = 1
+
+
+class LatencyHistogram(object):
+    """
+    .. python::
+    Example Usage
+    histogram = LatencyHistogram()
+    histogram.record(latency_ns)
+    histogram.merge(other_histogram)
+    print(histogram.percentile(99.9), histogram.max)
+    """
+
+    def __init__(self, sub_bits=SUB_BITS, max_bits=MAX_BITS):
+        """
+        Constructor
+        :param sub_bits: (integer) Precision, values are kept within 1 / 2 ** (sub_bits - 1)
+        :param max_bits: (integer) Values up to 2 ** max_bits are tracked precisely
+        :return: None
+        """
+        self.sub_bits = sub_bits
+        self.max_bits = max_bits
+        self._linear = 1 << sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self.size = self._linear + (max_bits - sub_bits) * self._half
+        self._zeros = array("Q", bytes(8 * self.size))
+        self.counts = array("Q", self._zeros)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        """
+        :param value: (integer) Non-negative value
+        :return: (integer) Bucket holding value
+        """
+        if value < self._linear:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        index = self._linear + (shift - 1) * self._half + (value >> shift) - self._half
+        if index >= self.size:
+            return self.size - 1
+        return index
+
+    def _value(self, index):
+        """
+        :param index: (integer) Bucket index
+        :return: (integer) Middle of the range of values the bucket holds
+        """
+        if index < self._linear:
+            return index
+        shift, sub = divmod(index - self._linear, self._half)
+        shift += 1
+        return ((sub + self._half) << shift) + (1 << (shift - 1))
+
+    def record(self, value):
+        """
+        Count one value.
+        :param value: (integer) Value in ns, negative values count as 0
+        :return: None
+        """
+        if value < 0:
+            value = 0
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        """
+        Forget every value, keeping the buckets allocated.
+        :return: None
+        """
+        if self.count:
+            self.counts[:] = self._zeros
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def merge(self, other):
+        """
+        Add another histogram's values to this one.
+        :param other: (LatencyHistogram) Histogram with the same sub_bits and max_bits
+        :return: None
+        """
+        if (other.sub_bits, other.max_bits) != (self.sub_bits, self.max_bits):
+            raise ValueError("Cannot merge histograms with different bucket layouts")
+        if not other.count:
+            return
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, percentile):
+        """
+        :param percentile: (number) Percentile, 0 - 100
+        :return: (integer) Value at the percentile in ns (exact for the maximum), -1 if empty
+        """
+        if not self.count:
+            return -1
+        # Smallest bucket with at least this many values at or below it
+        wanted = max(int(self.count * percentile / 100.0 + 0.5), 1)
+        if wanted >= self.count:
+            return self.max
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def stats(self, prefix="latency_", scale=10 ** -9):
+        """
+        :param prefix: (string) Prefix of the stat keys
+        :param scale: (number) Factor applied to every value, the default converts ns to seconds
+        :return: (dict) {prefix + "p50": ..., ..., prefix + "max": ...}, -1 for empty histograms
+        """
+        stats = {}
+        for name, percentile in PERCENTILES:
+            value = self.percentile(percentile)
+            stats[prefix + name] = value * scale if value >= 0 else -1
+        stats[prefix + "max"] = self.max * scale if self.count else -1
+        return stats
+
+    def to_compact(self):
+        """
+        :return: (string) The histogram as base64 of the zlib compressed non-empty buckets
+        """
+        pairs = array("Q")
+        for index, count in enumerate(self.counts):
+            if count:
+                pairs.append(index)
+                pairs.append(count)
+        # Buckets are shipped little endian
+        if sys.byteorder == "big":
+            pairs.byteswap()
+        data = _COMPACT_HEADER.pack(_COMPACT_VERSION, self.sub_bits, self.max_bits, self.total,
+                                    self.max) + pairs.tobytes()
+        return base64.b64encode(zlib.compress(data)).decode("ascii")
+
+    @classmethod
+    def from_compact(cls, text):
+        """
+        :param text: (string) Output of to_compact()
+        :return: (LatencyHistogram) The histogram it encodes
+        """
+        data = zlib.decompress(base64.b64decode(text))
+        version, sub_bits, max_bits, total, maximum = _COMPACT_HEADER.unpack_from(data)
+        if version != _COMPACT_VERSION:
+            raise ValueError("Unknown compact histogram version %d" % version)
+        histogram = cls(sub_bits, max_bits)
+        pairs = array("Q", data[_COMPACT_HEADER.size:])
+        if sys.byteorder == "big":
+            pairs.byteswap()
+        for i in range(0, len(pairs), 2):
+            histogram.counts[pairs[i]] = pairs[i + 1]
+            histogram.count += pairs[i + 1]
+        histogram.total = total
+        histogram.max = maximum
+        return histogram
@@ -0,0 +1,298 @@
+"""
+Live stat rings.
+
+The controller only sees a run's stats every report interval, and the agent's database
+only as often (see app.statstore). To watch a run as it goes, the engine also writes every
+stat record, as it is put on stat_queue, to a LiveStatRing: a small fixed-size ring of
+JSON slots in a file under LIVE_DIR, tmpfs where there is one, one file per traffic row.
+The web process maps the same file read-only, so dashboards follow a run without a
+database query or a word to the sender (how many at once is up to the web process, see
+app.api.LiveStatApiView).
+
+There is one writer per ring and no lock. Each slot carries a sequence number that is odd
+while the slot is written, and the record's number; a reader copies the slot and keeps it
+only if the sequence was even and unchanged across the copy (a seqlock), so it never
+returns a half written record. A reader that falls a whole ring behind loses the records
+in between, it does not hold the writer up.
+
+A ring outlives its run: the next run of the same row carries on numbering its records,
+and remove_ring() deletes it with the row.
+"""
+import os
+import json
+import mmap
+import struct
+import tempfile
+
+# Directory the rings are kept in, in memory where the system has a tmpfs for it
+LIVE_DIR = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                        "DSCHA_ClientAgent-live")
+# Records a ring keeps, two minutes of one second intervals
+SLOTS = 120
+# Largest encoded record
+SLOT_SIZE = 4096
+MAGIC = b"DSLR"
+# Magic, slots, slot size, then the number of records ever written
+_HEADER = struct.Struct("=4sII")
+_WRITTEN = struct.Struct("=Q")
+# Sequence (odd while the slot is written), record number and length of the JSON
+_SLOT = struct.Struct("=QQI")
+
+
+def ring_path(kind, app_id):
+    """
+    :param kind: (string) "udp" or "tcp"
+    :param app_id: (object) Id of the traffic row
+    :return: (string) Path of the row's ring
+    """
+    return os.path.join(LIVE_DIR, "%s-%s" % (kind, app_id))
+
+
+def remove_ring(kind, app_id):
+    """
+    Delete a row's ring, readers that have it open keep their copy.
+    :param kind: (string) "udp" or "tcp"
+    :param app_id: (object) Id of the traffic row
+    :return: None
+    """
+    try:
+        os.remove(ring_path(kind, app_id))
+    except FileNotFoundError:
+        pass
+
+
+def _ring_size(slots, slot_size):
+    """
+    Private method
+    :param slots: (integer) Records the ring keeps
+    :param slot_size: (integer) Largest encoded record
+    :return: (integer) Bytes of the ring file
+    """
+    return _HEADER.size + _WRITTEN.size + slots * (_SLOT.size + slot_size)
+
+
+def _read_header(fd):
+    """
+    Private method
+    :param fd: (integer) Open ring file
+    :return: (tuple) Magic, slots and slot size, None if the file is shorter than a header
+    """
+    data = os.pread(fd, _HEADER.size, 0)
+    if len(data) < _HEADER.size:
+        return None
+    return _HEADER.unpack(data)
+
+
+def encode_record(record, limit=SLOT_SIZE):
+    """
+    :param record: (dict) Stat record
+    :param limit: (integer) Most bytes the encoded record may take
+    :return: (bytes) The record as compact JSON, without its latency histogram, and without
+        its lists (outage details, reorder distances) if it does not fit otherwise; None if
+        it still does not fit
+    """
+    data = {key: value for key, value in record.items() if key != "latency_histogram"}
+    body = json.dumps(data, separators=(",", ":"), default=str).encode("utf-8")
+    if len(body) > limit:
+        data = {key: value for key, value in data.items() if not isinstance(value, (list, dict))}
+        body = json.dumps(data, separators=(",", ":"), default=str).encode("utf-8")
+    return body if len(body) <= limit else None
+
+
+class LiveStatRing(object):
+    """
+    .. python::
+    Example Usage
+    ring = LiveStatRing(ring_path("udp", 1), writable=True)   # Engine
+    ring.put(record)
+    ring = LiveStatRing(ring_path("udp", 1))                  # Web process
+    for number, record in ring.read(count=10):
+        print(number, record)
+    """
+
+    def __init__(self, path, writable=False, slots=SLOTS, slot_size=SLOT_SIZE):
+        """
+        Constructor
+        :param path: (string) File of the ring
+        :param writable: (boolean) Open it for the engine, creating it if needed; readers
+            open an existing ring read-only and get FileNotFoundError if there is none
+        :param slots: (integer) Records a new ring keeps
+        :param slot_size: (integer) Largest encoded record a new ring takes
+        :return: None
+        """
+        self.path = path
+        self.writable = writable
+        if writable:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+        try:
+            header = _read_header(fd)
+            if writable and header != (MAGIC, slots, slot_size):
+                # New, or laid out otherwise: start it over in a new file, so readers that
+                # still map the old one are not cut short
+                os.close(fd)
+                fd = -1
+                os.remove(path)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+                os.ftruncate(fd, _ring_size(slots, slot_size))
+                os.pwrite(fd, _HEADER.pack(MAGIC, slots, slot_size), 0)
+                header = (MAGIC, slots, slot_size)
+            if header is None or header[0] != MAGIC:
+                raise ValueError("%s is not a live stat ring" % path)
+            self.slots, self.slot_size = header[1:]
+            size = _ring_size(self.slots, self.slot_size)
+            if os.fstat(fd).st_size < size:
+                raise ValueError("%s is cut short" % path)
+            self._map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            self._inode = os.fstat(fd).st_ino
+        finally:
+            if fd >= 0:
+                os.close(fd)
+        self._stride = _SLOT.size + self.slot_size
+        self._slots_start = _HEADER.size + _WRITTEN.size
+        # Records too large for a slot
+        self.skipped = 0
+
+    @property
+    def written(self):
+        """
+        :return: (integer) Records ever written to the ring, the number of the next one
+        """
+        return _WRITTEN.unpack_from(self._map, _HEADER.size)[0]
+
+    def put(self, record):
+        """
+        Write a record over the oldest one. Only the writer may call this.
+        :param record: (dict) Stat record
+        :return: (boolean) False if the record was too large for a slot
+        """
+        body = encode_record(record, self.slot_size)
+        if body is None:
+            self.skipped += 1
+            return False
+        number = self.written
+        offset = self._slots_start + number % self.slots * self._stride
+        sequence = _SLOT.unpack_from(self._map, offset)[0]
+        _SLOT.pack_into(self._map, offset, sequence + 1, number, len(body))
+        start = offset + _SLOT.size
+        self._map[start:start + len(body)] = body
+        _SLOT.pack_into(self._map, offset, sequence + 2, number, len(body))
+        _WRITTEN.pack_into(self._map, _HEADER.size, number + 1)
+        return True
+
+    def read(self, after=None, count=None):
+        """
+        :param after: (integer) Only records numbered after this one; a number the ring has
+            not reached means it was removed and started over, and reads from its start
+        :param count: (integer) At most this many, the latest
+        :return: (list) (number, record) of the records still in the ring, oldest first
+        """
+        written = self.written
+        first = max(written - self.slots, 0)
+        if after is not None and after < written:
+            first = max(first, after + 1)
+        if count is not None:
+            first = max(first, written - count)
+        records = []
+        for number in range(first, written):
+            offset = self._slots_start + number % self.slots * self._stride
+            sequence, slot_number, length = _SLOT.unpack_from(self._map, offset)
+            if sequence & 1 or slot_number != number or length > self.slot_size:
+                # Being written, or already overwritten by a newer record
+                continue
+            start = offset + _SLOT.size
+            body = self._map[start:start + length]
+            if _SLOT.unpack_from(self._map, offset)[0] != sequence:
+                continue
+            records.append((number, json.loads(body.decode("utf-8"))))
+        return records
+
+    def replaced(self):
+        """
+        :return: (boolean) True if the ring was removed, or started over in a new file, since
+            it was opened; a reader following it should open it again
+        """
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def close(self):
+        """
+        :return: None
+        """
+        self._map.close()
+
+
+class LiveStats(object):
+    """
+    The engine side: routes every record to the ring of its app_id. Set it as the live
+    attribute of the engine's StatQueue, see UDPTraffic.statqueue.
+
+    .. python::
+    Example Usage
+    udp.stat_queue.live = LiveStats("udp")
+    """
+
+    def __init__(self, kind, slots=SLOTS, slot_size=SLOT_SIZE):
+        """
+        Constructor
+        :param kind: (string) "udp" or "tcp", the model the records' app_id refers to
+        :param slots: (integer) Records each ring keeps
+        :param slot_size: (integer) Largest encoded record
+        :return: None
+        """
+        self.kind = kind
+        self.slots = slots
+        self.slot_size = slot_size
+        self.rings = {}
+        # Records lost to a failing ring, e.g. a full tmpfs
+        self.failures = 0
+
+    def put(self, record):
+        """
+        Write a record to its ring. Never raises: live stats must not stop the sender.
+        :param record: (dict) Stat record
+        :return: None
+        """
+        app_id = record.get("app_id")
+        if app_id in (None, ""):
+            return
+        try:
+            ring = self.rings.get(app_id)
+            if ring is None:
+                ring = self.rings[app_id] = LiveStatRing(ring_path(self.kind, app_id), True, self.slots,
+                                                         self.slot_size)
+            ring.put(record)
+        except (OSError, ValueError):
+            self.failures += 1
+
+    def close(self):
+        """
+        Unmap the rings, they stay for the readers.
+        :return: None
+        """
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+
+def read_ring(kind, app_id, after=None, count=None):
+    """
+    Open a row's ring, read it and close it again.
+    :param kind: (string) "udp" or "tcp"
+    :param app_id: (object) Id of the traffic row
+    :param after: (integer) Only records numbered after this one, see LiveStatRing.read()
+    :param count: (integer) At most this many, the latest
+    :return: (list) (number, record) oldest first, empty if the row has no ring (yet)
+    """
+    try:
+        ring = LiveStatRing(ring_path(kind, app_id))
+    except (FileNotFoundError, ValueError):
+        return []
+    try:
+        return ring.read(after, count)
+    finally:
+        ring.close()
@@ -0,0 +1,341 @@
+"""
+Multi-flow UDP traffic.
+
+A UDPTraffic drives one destination with its own sockets, reader thread and pacing loop, so
+an agent sending to 50 VIPs ran 50 Celery tasks with 50 pacers spinning side by side.
+MultiFlowUDPTraffic drives any number of flows from one task: one FlowScheduler paces all of
+them from the sender thread, one epoll reader hands every echo to its flow by the flow id in
+its header, and all flows send from one shared source port pool.
+
+Each flow is a UDPFlow, which keeps everything UDPTraffic does per destination: the flow id,
+sequence space, in-flight tracker, pacer, outage and reorder bookkeeping and its own stat
+records under its own app_id, so the controller gets the same records as from separate
+tasks. Flows can be added and removed while the engine runs. A removed flow stops sending at
+once and reports its last intervals when its echoes are in, like a stopped UDPTraffic.
+"""
+import time
+
+from UDPTraffic.udptraffic import UDPTraffic
+from UDPTraffic.pacer import TokenBucketPacer, FlowScheduler
+from UDPTraffic.tracker import InFlightTracker, ring_capacity
+from UDPTraffic.packet import PacketBuilder, parse_header, parse_payload_size
+from UDPTraffic.timestamps import CLOCK_KERNEL_TX, realtime_offset
+from UDPTraffic.rateprofile import RATE_STEP_NS, parse_profile
+
+
+class UDPFlow(UDPTraffic):
+    """
+    One destination of a MultiFlowUDPTraffic. It is never started on its own: the engine
+    attaches it to its sockets and drives it.
+    """
+
+    def __init__(self, destination_ip, destination_port, packet_rate, app_id, rate_profile=None,
+                 payload_size=None):
+        """
+        Constructor
+        :param destination_ip: (string) IP address to send traffic to (BIG-IP VIP)
+        :param destination_port: (integer) Port to send traffic to
+        :param packet_rate: (integer) Packets per second
+        :param app_id: (integer) Controller app id of the flow, also its flow id
+        :param rate_profile: (dict) Rate profile spec the flow follows instead of packet_rate
+        :param payload_size: (object) Payload size or size spec of the flow, None (or "") for the
+            engine's, see packet.parse_payload_size()
+        :return: None
+        """
+        super(UDPFlow, self).__init__(destination_ip, destination_port, packet_rate)
+        self.rate_profile = parse_profile(rate_profile)
+        self.payload_size = parse_payload_size(payload_size) if payload_size not in (None, "") else None
+        self.controller_app_id = app_id
+        self.flow_id = int(app_id)
+        self.destination = (destination_ip, destination_port)
+        # Monotonic ns time the flow stopped sending, None while it sends
+        self.stop_ns = None
+
+    def attach(self, engine, origin):
+        """
+        Take the engine's sockets and settings and reset the flow's bookkeeping, before its
+        first packet.
+        :param engine: (MultiFlowUDPTraffic) The engine driving the flow
+        :param origin: (integer) Monotonic ns time the engine's stat intervals are aligned to
+        :return: None
+        """
+        self.client_read_timeout = engine.client_read_timeout
+        self.stop_drain_idle = engine.stop_drain_idle
+        if self.payload_size is None:
+            self.payload_size = engine.payload_size
+        self.socket_pool = engine.socket_pool
+        self.clock_source = engine.clock_source
+        # Transmit stamps are counted per socket, whichever flow sent on it
+        self._tx_counts = engine._tx_counts
+        self._tx_expected = engine._tx_expected
+        self.stat_queue = engine.stat_queue
+        self.ship_histogram = engine.ship_histogram
+        self.interval_origin = origin
+        self.tracker = InFlightTracker(self.tracker_capacity or
+                                       ring_capacity(self._peak_rate(), self.client_read_timeout + 2))
+        self.packet_builder = PacketBuilder(self.flow_id, self.payload_size, engine.batch_size)
+        self.pacer = TokenBucketPacer(self.packet_rate, max(engine.pacing_burst, engine.batch_size))
+        self._reset_counters()
+        # The engine's reader serves every flow, its CPU time is not split between them
+        self.reader_cpu_ns = None
+        self._reset_intervals()
+        self.sending_client_data = True
+
+
+class MultiFlowUDPTraffic(UDPTraffic):
+    """
+    UDPTraffic to many destinations at once. Configure the shared settings (source ports,
+    batch_size, timestamping, ...) like UDPTraffic, then call start(), which blocks until
+    stop() is called from another thread. add_flow() and remove_flow() work before and
+    during the run.
+
+    .. python::
+    Example Usage
+    u = MultiFlowUDPTraffic([('10.1.1.125', 1234, 10000, 7), ('10.1.1.126', 1234, 500, 8)])
+    u.udp_port_range_start = 20000
+    u.udp_port_range_stop = 35000
+    threading.Thread(target=u.start).start()
+    u.add_flow('10.1.1.127', 1234, 1000, 9)
+    u.remove_flow(7)
+    u.stop()
+    (missing_packets, offline_time) = u.analyze_results()   # Outages of every flow
+    """
+    # Longest the sender waits before it picks up added and removed flows
+    CHANGE_POLL_NS = 10 ** 8
+
+    def __init__(self, flows=()):
+        """
+        Constructor
+        :param flows: (list) (destination_ip, destination_port, packet_rate, app_id[, rate_profile
+            [, payload_size]]) of the flows to start with
+        :return: None
+        """
+        super(MultiFlowUDPTraffic, self).__init__(None, None, 0)
+        # Flows sending, and removed flows still waiting for their last echoes, by flow id.
+        # Only the sender thread changes them, under self.lock.
+        self.flows = {}
+        self._retiring = {}
+        # Both of them, for the reader; replaced, never changed in place
+        self._receivers = {}
+        # Sending flows with a rate profile, whose pacers the sender retunes
+        self._profiled = []
+        # Changes asked for since the sender last looked
+        self._added = []
+        self._removed = []
+        for flow in flows:
+            self.add_flow(*flow)
+
+    def add_flow(self, destination_ip, destination_port, packet_rate, app_id, rate_profile=None,
+                 payload_size=None):
+        """
+        Add a flow. Thread safe; a running engine starts sending within CHANGE_POLL_NS.
+        :param destination_ip: (string) IP address to send traffic to (BIG-IP VIP)
+        :param destination_port: (integer) Port to send traffic to
+        :param packet_rate: (integer) Packets per second
+        :param app_id: (integer) Controller app id of the flow, also its flow id
+        :param rate_profile: (dict) Rate profile spec the flow follows instead of packet_rate
+        :param payload_size: (object) Payload size or size spec of the flow, None for the engine's
+        :return: (UDPFlow) The new flow
+        """
+        flow = UDPFlow(destination_ip, int(destination_port), int(packet_rate), app_id, rate_profile,
+                       payload_size)
+        with self.lock:
+            if self._stop_requested:
+                raise ValueError("Traffic is stopping")
+            if flow.flow_id in self.flows or flow.flow_id in self._retiring or \
+                    flow.flow_id in [added.flow_id for added in self._added]:
+                raise ValueError("Flow %d already exists" % flow.flow_id)
+            self._added.append(flow)
+        return flow
+
+    def remove_flow(self, app_id):
+        """
+        Stop a flow. Thread safe; its last stats are reported once its echoes are in.
+        :param app_id: (integer) Controller app id of the flow
+        :return: None
+        """
+        flow_id = int(app_id)
+        with self.lock:
+            for flow in self._added:
+                if flow.flow_id == flow_id:
+                    # Never started
+                    self._added.remove(flow)
+                    return
+            if flow_id not in self.flows or flow_id in self._removed:
+                raise ValueError("No flow %d" % flow_id)
+            self._removed.append(flow_id)
+
+    def _apply_changes(self, now):
+        """
+        Private method
+        Start the flows added and stop the flows removed since the last call.
+        :param now: (integer) Monotonic ns time
+        :return: None
+        """
+        with self.lock:
+            added, self._added = self._added, []
+            removed, self._removed = self._removed, []
+            for flow in added:
+                flow.attach(self, self._origin)
+                # No burst credit to start with: flows started together would send pacing_burst
+                # packets each at once, enough to overflow a receive buffer with 50 flows
+                flow.pacer.start_at(now)
+                self.flows[flow.flow_id] = flow
+                self.pacer.add(flow.flow_id, flow.pacer)
+                self.log.info("Flow %d added: %s:%d at %d pps" %
+                              (flow.flow_id, flow.destination_ip, flow.destination_port, flow.packet_rate))
+            for flow_id in removed:
+                flow = self.flows.pop(flow_id)
+                self.pacer.remove(flow_id)
+                flow.sending_client_data = False
+                flow.stop_ns = now
+                flow._end_sending(now)
+                self._retiring[flow_id] = flow
+                self.log.info("Flow %d removed after %d packets" % (flow_id, flow.sent_packets))
+            receivers = dict(self.flows)
+            receivers.update(self._retiring)
+            self._receivers = receivers
+            self._profiled = [flow for flow in self.flows.values() if flow.rate_profile is not None]
+
+    def _retire(self, now):
+        """
+        Private method
+        Report the last intervals of every removed flow whose echoes are in, and drop it.
+        :param now: (integer) Monotonic ns time
+        :return: None
+        """
+        done = [flow for flow in self._retiring.values() if not flow._draining(flow.stop_ns, now)]
+        if not done:
+            return
+        with self.lock:
+            for flow in done:
+                del self._retiring[flow.flow_id]
+            receivers = dict(self.flows)
+            receivers.update(self._retiring)
+            self._receivers = receivers
+        for flow in done:
+            self._flush_flow(flow, now)
+
+    def _flush_flow(self, flow, now):
+        """
+        Private method
+        Put the stat records of every interval of a flow not reported yet on stat_queue.
+        :param flow: (UDPFlow) A flow that stopped sending
+        :param now: (integer) Monotonic ns time
+        :return: None
+        """
+        flow._flush_intervals(now)
+        self.outages.extend(flow.outages)
+        self.sent_packets += flow.sent_packets
+        self.acked_packets += flow.acked_packets
+
+    def _send_client_traffic(self):
+        """
+        Private method
+        This is the thread which sends traffic for every flow. Each packet will be sent from
+        the next socket of the source port pool, whichever flow it belongs to.
+        :return: None
+        """
+        self.log.info("Starting multi-flow traffic thread")
+        self.pacer = FlowScheduler()
+        now = time.monotonic_ns()
+        self._origin = self.interval_origin if self.interval_origin is not None else now
+        self._next_interval = self._origin + ((now - self._origin) // 10 ** 9 + 1) * 10 ** 9
+        self._next_rate_update = now + RATE_STEP_NS
+        # The reader converts the kernel's receive stamps of every flow with the engine's offset
+        self._realtime_offset = realtime_offset()
+        self._apply_changes(now)
+        pool = self.socket_pool
+        while self.sending_client_data is True:
+            if self._added or self._removed:
+                self._apply_changes(time.monotonic_ns())
+            until = min(self._next_interval, time.monotonic_ns() + self.CHANGE_POLL_NS)
+            if self._profiled:
+                until = min(until, self._next_rate_update)
+            for flow_id, count in self.pacer.wait(until):
+                flow = self.flows[flow_id]
+                destination = flow.destination
+                if self.send_batch is None:
+                    for i in range(count):
+                        sock = pool.next_socket()
+                        packet = flow._next_packet()
+                        if self.clock_source == CLOCK_KERNEL_TX:
+                            flow._expect_tx_timestamp(sock)
+                        sock.sendto(packet, 0, destination)
+                else:
+                    for start in range(0, count, self.batch_size):
+                        packets = [flow._next_packet() for i in range(min(self.batch_size, count - start))]
+                        self.send_batch.send(pool.next_socket(), packets, destination)
+
+            now = time.monotonic_ns()
+            if self._profiled and now >= self._next_rate_update:
+                for flow in self._profiled:
+                    if flow._update_rate(now):
+                        self.pacer.reschedule(flow.flow_id)
+                self._next_rate_update = now + RATE_STEP_NS
+            if self._retiring:
+                self._retire(now)
+            if now >= self._next_interval:
+                # Every flow's intervals are aligned to the engine's
+                for flow in list(self.flows.values()) + list(self._retiring.values()):
+                    if now >= flow._next_interval:
+                        flow._close_interval(now)
+                self._next_interval = self._origin + ((now - self._origin) // 10 ** 9 + 1) * 10 ** 9
+                # Follow clock adjustments, as UDPTraffic._close_interval() does
+                self._realtime_offset = realtime_offset()
+
+    def _handle_reply(self, reply, now):
+        """
+        Private method
+        Hand an echo to its flow.
+        :param reply: (bytes) Echoed payload
+        :param now: (integer) Receive time in monotonic ns
+        :return: None
+        """
+        self.received_packets += 1
+        self._last_reply_ns = now
+        header = parse_header(reply)
+        flow = self._receivers.get(header[0]) if header is not None else None
+        if flow is None:
+            self.bad_packets += 1
+            return
+        flow._handle_reply(reply, now)
+
+    def _end_sending(self, stop_ns):
+        """
+        Private method
+        Stop counting target packets of every flow still sending.
+        :param stop_ns: (integer) Monotonic ns time the sender stopped
+        :return: None
+        """
+        for flow in list(self.flows.values()):
+            flow._end_sending(stop_ns)
+
+    def _draining(self, stop_ns, now):
+        """
+        Private method
+        :param stop_ns: (integer) Monotonic ns time the last packet was sent
+        :param now: (integer) Monotonic ns time
+        :return: (boolean) True while echoes of any flow may still come back
+        """
+        flows = list(self._receivers.values())
+        return any([flow._draining(flow.stop_ns or stop_ns, now) for flow in flows])
+
+    def _flush_intervals(self, now):
+        """
+        Private method
+        Put the stat records of every flow's intervals not reported yet on stat_queue.
+        :param now: (integer) Monotonic ns time sending stopped
+        :return: None
+        """
+        with self.lock:
+            flows = list(self.flows.values()) + list(self._retiring.values())
+            self.flows = {}
+            self._retiring = {}
+            self._profiled = []
+            self._added = []
+            self._removed = []
+        for flow in flows:
+            self._flush_flow(flow, now)
+        if self.bad_packets:
+            self.log.warning("%d echoes matched no flow" % self.bad_packets)
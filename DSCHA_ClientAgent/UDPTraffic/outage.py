@@ -0,0 +1,173 @@
+"""
+Outage detection.
+
+An outage is a run of consecutive lost packets: traffic stopped at the first of them and
+resumed with the next packet that was echoed again. GapDetector follows the packets as
+InFlightTracker.expire() settles them, in sequence order, and is only called when a gap
+opens or closes, so it costs nothing per packet and holds O(1) state for the open gap.
+Outages are timed by the send times of the packets around them, so the resolution is one
+packet gap (100 us at 10000 pps) instead of the one second stat interval.
+
+Outages closed during an interval ride along in that interval's stat record, and
+UDPTraffic.analyze_results() sums them up after the run.
+"""
+
+
+class Outage(object):
+    """
+    One run of lost packets.
+    start_seq: the first packet ID dropped
+    end_seq: the last packet ID dropped
+    last_timestamp: time the first missing packet was sent (seconds since the epoch)
+    resume_timestamp: time the first packet that came back again was sent, None if traffic
+        stopped before it resumed
+    offline_time: seconds without traffic
+    """
+
+    def __init__(self, start_seq, end_seq, last_timestamp, resume_timestamp, offline_time):
+        self.start_seq = start_seq
+        self.end_seq = end_seq
+        self.last_timestamp = last_timestamp
+        self.resume_timestamp = resume_timestamp
+        self.offline_time = offline_time
+
+    def __repr__(self):
+        return "Outage(%d-%d, %.6f s)" % (self.start_seq, self.end_seq, self.offline_time)
+
+    def to_dict(self):
+        """
+        :return: (dict) The outage as it goes into stat records
+        """
+        return {"start_seq": self.start_seq,
+                "end_seq": self.end_seq,
+                "last_timestamp": self.last_timestamp,
+                "resume_timestamp": self.resume_timestamp,
+                "offline_time": self.offline_time}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: (dict) Output of to_dict()
+        :return: (Outage) The outage
+        """
+        return cls(data["start_seq"], data["end_seq"], data["last_timestamp"], data["resume_timestamp"],
+                   data["offline_time"])
+
+
+def merge_outages(outages):
+    """
+    :param outages: (list) Outages, possibly overlapping (e.g. the same outage seen by several shards)
+    :return: (list) One Outage per time span covered by overlapping ones, oldest first; it
+        runs from the first to the last lost packet of the span and lasts the whole span
+    """
+    merged = []
+    end = None
+    for outage in sorted(outages, key=lambda outage: outage.last_timestamp):
+        stop = outage.last_timestamp + outage.offline_time
+        if end is None or outage.last_timestamp >= end:
+            merged.append(Outage(outage.start_seq, outage.end_seq, outage.last_timestamp,
+                                 outage.resume_timestamp, outage.offline_time))
+            end = stop
+        elif stop > end:
+            last = merged[-1]
+            last.end_seq = outage.end_seq
+            last.resume_timestamp = outage.resume_timestamp
+            last.offline_time = stop - last.last_timestamp
+            end = stop
+    return merged
+
+
+def offline_time(outages):
+    """
+    :param outages: (list) Outages, possibly overlapping (e.g. the same outage seen by several shards)
+    :return: (number) Seconds covered by at least one of them
+    """
+    return sum(outage.offline_time for outage in merge_outages(outages))
+
+
+class GapDetector(object):
+    """
+    .. python::
+    Example Usage
+    gaps = GapDetector(10 ** 9 // packet_rate, realtime_offset())
+    tracker.expire(first, stop, gaps=gaps)   # Opens and closes gaps
+    for outage in gaps.pop():
+        print(outage.start_seq, outage.end_seq, outage.offline_time)
+    """
+
+    def __init__(self, gap_ns, wall_offset_ns):
+        """
+        Constructor
+        :param gap_ns: (integer) Time between two packets, the resolution of the outage times
+        :param wall_offset_ns: (integer) Wall clock minus the monotonic clock of the send times
+        :return: None
+        """
+        self.gap_ns = gap_ns
+        self.wall_offset_ns = wall_offset_ns
+        self.is_open = False
+        # First and last lost packet of the open gap, and their send times
+        self.start_seq = None
+        self.start_ns = None
+        self.end_seq = None
+        self.end_ns = None
+        self._closed = []
+
+    def open(self, sequence, send_ns):
+        """
+        A packet was lost while traffic was flowing.
+        :param sequence: (integer) The lost packet
+        :param send_ns: (integer) Its monotonic ns send time
+        :return: None
+        """
+        self.is_open = True
+        self.start_seq = self.end_seq = sequence
+        self.start_ns = self.end_ns = send_ns
+
+    def extend(self, sequence, send_ns):
+        """
+        Move the end of the open gap, before a close() that may come much later.
+        :param sequence: (integer) Last lost packet so far
+        :param send_ns: (integer) Its monotonic ns send time
+        :return: None
+        """
+        self.end_seq = sequence
+        self.end_ns = send_ns
+
+    def close(self, end_seq, resume_ns):
+        """
+        A packet came back after the open gap.
+        :param end_seq: (integer) Last lost packet
+        :param resume_ns: (integer) Monotonic ns send time of the packet that came back
+        :return: None
+        """
+        self.end_seq = end_seq
+        self._closed.append(self._outage(resume_ns - self.start_ns, resume_ns))
+        self.is_open = False
+
+    def finish(self):
+        """
+        Traffic stopped, close the open gap without a resume time.
+        :return: None
+        """
+        if self.is_open:
+            self._closed.append(self._outage(self.end_ns - self.start_ns + self.gap_ns, None))
+            self.is_open = False
+
+    def _outage(self, duration_ns, resume_ns):
+        """
+        :param duration_ns: (integer) Length of the open gap
+        :param resume_ns: (integer) Monotonic ns resume time or None
+        :return: (Outage) The open gap
+        """
+        offset = self.wall_offset_ns
+        return Outage(self.start_seq, self.end_seq, (self.start_ns + offset) / 10 ** 9,
+                      (resume_ns + offset) / 10 ** 9 if resume_ns is not None else None,
+                      duration_ns / 10 ** 9)
+
+    def pop(self):
+        """
+        :return: (list) Outages closed since the last call, oldest first
+        """
+        closed = self._closed
+        self._closed = []
+        return closed
@@ -0,0 +1,303 @@
+"""
+Packet pacing.
+
+TokenBucketPacer spaces sends evenly at the configured rate instead of firing the whole
+second's worth of packets at the top of each second. It is a GCRA-style token bucket on
+the monotonic nanosecond clock: a send of n packets is allowed once the theoretical send
+time of the bucket, less the burst credit, has been reached. Waiting is hybrid: the pacer
+sleeps until shortly before the deadline and spins (yielding the GIL) for the rest, since
+time.sleep() alone overshoots by tens of microseconds. interrupt() ends a wait early, so a
+sender at a low rate still stops at once.
+
+FlowScheduler paces many flows from one thread: every flow keeps a TokenBucketPacer of its
+own, and the scheduler sleeps until the earliest of their send times, kept in a heap.
+"""
+import os
+import time
+import heapq
+import threading
+
+# sched_yield() gives up the CPU and the GIL for about a microsecond; time.sleep(0) is held
+# up by the timer slack (~50 us) and would cap the spin resolution.
+_yield = getattr(os, "sched_yield", lambda: time.sleep(0))
+# The last SPIN_NS of every wait are spun instead of slept
+SPIN_NS = 250000
+
+
+def sleep_until(deadline, interrupted, spin_ns=SPIN_NS):
+    """
+    Sleep until shortly before deadline, then spin until it is reached.
+    :param deadline: (number) Monotonic ns time to wake up at
+    :param interrupted: (threading.Event) Ends the wait early once set
+    :param spin_ns: (integer) Length of the busy-wait at the end
+    :return: (integer) Monotonic ns time at wake up
+    """
+    now = time.monotonic_ns()
+    remaining = deadline - now
+    if remaining > spin_ns:
+        if interrupted.wait((remaining - spin_ns) / 10 ** 9):
+            return now
+        now = time.monotonic_ns()
+    while now < deadline and not interrupted.is_set():
+        # Yield so the reader thread is not starved while spinning
+        _yield()
+        now = time.monotonic_ns()
+    return now
+
+
+class TokenBucketPacer(object):
+    """
+    .. python::
+    Example Usage
+    pacer = TokenBucketPacer(10000, burst=8)
+    while running:
+        if pacer.wait(1, time.monotonic_ns() + 10 ** 9):
+            sock.sendto(...)
+    print(pacer.pop_stats())
+    """
+
+    def __init__(self, rate, burst=1, spin_ns=SPIN_NS):
+        """
+        Constructor
+        :param rate: (number) Packets per second, 0 or less pauses sending
+        :param burst: (integer) Packets that may go out back to back after the sender fell behind
+        :param spin_ns: (integer) Length of the busy-wait at the end of each wait
+        :return: None
+        """
+        self.spin_ns = spin_ns
+        self.burst = max(int(burst), 1)
+        self.rate = 0
+        self.gap_ns = None
+        # Theoretical time at which the next packet is due
+        self._tat = time.monotonic_ns()
+        self._last_grant = None
+        self._last_count = 0
+        self._interrupted = threading.Event()
+        self.set_rate(rate)
+        self._reset_stats()
+
+    def set_rate(self, rate, now=None):
+        """
+        Change the packet rate. The wait for the next packet stretches or shrinks with the
+        gap, so a sender ramping up from a low rate is not held back by the old, long gap.
+        :param rate: (number) Packets per second, 0 or less pauses sending
+        :param now: (integer) Monotonic ns time of the change, None reads the clock
+        :return: None
+        """
+        gap_ns = 10 ** 9 / rate if rate > 0 else None
+        if gap_ns is not None and self.gap_ns is not None:
+            if now is None:
+                now = time.monotonic_ns()
+            if self._tat > now:
+                self._tat = now + (self._tat - now) * gap_ns / self.gap_ns
+        self.rate = rate
+        self.gap_ns = gap_ns
+
+    def start_at(self, start_ns):
+        """
+        Hold the first packet back until start_ns, without the burst credit a new pacer has.
+        :param start_ns: (integer) Monotonic ns time the first packet may go
+        :return: None
+        """
+        if self.gap_ns is not None:
+            self._tat = start_ns + (self.burst - 1) * self.gap_ns
+
+    def _reset_stats(self):
+        self._gaps = 0
+        self._gap_sum = 0.0
+        self._error_sum = 0.0
+        self._error_max = 0.0
+
+    def next_send_time(self):
+        """
+        :return: (number) Monotonic ns time at which the next send is allowed, None if paused
+        """
+        if self.gap_ns is None:
+            return None
+        return self._tat - (self.burst - 1) * self.gap_ns
+
+    def due(self, now):
+        """
+        Number of packets that may be sent at now without waiting, for callers that cannot
+        block in wait(), such as an event loop. Consume them with grant().
+        :param now: (integer) Monotonic ns time
+        :return: (integer) Packets due, at most burst
+        """
+        deadline = self.next_send_time()
+        if deadline is None or now < deadline:
+            return 0
+        return min(int((now - deadline) // self.gap_ns) + 1, self.burst)
+
+    def wait(self, count=1, until_ns=None):
+        """
+        Block until count packets may be sent and consume their tokens.
+        :param count: (integer) Number of packets to send at once
+        :param until_ns: (integer) Monotonic ns time after which to give up waiting
+        :return: (boolean) True if the packets may be sent now, False if until_ns was reached
+            first or the pacer was interrupted
+        """
+        deadline = self.next_send_time()
+        if deadline is None or (until_ns is not None and deadline > until_ns):
+            if until_ns is not None:
+                self._sleep_until(until_ns)
+            return False
+        now = self._sleep_until(deadline)
+        if self._interrupted.is_set():
+            return False
+        self.grant(count, now)
+        return True
+
+    def interrupt(self):
+        """
+        Make the current and every later wait() return False right away. Thread safe.
+        :return: None
+        """
+        self._interrupted.set()
+
+    def grant(self, count, now):
+        """
+        Consume tokens for count packets sent at now and record the achieved spacing.
+        :param count: (integer) Number of packets sent
+        :param now: (integer) Monotonic ns send time
+        :return: None
+        """
+        if self._last_grant is not None and self._last_count:
+            gap = (now - self._last_grant) / self._last_count
+            self._gaps += 1
+            self._gap_sum += gap
+            error = abs(gap - self.gap_ns)
+            self._error_sum += error
+            if error > self._error_max:
+                self._error_max = error
+        self._last_grant = now
+        self._last_count = count
+        # Idle time only earns credit up to the burst size, see next_send_time()
+        self._tat = max(self._tat, now) + count * self.gap_ns
+
+    def _sleep_until(self, deadline):
+        return sleep_until(deadline, self._interrupted, self.spin_ns)
+
+    def pop_stats(self):
+        """
+        Pacing accuracy since the previous call, in microseconds: the target inter-packet gap,
+        the mean achieved gap and the mean and maximum absolute difference between the two.
+        :return: (dict) Pacing statistics for the interval
+        """
+        stats = {"target_gap_us": -1,
+                 "achieved_gap_us": -1,
+                 "pacing_error_us": -1,
+                 "max_pacing_error_us": -1}
+        if self.gap_ns is not None:
+            stats["target_gap_us"] = self.gap_ns / 1000
+        if self._gaps:
+            stats["achieved_gap_us"] = self._gap_sum / self._gaps / 1000
+            stats["pacing_error_us"] = self._error_sum / self._gaps / 1000
+            stats["max_pacing_error_us"] = self._error_max / 1000
+        self._reset_stats()
+        return stats
+
+
+class FlowScheduler(object):
+    """
+    .. python::
+    Example Usage
+    scheduler = FlowScheduler()
+    scheduler.add(flow_id, TokenBucketPacer(10000, burst=8))
+    while running:
+        for flow_id, count in scheduler.wait(time.monotonic_ns() + 10 ** 9):
+            send(flow_id, count)
+    """
+
+    def __init__(self, spin_ns=SPIN_NS):
+        """
+        Constructor
+        :param spin_ns: (integer) Length of the busy-wait at the end of each wait
+        :return: None
+        """
+        self.spin_ns = spin_ns
+        self.pacers = {}
+        # (send time, serial, key, pacer) of every flow with a rate, plus stale entries left
+        # by remove() and rate changes, skipped when they come up
+        self._heap = []
+        self._serial = 0
+        self._interrupted = threading.Event()
+
+    def __len__(self):
+        return len(self.pacers)
+
+    def add(self, key, pacer):
+        """
+        Start pacing a flow, replacing any flow with the same key.
+        :param key: (object) Hashable flow key
+        :param pacer: (TokenBucketPacer) The flow's pacer
+        :return: None
+        """
+        self.pacers[key] = pacer
+        self._push(key, pacer)
+
+    def remove(self, key):
+        """
+        :param key: (object) Key of the flow to stop pacing
+        :return: (TokenBucketPacer) Its pacer, None if it was not paced
+        """
+        return self.pacers.pop(key, None)
+
+    def reschedule(self, key):
+        """
+        Pick up a change of the flow's rate, call after pacer.set_rate().
+        :param key: (object) Flow key
+        :return: None
+        """
+        pacer = self.pacers.get(key)
+        if pacer is not None:
+            self._push(key, pacer)
+
+    def interrupt(self):
+        """
+        Make the current and every later wait() return at once. Thread safe.
+        :return: None
+        """
+        self._interrupted.set()
+
+    def _push(self, key, pacer):
+        deadline = pacer.next_send_time()
+        if deadline is not None:
+            self._serial += 1
+            heapq.heappush(self._heap, (deadline, self._serial, key, pacer))
+
+    def _valid(self, entry):
+        deadline, serial, key, pacer = entry
+        return self.pacers.get(key) is pacer and pacer.next_send_time() == deadline
+
+    def wait(self, until_ns):
+        """
+        Block until at least one flow may send, and consume the tokens of every flow due.
+        :param until_ns: (integer) Monotonic ns time after which to give up waiting
+        :return: (list) (key, packets) of every flow due, empty if until_ns was reached first
+            or the scheduler was interrupted
+        """
+        heap = self._heap
+        while heap and not self._valid(heap[0]):
+            heapq.heappop(heap)
+        if not heap or heap[0][0] > until_ns:
+            sleep_until(until_ns, self._interrupted, self.spin_ns)
+            return []
+        now = sleep_until(heap[0][0], self._interrupted, self.spin_ns)
+        if self._interrupted.is_set():
+            return []
+        due = []
+        granted = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if not self._valid(entry):
+                continue
+            key, pacer = entry[2], entry[3]
+            count = pacer.due(now)
+            if count:
+                pacer.grant(count, now)
+                due.append((key, count))
+            granted.append((key, pacer))
+        # Pushed back afterwards, so a flow far behind is not served twice in one wait
+        for key, pacer in granted:
+            self._push(key, pacer)
+        return due
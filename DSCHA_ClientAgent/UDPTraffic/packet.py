@@ -0,0 +1,263 @@
+"""
+UDP traffic packet format.
+
+Every datagram starts with a fixed, versioned binary header:
+
+    magic      u16   0xDC5A
+    flow_id    u32   traffic flow the packet belongs to
+    sequence   u64   packet sequence number
+    send_ns    u64   sender's monotonic clock at send time, in ns
+    flags      u8    reserved, 0
+    version    u8    header version
+
+followed by zero padding up to the payload size. The echo carries the send time back, so the
+reader computes RTT from the payload alone.
+
+Payload sizes are fixed, uniform over a range or drawn from weighted sizes such as IMIX, see
+parse_payload_size(). PacketBuilder keeps preallocated zero padded buffers and packs each
+header into one in place, so a packet costs no allocation or copy however large it is.
+
+An echo server running with timestamps appends a trailer to the echoed payload:
+
+    rx_ns      u64   server clock when the packet arrived
+    tx_ns      u64   server clock when the echo left
+    magic      u16   0x5E7A
+
+The server clock is its monotonic clock shifted to wall-clock time (see server_clock_ns), so
+it neither jumps nor depends on NTP while the server runs.
+"""
+import time
+import json
+import random
+import struct
+from array import array
+
+from UDPTraffic.batchio import MAX_DATAGRAM
+
+MAGIC = 0xDC5A
+VERSION = 1
+HEADER = struct.Struct("!HIQQBB")
+TRAILER_MAGIC = 0x5E7A
+TRAILER = struct.Struct("!QQH")
+# Largest payload an echo can carry: receive buffers hold MAX_DATAGRAM bytes and the server
+# may append its timestamp trailer
+MAX_PAYLOAD = MAX_DATAGRAM - TRAILER.size
+# Simple IMIX: 64, 576 and 1500 byte IP packets 7:4:1, as UDP payload sizes (the IP packet
+# less 28 bytes of IPv4 and UDP header)
+IMIX = ((36, 7), (548, 4), (1472, 1))
+# Sizes drawn ahead of time for a varying payload size, cycled through by PacketBuilder
+SIZE_TABLE = 1024
+
+# Wall-clock time of the monotonic clock's zero, fixed when the module is loaded
+_WALL_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def server_clock_ns():
+    """
+    :return: (integer) The monotonic clock in ns since the epoch
+    """
+    return time.monotonic_ns() + _WALL_OFFSET_NS
+
+
+def _size(value, name="size"):
+    """
+    :param value: (integer) Payload size from a spec
+    :param name: (string) What the size is, for the error message
+    :return: (integer) The size, raised to the header size
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Payload %s must be a number of bytes" % name)
+    if size > MAX_PAYLOAD:
+        raise ValueError("Payload %s must be at most %d bytes" % (name, MAX_PAYLOAD))
+    return max(size, HEADER.size)
+
+
+class PayloadSizes(object):
+    """
+    Distribution of payload sizes: a weighted list of sizes, or a uniform range.
+
+    .. python::
+    Example Usage
+    sizes = parse_payload_size({"type": "uniform", "min": 64, "max": 1400})
+    print(sizes.minimum, sizes.maximum, sizes.table(8))
+    """
+
+    def __init__(self, spec, sizes=None, weights=None, uniform=None):
+        """
+        Constructor
+        :param spec: (object) The spec the sizes were parsed from
+        :param sizes: (list) Sizes in bytes, with weights
+        :param weights: (list) Relative frequency of each size, None for equal ones
+        :param uniform: (tuple) (min, max) sizes in bytes, instead of sizes
+        :return: None
+        """
+        self.spec = spec
+        self.sizes = sizes
+        self.weights = weights
+        self.uniform = uniform
+        if uniform is not None:
+            self.minimum, self.maximum = uniform
+        else:
+            self.minimum, self.maximum = min(sizes), max(sizes)
+
+    @property
+    def fixed(self):
+        return self.minimum == self.maximum
+
+    def table(self, count=SIZE_TABLE, seed=None):
+        """
+        :param count: (integer) Number of sizes
+        :param seed: (object) Seed of the draw, None for a random one
+        :return: (array) count sizes drawn from the distribution, one per packet
+        """
+        if self.fixed:
+            return array("H", [self.maximum])
+        rng = random.Random(seed)
+        if self.uniform is not None:
+            return array("H", [rng.randint(self.minimum, self.maximum) for i in range(count)])
+        return array("H", rng.choices(self.sizes, self.weights, k=count))
+
+
+def parse_payload_size(spec):
+    """
+    :param spec: (object) Payload size: a number of bytes (0 or None for just the header),
+        "imix", or a spec (or its JSON text) such as
+            {"type": "fixed", "size": 512}
+            {"type": "uniform", "min": 64, "max": 1400}
+            {"type": "weighted", "sizes": [[64, 7], [576, 4], [1472, 1]]}
+            {"type": "imix"}
+    :return: (PayloadSizes) The sizes
+    """
+    if isinstance(spec, PayloadSizes):
+        return spec
+    if spec is None or spec == "":
+        spec = 0
+    if isinstance(spec, str):
+        text = spec.strip()
+        if text.isdigit():
+            spec = int(text)
+        elif text.lower() == "imix":
+            spec = {"type": "imix"}
+        else:
+            try:
+                spec = json.loads(text)
+            except ValueError:
+                raise ValueError("Payload size must be a number of bytes, imix or a JSON spec")
+    if isinstance(spec, int):
+        return PayloadSizes(spec, [_size(spec)])
+    if not isinstance(spec, dict):
+        raise ValueError("Payload size must be a number of bytes, imix or a JSON spec")
+    kind = spec.get("type")
+    if kind == "fixed":
+        return PayloadSizes(spec, [_size(spec.get("size"))])
+    if kind == "uniform":
+        low, high = _size(spec.get("min"), "min"), _size(spec.get("max"), "max")
+        if low > high:
+            raise ValueError("Payload min must not be above max")
+        return PayloadSizes(spec, uniform=(low, high))
+    if kind in ("weighted", "imix"):
+        pairs = IMIX if kind == "imix" else spec.get("sizes")
+        try:
+            weights = [float(weight) for size, weight in pairs]
+            sizes = [size for size, weight in pairs]
+        except (TypeError, ValueError):
+            raise ValueError("Payload sizes must be [bytes, weight] pairs")
+        sizes = [_size(size) for size in sizes]
+        if not sizes or min(weights) < 0 or not sum(weights):
+            raise ValueError("Payload sizes need a positive weight")
+        return PayloadSizes(spec, sizes, weights)
+    raise ValueError("Payload size type must be one of fixed, uniform, weighted, imix")
+
+
+class PacketBuilder(object):
+    """
+    Builds the payloads of one flow, in place: build() packs the header into the next of
+    `buffers` preallocated, zero padded buffers and returns a memoryview of the packet. The
+    view is only valid until the builder comes back to its buffer, so every packet must be
+    sent (or copied) before `buffers` more are built.
+
+    .. python::
+    Example Usage
+    builder = PacketBuilder(flow_id=7, payload_size=64)
+    data = builder.build(1, time.monotonic_ns())
+    flow_id, sequence, send_ns = parse_header(data)
+    """
+
+    def __init__(self, flow_id=0, payload_size=0, buffers=1):
+        """
+        Constructor
+        :param flow_id: (integer) Flow id stamped into every packet
+        :param payload_size: (object) Payload size in bytes, raised to the header size, or a
+            size spec, see parse_payload_size()
+        :param buffers: (integer) Packets built before a buffer is reused, e.g. a batch
+        :return: None
+        """
+        self.flow_id = flow_id
+        self.sizes = parse_payload_size(payload_size)
+        # The largest payload built
+        self.payload_size = self.sizes.maximum
+        table = self.sizes.table()
+        count = 1
+        while count < buffers:
+            count *= 2
+        if len(table) > 1:
+            # Buffer i of the ring carries sizes i, i + count, ... of the table
+            count = min(count, len(table))
+        self._buffers = [bytearray(self.payload_size) for i in range(count)]
+        # One view per table entry, of the size it draws, on the buffer it falls on
+        self._views = [memoryview(self._buffers[i % count])[:table[i % len(table)]]
+                       for i in range(max(count, len(table)))]
+        self._next = 0
+        self._mask = len(self._views) - 1
+
+    def build(self, sequence, send_ns):
+        """
+        :param sequence: (integer) Packet sequence number
+        :param send_ns: (integer) Monotonic send time in ns
+        :return: (memoryview) The packet payload
+        """
+        view = self._views[self._next]
+        self._next = (self._next + 1) & self._mask
+        HEADER.pack_into(view, 0, MAGIC, self.flow_id, sequence, send_ns, 0, VERSION)
+        return view
+
+
+def append_timestamps(buf, length, rx_ns, tx_ns):
+    """
+    Append the server timestamp trailer to a received datagram, in place.
+    :param buf: (bytearray) Buffer holding the datagram, with TRAILER.size bytes to spare
+    :param length: (integer) Length of the datagram in buf
+    :param rx_ns: (integer) Server clock when the datagram arrived
+    :param tx_ns: (integer) Server clock when the echo is sent
+    :return: (integer) Length of the datagram with the trailer
+    """
+    TRAILER.pack_into(buf, length, rx_ns, tx_ns, TRAILER_MAGIC)
+    return length + TRAILER.size
+
+
+def parse_timestamps(data):
+    """
+    :param data: (bytes) Echoed payload
+    :return: (tuple) (rx_ns, tx_ns) from the server timestamp trailer, or None without one
+    """
+    if len(data) < HEADER.size + TRAILER.size:
+        return None
+    rx_ns, tx_ns, magic = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    if magic != TRAILER_MAGIC:
+        return None
+    return rx_ns, tx_ns
+
+
+def parse_header(data):
+    """
+    :param data: (bytes) Received payload
+    :return: (tuple) (flow_id, sequence, send_ns), or None for short, corrupted or foreign datagrams
+    """
+    if len(data) < HEADER.size:
+        return None
+    magic, flow_id, sequence, send_ns, flags, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return flow_id, sequence, send_ns
@@ -0,0 +1,234 @@
+"""
+Packet rate profiles.
+
+A rate profile makes the packet rate a function of the time since sending started, so one
+run can walk a VIP through a range of rates instead of a stop/patch/start cycle per rate.
+The engines ask the profile for the rate every RATE_STEP_NS and retune their pacer, and
+every stat record carries the interval's target rate (target_pps) next to the achieved one.
+
+Profiles are described by JSON specs, times in seconds since sending started:
+
+    {"type": "ramp", "start": 1000, "stop": 50000, "duration": 60}
+    {"type": "step", "start": 1000, "step": 1000, "every": 10, "stop": 20000}
+    {"type": "burst", "base": 1000, "peak": 20000, "period": 10, "length": 0.5}
+    {"type": "sine", "mean": 10000, "amplitude": 5000, "period": 30}
+    {"type": "points", "points": [[0, 1000], [10, 5000], [30, 5000]], "interpolate": true,
+     "repeat": false}
+
+A ramp, a step ladder (stop is optional) and a point list hold their last rate once they
+end, unless the points repeat. Point lists interpolate linearly between points by default,
+or hold each rate until the next point.
+"""
+import copy
+import json
+import math
+
+# How often the engines retune their pacer to the profile
+RATE_STEP_NS = 10 ** 7
+
+
+def _number(spec, key, default=None, positive=False, signed=False):
+    """
+    :param spec: (dict) Profile spec
+    :param key: (string) Key of the value
+    :param default: (number) Value when the key is missing, None if it is required
+    :param positive: (boolean) The value must be above 0, not just at least 0
+    :param signed: (boolean) The value may be below 0 too
+    :return: (float) The value
+    """
+    value = spec.get(key, default)
+    if value is None:
+        raise ValueError("Rate profile %s needs %s" % (spec.get("type"), key))
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Rate profile %s: %s must be a number" % (spec.get("type"), key))
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError("Rate profile %s: %s must be a finite number" % (spec.get("type"), key))
+    if not signed and (value < 0 or positive and value == 0):
+        raise ValueError("Rate profile %s: %s must be %s" %
+                         (spec.get("type"), key, "above 0" if positive else "at least 0"))
+    return value
+
+
+class RateProfile(object):
+    """
+    .. python::
+    Example Usage
+    profile = parse_profile({"type": "ramp", "start": 1000, "stop": 50000, "duration": 60})
+    pacer.set_rate(profile.rate(seconds_since_start))
+    """
+
+    def __init__(self, spec):
+        """
+        Constructor
+        :param spec: (dict) Profile spec, see the module docstring
+        :return: None
+        """
+        self.spec = spec
+        # Factor every rate is multiplied with, see scaled()
+        self.scale = 1.0
+
+    def rate(self, t):
+        """
+        :param t: (number) Seconds since sending started
+        :return: (float) Packets per second at t
+        """
+        return self.scale * self._rate(t)
+
+    def peak(self):
+        """
+        :return: (float) Highest rate of the profile
+        """
+        return self.scale * self._peak()
+
+    def scaled(self, factor):
+        """
+        :param factor: (number) Share of the rate, e.g. of one shard
+        :return: (RateProfile) A copy of the profile with every rate multiplied by factor
+        """
+        profile = copy.copy(self)
+        profile.scale = self.scale * factor
+        return profile
+
+    def _rate(self, t):
+        raise NotImplementedError
+
+    def _peak(self):
+        raise NotImplementedError
+
+
+class RampProfile(RateProfile):
+
+    def __init__(self, spec):
+        super(RampProfile, self).__init__(spec)
+        self.start = _number(spec, "start")
+        self.stop = _number(spec, "stop")
+        self.duration = _number(spec, "duration", positive=True)
+
+    def _rate(self, t):
+        if t >= self.duration:
+            return self.stop
+        return self.start + (self.stop - self.start) * max(t, 0) / self.duration
+
+    def _peak(self):
+        return max(self.start, self.stop)
+
+
+class StepProfile(RateProfile):
+
+    def __init__(self, spec):
+        super(StepProfile, self).__init__(spec)
+        self.start = _number(spec, "start")
+        self.step = _number(spec, "step", 0, signed=True)
+        self.every = _number(spec, "every", positive=True)
+        self.stop = _number(spec, "stop") if spec.get("stop") is not None else None
+        if self.stop is None and self.step > 0:
+            raise ValueError("Rate profile step: a rising ladder needs stop")
+
+    def _rate(self, t):
+        rate = self.start + self.step * (max(t, 0) // self.every)
+        if self.stop is not None:
+            rate = min(rate, self.stop) if self.step >= 0 else max(rate, self.stop)
+        return max(rate, 0.0)
+
+    def _peak(self):
+        if self.step > 0:
+            return self.stop
+        return self.start
+
+
+class BurstProfile(RateProfile):
+
+    def __init__(self, spec):
+        super(BurstProfile, self).__init__(spec)
+        self.base = _number(spec, "base")
+        self.peak_rate = _number(spec, "peak")
+        self.period = _number(spec, "period", positive=True)
+        self.length = _number(spec, "length", positive=True)
+
+    def _rate(self, t):
+        return self.peak_rate if max(t, 0) % self.period < self.length else self.base
+
+    def _peak(self):
+        return max(self.base, self.peak_rate)
+
+
+class SineProfile(RateProfile):
+
+    def __init__(self, spec):
+        super(SineProfile, self).__init__(spec)
+        self.mean = _number(spec, "mean")
+        self.amplitude = _number(spec, "amplitude")
+        self.period = _number(spec, "period", positive=True)
+
+    def _rate(self, t):
+        return max(self.mean + self.amplitude * math.sin(2 * math.pi * t / self.period), 0.0)
+
+    def _peak(self):
+        return self.mean + self.amplitude
+
+
+class PointsProfile(RateProfile):
+
+    def __init__(self, spec):
+        super(PointsProfile, self).__init__(spec)
+        points = spec.get("points")
+        if not points:
+            raise ValueError("Rate profile points needs points")
+        try:
+            self.points = sorted((_number({"time": time}, "time"), _number({"rate": rate}, "rate"))
+                                 for time, rate in points)
+        except (TypeError, ValueError):
+            raise ValueError("Rate profile points: points must be [seconds, rate] pairs")
+        self.interpolate = bool(spec.get("interpolate", True))
+        self.repeat = bool(spec.get("repeat", False))
+        if self.repeat and self.points[-1][0] <= 0:
+            raise ValueError("Rate profile points: repeating points must span some time")
+
+    def _rate(self, t):
+        points = self.points
+        if self.repeat:
+            t %= points[-1][0]
+        if t <= points[0][0]:
+            return points[0][1]
+        for i in range(1, len(points)):
+            if t < points[i][0]:
+                (t0, rate0), (t1, rate1) = points[i - 1], points[i]
+                if not self.interpolate:
+                    return rate0
+                return rate0 + (rate1 - rate0) * (t - t0) / (t1 - t0)
+        return points[-1][1]
+
+    def _peak(self):
+        return max(rate for time, rate in self.points)
+
+
+PROFILES = {"ramp": RampProfile,
+            "step": StepProfile,
+            "burst": BurstProfile,
+            "sine": SineProfile,
+            "points": PointsProfile}
+
+
+def parse_profile(spec):
+    """
+    :param spec: (dict) Profile spec, or its JSON text; None or "" for a constant rate
+    :return: (RateProfile) The profile, None for a constant rate
+    """
+    if spec is None or spec == "" or spec == {}:
+        return None
+    if isinstance(spec, RateProfile):
+        return spec
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except ValueError:
+            raise ValueError("Rate profile is not valid JSON")
+    if not isinstance(spec, dict):
+        raise ValueError("Rate profile must be a JSON object")
+    # Not looked up as it is: a list or object type would raise TypeError
+    kind = PROFILES.get(spec.get("type")) if isinstance(spec.get("type"), str) else None
+    if kind is None:
+        raise ValueError("Rate profile type must be one of %s" % ", ".join(sorted(PROFILES)))
+    return kind(spec)
@@ -0,0 +1,123 @@
+"""
+Reordering, duplicate and late echo accounting.
+
+The in-flight tracker only knows whether an echo matched a packet still waiting for one, so
+a duplicate and an echo that arrived after its packet expired (and was counted as lost) both
+looked like noise, and an echo overtaken by later ones looked like any other. ReorderWindow
+sorts every echo into one of them as it arrives. It keeps one bit per sequence number for the
+last `size` sequences behind the highest one echoed so far, in a ring indexed by sequence
+modulo size, so it costs a few integer operations per echo and its memory is fixed.
+
+Each echo ends up as exactly one of:
+  in order:  higher than any sequence echoed before
+  reordered: behind the highest sequence echoed, first echo of a packet still in flight;
+             its distance (how many sequences it was overtaken by) goes in a log2 histogram
+  duplicate: its bit is already set
+  late:      its packet already expired from the tracker, or it is too far behind to tell
+"""
+from array import array
+
+# Reorder distance buckets: bucket i counts distances in [2 ** i, 2 ** (i + 1)), the last
+# one everything from 2 ** (REORDER_BUCKETS - 1) up
+REORDER_BUCKETS = 16
+
+
+def distance_bucket(distance):
+    """
+    :param distance: (integer) Reorder distance, at least 1
+    :return: (integer) Index of the histogram bucket counting distance
+    """
+    return min(distance.bit_length() - 1, REORDER_BUCKETS - 1)
+
+
+class ReorderWindow(object):
+    """
+    Fed by the receive path only; pop_stats() may be called from another thread.
+
+    .. python::
+    Example Usage
+    window = ReorderWindow(tracker.capacity)
+    window.record(sequence, tracker.ack(sequence, latency_ns))   # Every echo
+    stats = window.pop_stats()                                    # Every interval
+    print(stats["reordered_packets"], stats["reorder_distance"])
+    """
+
+    def __init__(self, size):
+        """
+        Constructor
+        :param size: (integer) Sequences tracked behind the highest one, rounded up to a power
+            of two. At least the tracker's capacity, so anything older has expired anyway.
+        :return: None
+        """
+        bits = 8
+        while bits < size:
+            bits *= 2
+        self.size = bits
+        self.mask = bits - 1
+        self.bitmap = bytearray(bits // 8)
+        self.highest = None
+        # Echoes of each kind over the whole run
+        self.reordered = 0
+        self.duplicates = 0
+        self.late = 0
+        self.distances = array("Q", bytes(8 * REORDER_BUCKETS))
+        # Counter values at the last pop_stats()
+        self._marks = (0, 0, 0)
+        self._distance_marks = array("Q", self.distances)
+
+    def record(self, sequence, in_flight):
+        """
+        Account for one echo.
+        :param sequence: (integer) Echoed sequence number
+        :param in_flight: (boolean) The tracker took the echo, i.e. the packet was in flight
+            and not acked before
+        :return: None
+        """
+        bitmap = self.bitmap
+        mask = self.mask
+        highest = self.highest
+        if highest is None or sequence > highest:
+            if highest is None or sequence - highest >= self.size:
+                bitmap[:] = bytes(len(bitmap))
+            elif sequence - highest > 1:
+                # Sequences the window slides over were not echoed (yet)
+                for skipped in range(highest + 1, sequence):
+                    bit = skipped & mask
+                    bitmap[bit >> 3] &= ~(1 << (bit & 7))
+            bit = sequence & mask
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+            self.highest = sequence
+            if not in_flight:
+                # Only a packet evicted from an overfull tracker gets here
+                self.late += 1
+            return
+        distance = highest - sequence
+        if distance >= self.size:
+            self.late += 1
+            return
+        bit = sequence & mask
+        if bitmap[bit >> 3] & (1 << (bit & 7)):
+            self.duplicates += 1
+            return
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+        if not in_flight:
+            self.late += 1
+            return
+        self.reordered += 1
+        self.distances[distance_bucket(distance)] += 1
+
+    def pop_stats(self):
+        """
+        :return: (dict) Echoes reordered, duplicated and late since the last call, and the
+            reorder distance histogram as a list of REORDER_BUCKETS counts
+        """
+        counters = (self.reordered, self.duplicates, self.late)
+        reordered, duplicates, late = [counters[i] - self._marks[i] for i in range(3)]
+        self._marks = counters
+        distances = array("Q", self.distances)
+        histogram = [distances[i] - self._distance_marks[i] for i in range(REORDER_BUCKETS)]
+        self._distance_marks = distances
+        return {"reordered_packets": reordered,
+                "duplicate_packets": duplicates,
+                "late_packets": late,
+                "reorder_distance": histogram}
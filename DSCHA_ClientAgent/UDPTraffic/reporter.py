@@ -0,0 +1,274 @@
+"""
+Stat reporting to the harness controller.
+
+StatReporter posts batches of stat records over one pooled requests.Session, so the
+connection to the controller is kept alive between posts instead of being opened every
+5 seconds. Batches are sent as compact, gzip compressed JSON with connect and read
+timeouts, so a slow controller can no longer hang the reporting thread.
+
+When the controller cannot be reached (or answers with a 5xx, 408 or 429) the batch is
+written to a spool directory and the reporter backs off exponentially. Spooled batches are
+replayed oldest first before anything newer is sent, so the controller still sees records
+in order. The spool is bounded: once it holds spool_limit batches the oldest are dropped.
+Batches the controller rejects for good (any other 4xx) are logged and discarded.
+
+Spooled files are named by the time they were written, so a reporter restarted with the
+same spool directory picks up where the previous one left off.
+
+A reporter may also have a store, such as app.statstore.StatStore, that keeps every batch
+on the agent whether or not the controller takes it.
+"""
+import os
+import json
+import gzip
+import time
+import logging
+import requests
+
+# Content-Encoding the batches are sent with
+GZIP = "gzip"
+# Statuses after which the same batch is worth sending again later
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+SPOOL_SUFFIX = ".json.gz"
+
+
+class StatReporter(object):
+    """
+    .. python::
+    Example Usage
+    reporter = StatReporter("http://10.1.1.1:8000/api/v1/udptrafficstat/", "/tmp/udp_spool/1",
+                            store=StatStore("udp"))
+    reporter.post(data_list)   # Every report interval
+    reporter.close()
+    print(reporter.stats())
+    """
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (3.05, 10)
+    # Batches kept on disk while the controller is unreachable
+    SPOOL_LIMIT = 1000
+    BACKOFF_START = 1.0
+    BACKOFF_MAX = 60.0
+    # Spooled batches replayed per post() call, so a long outage does not stall one interval
+    REPLAY_BATCHES = 20
+
+    def __init__(self, url, spool_dir=None, spool_limit=SPOOL_LIMIT, timeout=TIMEOUT, compress=True,
+                 log=None, store=None):
+        """
+        Constructor
+        :param url: (string) Controller endpoint the batches are posted to
+        :param spool_dir: (string) Directory unsent batches are kept in, None to drop them
+        :param spool_limit: (integer) Most batches kept in spool_dir
+        :param timeout: (tuple) (connect, read) timeouts in seconds
+        :param compress: (boolean) Send batches gzip compressed
+        :param log: (logging.Logger) Logger, defaults to the udp_traffic.log logger
+        :param store: (object) Also given every batch with store.write(data_list), and closed
+            with store.close(); None keeps nothing on the agent
+        :return: None
+        """
+        self.url = url
+        self.spool_dir = spool_dir
+        self.spool_limit = spool_limit
+        self.timeout = timeout
+        self.compress = compress
+        self.log = log or logging.getLogger("udp_traffic.log")
+        self.store = store
+        self.session = requests.Session()
+        # One connection to the controller is all the reporter needs
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.backoff = 0
+        self._retry_at = 0
+        self._spool_serial = 0
+        # Requests made and body bytes sent, and batches spooled, replayed and dropped
+        self.requests = 0
+        self.bytes_sent = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        # Batches the store failed to keep
+        self.store_failures = 0
+        if self.spool_dir is not None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            pending = self._spool_files()
+            if pending:
+                self.log.info("%d unsent stat batches in %s" % (len(pending), self.spool_dir))
+
+    def post(self, data_list):
+        """
+        Send a batch of stat records, after any spooled batches. Never raises on network
+        errors: a batch that cannot be sent is spooled.
+        :param data_list: (list) Stat records
+        :return: (boolean) True if the batch reached the controller
+        """
+        body = None
+        if data_list:
+            self._store(data_list)
+            body = self._encode(data_list)
+        if time.monotonic() < self._retry_at:
+            # Still backing off, do not even try
+            if body is not None:
+                self._spool(body)
+            return False
+        if not self._replay():
+            if body is not None:
+                self._spool(body)
+            return False
+        if body is None:
+            return True
+        result = self._send(body)
+        if result is None:
+            self._spool(body)
+            return False
+        return result
+
+    def close(self):
+        """
+        Close the pooled connection and the store. Spooled batches stay on disk.
+        :return: None
+        """
+        self.session.close()
+        if self.store is not None:
+            try:
+                self.store.close()
+            except Exception:
+                self.log.exception("Closing the stat store failed")
+
+    def stats(self):
+        """
+        :return: (dict) Requests made, bytes sent, batches spooled, replayed, dropped and pending,
+            and batches the store failed to keep
+        """
+        return {"report_requests": self.requests,
+                "report_bytes": self.bytes_sent,
+                "report_spooled": self.spooled,
+                "report_replayed": self.replayed,
+                "report_dropped": self.dropped,
+                "report_pending": len(self._spool_files()),
+                "store_failures": self.store_failures}
+
+    def _store(self, data_list):
+        """
+        Private method
+        Keep a batch in the store. A failing store (e.g. a locked database) only costs it the
+        batch, the controller still gets it.
+        :param data_list: (list) Stat records
+        :return: None
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.write(data_list)
+        except Exception:
+            self.store_failures += 1
+            self.log.exception("Storing %d stat records failed" % len(data_list))
+
+    def _encode(self, data_list):
+        """
+        Private method
+        :param data_list: (list) Stat records
+        :return: (bytes) The request body, gzip compressed JSON
+        """
+        data = json.dumps({"data_list": data_list}, separators=(",", ":")).encode("utf-8")
+        # Level 6 gets nearly all of level 9's ratio on these records at a fraction of the CPU
+        return gzip.compress(data, 6)
+
+    def _send(self, body):
+        """
+        Private method
+        Post one encoded batch and update the backoff.
+        :param body: (bytes) Output of _encode()
+        :return: (boolean) True if delivered, False if the controller rejected it for good,
+            None if it should be sent again later
+        """
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            headers["Content-Encoding"] = GZIP
+        else:
+            body = gzip.decompress(body)
+        try:
+            self.requests += 1
+            self.bytes_sent += len(body)
+            r = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._fail("Post UDP traffic stats fail: %s" % e)
+            return None
+        if r.status_code == 415 and self.compress:
+            # The controller does not take compressed bodies, send this and every later batch plain
+            self.log.warning("Controller rejected gzip stat batches, sending them uncompressed")
+            self.compress = False
+            return self._send(body)
+        if r.status_code in RETRY_STATUSES:
+            self._fail("Post UDP traffic stats fail: HTTP %d" % r.status_code)
+            return None
+        self.backoff = 0
+        self._retry_at = 0
+        if r.status_code >= 400:
+            self.dropped += 1
+            self.log.error("Controller rejected UDP traffic stats: HTTP %d %s" % (r.status_code, r.text[:200]))
+            return False
+        return True
+
+    def _fail(self, message):
+        """
+        Private method
+        Log a failed post and back off exponentially.
+        :param message: (string) Error to log
+        :return: None
+        """
+        self.backoff = min(self.backoff * 2, self.BACKOFF_MAX) if self.backoff else self.BACKOFF_START
+        self._retry_at = time.monotonic() + self.backoff
+        self.log.error("%s, retrying in %.1f s" % (message, self.backoff))
+
+    def _spool_files(self):
+        """
+        Private method
+        :return: (list) Spooled batch file names, oldest first
+        """
+        if self.spool_dir is None:
+            return []
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(SPOOL_SUFFIX))
+
+    def _spool(self, body):
+        """
+        Private method
+        Keep a batch on disk until the controller is back, dropping the oldest ones beyond
+        spool_limit.
+        :param body: (bytes) Output of _encode()
+        :return: None
+        """
+        if self.spool_dir is None:
+            self.dropped += 1
+            return
+        # Nanosecond wall time plus a serial keeps names unique and sorting in write order
+        self._spool_serial += 1
+        name = "%020d-%06d%s" % (time.time_ns(), self._spool_serial % 10 ** 6, SPOOL_SUFFIX)
+        path = os.path.join(self.spool_dir, name)
+        # Write then rename, so a replay never reads half a batch
+        with open(path + ".tmp", "wb") as spool_file:
+            spool_file.write(body)
+        os.rename(path + ".tmp", path)
+        self.spooled += 1
+        pending = self._spool_files()
+        if len(pending) > self.spool_limit:
+            for name in pending[:len(pending) - self.spool_limit]:
+                os.remove(os.path.join(self.spool_dir, name))
+                self.dropped += 1
+            self.log.warning("Stat spool full, dropped %d oldest batches" % (len(pending) - self.spool_limit))
+
+    def _replay(self):
+        """
+        Private method
+        Send spooled batches oldest first, up to REPLAY_BATCHES of them.
+        :return: (boolean) True if the spool was emptied, False if some are still waiting
+        """
+        pending = self._spool_files()
+        for name in pending[:self.REPLAY_BATCHES]:
+            path = os.path.join(self.spool_dir, name)
+            with open(path, "rb") as spool_file:
+                body = spool_file.read()
+            if self._send(body) is None:
+                return False
+            os.remove(path)
+            self.replayed += 1
+        return len(pending) <= self.REPLAY_BATCHES
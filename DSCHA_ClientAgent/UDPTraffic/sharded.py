@@ -0,0 +1,318 @@
+"""
+Multi-process sharded UDP traffic.
+
+One UDPTraffic runs its sender, epoll reader and stats bookkeeping in one process under the
+GIL, so a single traffic row tops out at what one core can do. ShardedUDPTraffic splits
+packet_rate, the source port range and the sequence space across N worker processes, each
+running a full UDPTraffic of its own, and merges their per-second stats into the single
+record that goes to stat_queue and the controller.
+"""
+import time
+import queue
+import threading
+import multiprocessing
+
+from UDPTraffic.udptraffic import UDPTraffic
+from UDPTraffic.histogram import LatencyHistogram
+from UDPTraffic.statqueue import SharedStatRing
+from UDPTraffic.outage import Outage, merge_outages
+from UDPTraffic.reorder import REORDER_BUCKETS
+
+
+def split_range(start, stop, parts):
+    """
+    Split [start, stop) into parts contiguous, near-equal sub ranges.
+    :param start: (integer) First value
+    :param stop: (integer) End of the range (exclusive)
+    :param parts: (integer) Number of sub ranges
+    :return: (list) [(start, stop), ...] sub ranges
+    """
+    size, extra = divmod(stop - start, parts)
+    ranges = []
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def merge_stats(records, ship_histogram=False):
+    """
+    Merge the stat records several shards produced for the same interval.
+    :param records: (list) Stat dicts for one interval, with their latency_histogram (a
+        LatencyHistogram or its compact form)
+    :param ship_histogram: (boolean) Keep the merged latency_histogram in the result
+    :return: (dict) One stat dict for the whole traffic row
+    """
+    sources = set(record["clock_source"] for record in records)
+    merged = {"app_id": records[0]["app_id"],
+              "clock_source": sources.pop() if len(sources) == 1 else "mixed",
+              "byte_sent": 0,
+              "packets_sent": 0,
+              "packets_receive": 0,
+              "drop_packets": 0,
+              "avg_latency": -1,
+              "pkt_time": max(record["pkt_time"] for record in records),
+              "achieved_pps": 0,
+              "target_pps": 0,
+              "bad_packets": 0,
+              "wire_byte_sent": 0,
+              "byte_receive": 0,
+              "wire_byte_receive": 0,
+              "bps_sent": 0,
+              "wire_bps_sent": 0,
+              "bps_receive": 0,
+              "wire_bps_receive": 0,
+              "server_samples": 0,
+              "outage_count": 0,
+              "offline_time": 0,
+              "outages": [],
+              "reordered_packets": 0,
+              "duplicate_packets": 0,
+              "late_packets": 0,
+              "reorder_distance": [0] * REORDER_BUCKETS,
+              "forward_latency": -1,
+              "return_latency": -1,
+              "server_dwell": -1,
+              "clock_offset": None,
+              "target_gap_us": -1,
+              "achieved_gap_us": -1,
+              "pacing_error_us": -1,
+              "max_pacing_error_us": -1}
+    latency = 0.0
+    target_rate = 0.0
+    paced = 0
+    pacing_error = 0.0
+    for record in records:
+        for key in ("byte_sent", "packets_sent", "packets_receive", "drop_packets", "achieved_pps",
+                    "target_pps", "bad_packets", "wire_byte_sent", "byte_receive", "wire_byte_receive", "bps_sent",
+                    "wire_bps_sent", "bps_receive", "wire_bps_receive", "server_samples", "reordered_packets",
+                    "duplicate_packets", "late_packets"):
+            merged[key] += record[key]
+        # Shards have their own sequence ranges, so reordering is per shard and adds up
+        merged["reorder_distance"] = [merged["reorder_distance"][i] + record["reorder_distance"][i]
+                                      for i in range(REORDER_BUCKETS)]
+        if record["avg_latency"] >= 0:
+            latency += record["avg_latency"] * record["packets_receive"]
+        if record["target_gap_us"] > 0:
+            target_rate += 10 ** 6 / record["target_gap_us"]
+        if record["pacing_error_us"] >= 0:
+            paced += record["packets_sent"]
+            pacing_error += record["pacing_error_us"] * record["packets_sent"]
+            merged["max_pacing_error_us"] = max(merged["max_pacing_error_us"],
+                                                record["max_pacing_error_us"])
+    # A link outage hits every shard: outages overlapping in time are one outage of the row
+    outages = merge_outages([Outage.from_dict(outage) for record in records for outage in record["outages"]])
+    merged["outages"] = [outage.to_dict() for outage in outages]
+    merged["outage_count"] = len(outages)
+    merged["offline_time"] = sum(outage.offline_time for outage in outages)
+    if merged["packets_receive"]:
+        merged["avg_latency"] = latency / merged["packets_receive"]
+    # Every shard estimates the offset to the same server from the same monotonic clock
+    offsets = [record["clock_offset"] for record in records if record["clock_offset"] is not None]
+    if offsets:
+        merged["clock_offset"] = sum(offsets) / len(offsets)
+    if merged["server_samples"]:
+        for key in ("forward_latency", "return_latency", "server_dwell"):
+            merged[key] = sum(record[key] * record["server_samples"] for record in records
+                              if record["server_samples"]) / merged["server_samples"]
+    # Gaps of the combined stream, as if one sender produced all shards' packets
+    if target_rate:
+        merged["target_gap_us"] = 10 ** 6 / target_rate
+    if merged["achieved_pps"]:
+        merged["achieved_gap_us"] = 10 ** 6 / merged["achieved_pps"]
+    if paced:
+        merged["pacing_error_us"] = pacing_error / paced
+    # Percentiles do not average, they come from the shards' histograms added together
+    histogram = LatencyHistogram()
+    for record in records:
+        shard_histogram = record["latency_histogram"]
+        if not isinstance(shard_histogram, LatencyHistogram):
+            shard_histogram = LatencyHistogram.from_compact(shard_histogram)
+        histogram.merge(shard_histogram)
+    merged.update(histogram.stats())
+    if ship_histogram:
+        merged["latency_histogram"] = histogram.to_compact()
+    return merged
+
+
+def _run_shard(settings, stat_queue, stop_event):
+    """
+    Process target: run one shard until stop_event is set.
+    :param settings: (dict) UDPTraffic attributes for this shard
+    :param stat_queue: (SharedStatRing) Ring the shard's stat records go to
+    :param stop_event: (multiprocessing.Event) Set by the parent to stop the shard
+    :return: None
+    """
+    engine = settings.pop("engine")
+    udp = engine(settings.pop("destination_ip"), settings.pop("destination_port"),
+                 settings.pop("packet_rate"))
+    for name, value in settings.items():
+        setattr(udp, name, value)
+    udp.stat_queue = stat_queue
+    udp.report_stats = False
+    udp.ship_histogram = True
+
+    def wait_for_stop():
+        stop_event.wait()
+        udp.stop()
+
+    stopper = threading.Thread(target=wait_for_stop)
+    stopper.daemon = True
+    stopper.start()
+    udp.start()
+    stopper.join()
+
+
+class ShardedUDPTraffic(UDPTraffic):
+    """
+    UDPTraffic spread over several processes. Configure it like UDPTraffic, then call start().
+
+    .. python::
+    Example Usage
+    u = ShardedUDPTraffic('10.1.1.125', 1234, 200000, shards=4)
+    u.udp_port_range_start = 20000
+    u.udp_port_range_stop = 35000
+    u.start()
+    """
+    # Seconds to wait for a late shard before its interval is merged without it
+    MERGE_TIMEOUT = 2
+
+    def __init__(self, destination_ip, destination_port, packet_rate, shards=2, engine=UDPTraffic):
+        """
+        Constructor
+        :param destination_ip: (string) IP address to send traffic to (BIG-IP VIP)
+        :param destination_port: (integer) Port to send traffic to
+        :param packet_rate: (integer) Packets per second across all shards
+        :param shards: (integer) Number of sender processes
+        :param engine: (class) UDPTraffic or AsyncUDPTraffic, the engine each shard runs
+        :return: None
+        """
+        super(ShardedUDPTraffic, self).__init__(destination_ip, destination_port, packet_rate)
+        self.shards = shards
+        self.engine = engine
+        self.processes = []
+        self.shard_queue = None
+        self.stop_event = None
+
+    def _shard_settings(self):
+        """
+        :return: (list) Per-shard UDPTraffic attributes
+        """
+        rates = split_range(0, self.packet_rate, self.shards)
+        ports = split_range(self.udp_port_range_start, self.udp_port_range_stop, self.shards)
+        sequences = split_range(1, self.MAX_SEQUENCE + 1, self.shards)
+        # Give the shards a moment to start so their first intervals line up
+        origin = time.monotonic_ns() + 10 ** 8
+        settings = []
+        for i in range(self.shards):
+            rate = rates[i][1] - rates[i][0]
+            # Each shard follows its share of the profile
+            profile = None
+            if self.rate_profile is not None:
+                profile = self.rate_profile.scaled(rate / self.packet_rate if self.packet_rate
+                                                   else 1 / self.shards)
+            settings.append({"engine": self.engine,
+                             "destination_ip": self.destination_ip,
+                             "destination_port": self.destination_port,
+                             "packet_rate": rate,
+                             "rate_profile": profile,
+                             "udp_port_range_start": ports[i][0],
+                             "udp_port_range_stop": ports[i][1],
+                             "sequence_start": sequences[i][0],
+                             "sequence_stop": sequences[i][1] - 1,
+                             "interval_origin": origin,
+                             "client_read_timeout": self.client_read_timeout,
+                             "controller_app_id": self.controller_app_id,
+                             "flow_id": self.flow_id,
+                             "payload_size": self.payload_size,
+                             "batch_size": self.batch_size,
+                             "pacing_burst": self.pacing_burst,
+                             "timestamping": self.timestamping})
+        return settings
+
+    def start(self):
+        """
+        Start every shard and merge their stats until stop() is called and the shards' last
+        stats are merged.
+        :return: None
+        """
+        self._stopped.clear()
+        if self._stop_requested:
+            # stop() came first
+            self._stopped.set()
+            return
+        self._flushed.clear()
+        self.outages = []
+        self.sending_client_data = True
+        self.shard_queue = SharedStatRing()
+        self.stop_event = multiprocessing.Event()
+        if self._stop_requested:
+            self.stop_event.set()
+        self.processes = []
+        for i, settings in enumerate(self._shard_settings()):
+            self.log.info("Starting shard %d: %d pps, source ports %d-%d" %
+                          (i, settings["packet_rate"], settings["udp_port_range_start"],
+                           settings["udp_port_range_stop"]))
+            process = multiprocessing.Process(target=_run_shard,
+                                              args=(settings, self.shard_queue, self.stop_event))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        if self.report_stats:
+            self.report_stat_thread = threading.Thread(target=self._report_stat)
+            self.report_stat_thread.start()
+        try:
+            self._merge_shard_stats()
+        finally:
+            self._finish_reporting()
+            self._stopped.set()
+
+    def stop(self):
+        """
+        Stop every shard and wait for their last stats.
+        :return: None
+        """
+        self._stop_requested = True
+        if self.stop_event is not None:
+            self.stop_event.set()
+        for process in self.processes:
+            process.join(self.client_read_timeout + 5)
+        self.sending_client_data = False
+        self._stopped.wait(self.MERGE_TIMEOUT + 1)
+
+    def _merge_shard_stats(self):
+        """
+        Private method
+        Group shard stat records by interval and put one merged record per interval on
+        stat_queue, as soon as every shard reported or MERGE_TIMEOUT has passed.
+        :return: None
+        """
+        pending = {}
+        first_seen = {}
+        while True:
+            try:
+                # Once the shards are gone, only what they left in the ring is still to come
+                record = self.shard_queue.get(timeout=0.1 if self.sending_client_data else 0)
+            except queue.Empty:
+                record = None
+                if not self.sending_client_data and not pending:
+                    break
+            if record is not None:
+                interval = record.pop("interval")
+                pending.setdefault(interval, []).append(record)
+                first_seen.setdefault(interval, time.monotonic())
+
+            now = time.monotonic()
+            for interval in sorted(pending):
+                if len(pending[interval]) >= self.shards or not self.sending_client_data \
+                        or now - first_seen[interval] > self.MERGE_TIMEOUT:
+                    records = pending.pop(interval)
+                    del first_seen[interval]
+                    stat = merge_stats(records, self.ship_histogram)
+                    self.log.info("Interval %d: %d/%d shards, %d packets sent, %d dropped" %
+                                  (interval, len(records), self.shards, stat["packets_sent"],
+                                   stat["drop_packets"]))
+                    self.outages.extend(Outage.from_dict(outage) for outage in stat["outages"])
+                    self.stat_queue.put(stat)
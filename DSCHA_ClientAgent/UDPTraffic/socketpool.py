@@ -0,0 +1,167 @@
+"""
+Pre-bound UDP source socket pool.
+
+Binding a fresh socket for every packet costs socket(), setsockopt(), bind(), an epoll
+registration and a close() per datagram, and keeps one fd alive per in-flight packet.
+The pool binds every source port of the configured range once, keeps the sockets
+registered with epoll for the whole run and hands them out round-robin, so consecutive
+packets still leave from different source ports (and spread across TMMs) for the cost
+of a single sendto().
+"""
+import os
+import errno
+import select
+import socket
+import logging
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def raise_fd_limit():
+    """
+    Raise the soft RLIMIT_NOFILE to the hard limit so a full port range can be bound.
+    :return: (integer) The soft fd limit now in effect, or None if it is unknown
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+
+def open_fd_count():
+    """
+    :return: (integer) Number of fds currently open in this process, or None if unknown
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class UDPSocketPool(object):
+    """
+    A set of UDP sockets, one per source port in [port_start, port_stop), reused round-robin.
+
+    .. python::
+    Example Usage
+    pool = UDPSocketPool(20000, 35000, epoll_obj)
+    pool.open()
+    sock = pool.next_socket()
+    sock.sendto(b"1", ("10.1.1.125", 1234))
+    pool.close()
+    """
+    # fds left free for the epoll object, log files, HTTP sessions and celery plumbing
+    FD_RESERVE = 64
+
+    def __init__(self, port_start, port_stop, epoll_obj=None, bind_ip="0.0.0.0"):
+        """
+        Constructor
+        :param port_start: (integer) First source port of the range
+        :param port_stop: (integer) End of the source port range (exclusive)
+        :param epoll_obj: (select.epoll) Optional epoll object the sockets are registered with
+        :param bind_ip: (string) Local address to bind the sockets to
+        :return: None
+        """
+        self.port_start = port_start
+        self.port_stop = port_stop
+        self.epoll_obj = epoll_obj
+        self.bind_ip = bind_ip
+        self.sockets = []
+        # fd -> socket, used by the reader to map epoll events back to sockets
+        self.connections = {}
+        self.skipped_ports = 0
+        self.fd_limit = None
+        self._index = 0
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def open(self):
+        """
+        Bind one socket per source port. Ports already in use are skipped. If the fd limit
+        cannot cover the whole range the pool is truncated and a warning is logged.
+        :return: None
+        """
+        self.fd_limit = raise_fd_limit()
+        budget = self.port_stop - self.port_start
+        if self.fd_limit is not None:
+            in_use = open_fd_count() or 0
+            budget = min(budget, self.fd_limit - in_use - self.FD_RESERVE)
+            if budget < self.port_stop - self.port_start:
+                logger.warning("fd limit %d only allows %d of %d source ports" %
+                               (self.fd_limit, max(budget, 0), self.port_stop - self.port_start))
+
+        for port in range(self.port_start, self.port_stop):
+            if len(self.sockets) >= budget:
+                break
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((self.bind_ip, port))
+            except socket.error as err:
+                sock.close()
+                # IP/port combo currently in use, skip it.
+                if err.errno == errno.EADDRINUSE:
+                    self.skipped_ports += 1
+                    continue
+                self.close()
+                raise
+            self.sockets.append(sock)
+            self.connections[sock.fileno()] = sock
+            if self.epoll_obj is not None:
+                self.epoll_obj.register(sock.fileno(), select.EPOLLIN)
+
+        if not self.sockets:
+            raise OSError(errno.EADDRINUSE, "No usable source port in %d-%d" %
+                          (self.port_start, self.port_stop))
+        if self.skipped_ports:
+            logger.warning("%d source ports in use - skipped" % self.skipped_ports)
+        self._index = 0
+
+    def next_socket(self):
+        """
+        :return: (socket) The next socket in round-robin order
+        """
+        sock = self.sockets[self._index]
+        self._index += 1
+        if self._index == len(self.sockets):
+            self._index = 0
+        return sock
+
+    def fd_usage(self):
+        """
+        :return: (dict) Pool size, fds open in the process and the process fd limit
+        """
+        return {"pool_sockets": len(self.sockets),
+                "open_fds": open_fd_count(),
+                "fd_limit": self.fd_limit}
+
+    def close(self):
+        """
+        Unregister and close every socket in the pool.
+        :return: None
+        """
+        for sock in self.sockets:
+            if self.epoll_obj is not None:
+                try:
+                    self.epoll_obj.unregister(sock.fileno())
+                except (OSError, ValueError):
+                    # epoll object already closed
+                    pass
+            sock.close()
+        self.sockets = []
+        self.connections.clear()
@@ -0,0 +1,325 @@
+"""
+Stat record handoff.
+
+The sender loop puts one stat record per interval and a reporting thread (or the shard
+merger) takes them off. multiprocessing.Queue did this by pickling every record through a
+pipe from a feeder thread, even when both ends live in the same process, and its empty()
+is only a hint.
+
+StatQueue is for the same-process case: a bounded deque plus an event, no pickling and no
+extra thread. It can also copy every record to the live stat rings dashboards read, see
+UDPTraffic.livestats. SharedStatRing is for shard processes reporting to their parent: records are
+packed into fixed-size binary slots of a shared memory ring, the latency histogram as its
+raw bucket counts, so nothing is pickled or compressed on the way either.
+"""
+import math
+import time
+import queue
+import struct
+import threading
+import collections
+import multiprocessing
+from array import array
+
+from UDPTraffic.histogram import LatencyHistogram
+from UDPTraffic.reorder import REORDER_BUCKETS
+
+
+class StatQueue(object):
+    """
+    Bounded queue of stat records between threads of one process. When full, the oldest
+    record is dropped to make room.
+
+    .. python::
+    Example Usage
+    stat_queue = StatQueue()
+    stat_queue.put(record)         # Sender thread
+    records = stat_queue.drain()   # Reporting thread
+    """
+    # Records kept when nobody takes them, an hour of one second intervals
+    MAXLEN = 3600
+    # put() keeps a reference, the record must not be changed afterwards
+    copies_records = False
+
+    def __init__(self, maxlen=MAXLEN):
+        """
+        Constructor
+        :param maxlen: (integer) Most records held
+        :return: None
+        """
+        self._records = collections.deque(maxlen=maxlen)
+        self._ready = threading.Event()
+        self.dropped = 0
+        # Also gets every record put, e.g. UDPTraffic.livestats.LiveStats
+        self.live = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def put(self, record):
+        """
+        :param record: (dict) Stat record
+        :return: None
+        """
+        if len(self._records) == self._records.maxlen:
+            self.dropped += 1
+        self._records.append(record)
+        self._ready.set()
+        if self.live is not None:
+            self.live.put(record)
+
+    def get(self, timeout=None):
+        """
+        Take the oldest record, waiting for one if the queue is empty.
+        :param timeout: (number) Seconds to wait, None waits forever
+        :return: (dict) Stat record
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                return self._records.popleft()
+            except IndexError:
+                pass
+            self._ready.clear()
+            # A put() between popleft() and clear() would otherwise go unnoticed
+            if self._records:
+                continue
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0 or not self._ready.wait(remaining):
+                raise queue.Empty
+
+    def drain(self):
+        """
+        :return: (list) Every record queued so far, oldest first
+        """
+        records = []
+        while True:
+            try:
+                records.append(self._records.popleft())
+            except IndexError:
+                return records
+
+    def empty(self):
+        """
+        :return: (boolean) True if no record is queued
+        """
+        return not self._records
+
+
+# Layout of a SharedStatRing record, as (key, struct format). None is stored as NaN in "d"
+# fields and as INT64_MIN in "q" fields; strings are NUL padded.
+RECORD_FIELDS = (("interval", "q"),
+                 ("app_id", "q"),
+                 ("pkt_time", "32s"),
+                 ("clock_source", "16s"),
+                 ("byte_sent", "q"),
+                 ("packets_sent", "q"),
+                 ("packets_receive", "q"),
+                 ("drop_packets", "q"),
+                 ("avg_latency", "d"),
+                 ("latency_p50", "d"),
+                 ("latency_p90", "d"),
+                 ("latency_p99", "d"),
+                 ("latency_p999", "d"),
+                 ("latency_max", "d"),
+                 ("target_gap_us", "d"),
+                 ("achieved_gap_us", "d"),
+                 ("pacing_error_us", "d"),
+                 ("max_pacing_error_us", "d"),
+                 ("achieved_pps", "d"),
+                 ("target_pps", "d"),
+                 ("bad_packets", "q"),
+                 ("reader_cpu_per_packet_us", "d"),
+                 ("wire_byte_sent", "q"),
+                 ("byte_receive", "q"),
+                 ("wire_byte_receive", "q"),
+                 ("bps_sent", "d"),
+                 ("wire_bps_sent", "d"),
+                 ("bps_receive", "d"),
+                 ("wire_bps_receive", "d"),
+                 ("server_samples", "q"),
+                 ("forward_latency", "d"),
+                 ("return_latency", "d"),
+                 ("server_dwell", "d"),
+                 ("clock_offset", "d"),
+                 ("outage_count", "q"),
+                 ("offline_time", "d"),
+                 ("reordered_packets", "q"),
+                 ("duplicate_packets", "q"),
+                 ("late_packets", "q"))
+# Outages a record carries in detail, see UDPTraffic.outage; outage_count and offline_time
+# always cover all of them
+OUTAGE_SLOTS = 8
+# start_seq, end_seq, last_timestamp, resume_timestamp (NaN for None), offline_time
+_OUTAGE = struct.Struct("=qqddd")
+# reorder_distance, see UDPTraffic.reorder
+_REORDER = struct.Struct("=%dQ" % REORDER_BUCKETS)
+
+_INT_NONE = -2 ** 63
+
+
+class SharedStatRing(object):
+    """
+    Ring of fixed-size stat records in shared memory, written by any number of processes
+    forked after it was created and read by one. When full, the oldest record is dropped.
+    Records must have exactly the keys of RECORD_FIELDS, outages and reorder_distance, plus optionally
+    latency_histogram as a LatencyHistogram with the default layout.
+
+    .. python::
+    Example Usage
+    ring = SharedStatRing()
+    ring.put(record)                 # Shard process
+    record = ring.get(timeout=0.1)   # Parent
+    """
+    SLOTS = 64
+    # put() packs the record straight away, the caller may reuse its histogram
+    copies_records = True
+
+    def __init__(self, slots=SLOTS):
+        """
+        Constructor
+        :param slots: (integer) Records the ring holds
+        :return: None
+        """
+        self.slots = slots
+        self._keys = [key for key, fmt in RECORD_FIELDS]
+        self._formats = [fmt for key, fmt in RECORD_FIELDS]
+        self._template = LatencyHistogram()
+        # Fields, then whether a histogram follows and its count, total and max, then the
+        # number of outages and their slots, the reorder distances and the histogram buckets
+        self._fields = struct.Struct("=" + "".join(self._formats) + "?QQQ")
+        self._outage_count = struct.Struct("=B")
+        self._outages_size = self._outage_count.size + OUTAGE_SLOTS * _OUTAGE.size
+        self._buckets = self._template.size * 8
+        self._histogram_start = self._fields.size + self._outages_size + _REORDER.size
+        self.record_size = self._histogram_start + self._buckets
+        # Read and write positions (counting records ever written) and records dropped
+        self._positions = multiprocessing.RawArray("q", 3)
+        self._buffer = multiprocessing.RawArray("B", slots * self.record_size)
+        self._view = memoryview(self._buffer).cast("B")
+        self._lock = multiprocessing.Lock()
+        self._available = multiprocessing.Semaphore(0)
+
+    @property
+    def dropped(self):
+        """
+        :return: (integer) Records overwritten before they were read
+        """
+        return self._positions[2]
+
+    def put(self, record):
+        """
+        :param record: (dict) Stat record
+        :return: None
+        """
+        values = []
+        for key, fmt in zip(self._keys, self._formats):
+            value = record[key]
+            if fmt == "d":
+                value = float("nan") if value is None else value
+            elif fmt == "q":
+                value = _INT_NONE if value is None else value
+            else:
+                value = value.encode("utf-8")
+            values.append(value)
+        histogram = record.get("latency_histogram")
+        if histogram is not None:
+            if (histogram.sub_bits, histogram.max_bits) != (self._template.sub_bits, self._template.max_bits):
+                raise ValueError("Only histograms with the default bucket layout fit the ring")
+            values.extend((True, histogram.count, histogram.total, histogram.max))
+        else:
+            values.extend((False, 0, 0, 0))
+        outages = record["outages"][:OUTAGE_SLOTS]
+        distances = record["reorder_distance"]
+        if len(record) - (histogram is not None) != len(self._keys) + 2:
+            raise ValueError("Stat record keys do not match RECORD_FIELDS: %s" %
+                             sorted(set(record) - set(self._keys) -
+                                    {"latency_histogram", "outages", "reorder_distance"}))
+
+        with self._lock:
+            positions = self._positions
+            write = positions[1]
+            offset = write % self.slots * self.record_size
+            self._fields.pack_into(self._view, offset, *values)
+            start = offset + self._fields.size
+            self._outage_count.pack_into(self._view, start, len(outages))
+            start += self._outage_count.size
+            for outage in outages:
+                resume = outage["resume_timestamp"]
+                _OUTAGE.pack_into(self._view, start, outage["start_seq"], outage["end_seq"], outage["last_timestamp"],
+                                  float("nan") if resume is None else resume, outage["offline_time"])
+                start += _OUTAGE.size
+            _REORDER.pack_into(self._view, offset + self._fields.size + self._outages_size, *distances)
+            if histogram is not None:
+                start = offset + self._histogram_start
+                self._view[start:start + self._buckets] = memoryview(histogram.counts).cast("B")
+            positions[1] = write + 1
+            if write - positions[0] == self.slots:
+                # Overwrote the oldest record, the reader already has a permit for this slot
+                positions[0] += 1
+                positions[2] += 1
+                return
+        self._available.release()
+
+    def get(self, timeout=None):
+        """
+        Take the oldest record, waiting for one if the ring is empty.
+        :param timeout: (number) Seconds to wait, None waits forever
+        :return: (dict) Stat record, latency_histogram as a LatencyHistogram if one was put
+        """
+        if not self._available.acquire(timeout=timeout):
+            raise queue.Empty
+        with self._lock:
+            positions = self._positions
+            offset = positions[0] % self.slots * self.record_size
+            values = self._fields.unpack_from(self._view, offset)
+            start = offset + self._fields.size
+            count, = self._outage_count.unpack_from(self._view, start)
+            outages = [_OUTAGE.unpack_from(self._view, start + self._outage_count.size + i * _OUTAGE.size)
+                       for i in range(count)]
+            distances = _REORDER.unpack_from(self._view, offset + self._fields.size + self._outages_size)
+            has_histogram = values[-4]
+            if has_histogram:
+                start = offset + self._histogram_start
+                counts = array("Q")
+                counts.frombytes(self._view[start:start + self._buckets])
+            positions[0] += 1
+        record = {}
+        for key, fmt, value in zip(self._keys, self._formats, values):
+            if fmt == "d":
+                value = None if math.isnan(value) else value
+            elif fmt == "q":
+                value = None if value == _INT_NONE else value
+            else:
+                value = value.rstrip(b"\0").decode("utf-8")
+            record[key] = value
+        record["outages"] = [{"start_seq": start_seq,
+                              "end_seq": end_seq,
+                              "last_timestamp": last_timestamp,
+                              "resume_timestamp": None if math.isnan(resume_timestamp) else resume_timestamp,
+                              "offline_time": duration}
+                             for start_seq, end_seq, last_timestamp, resume_timestamp, duration in outages]
+        record["reorder_distance"] = list(distances)
+        if has_histogram:
+            histogram = LatencyHistogram()
+            histogram.counts = counts
+            histogram.count, histogram.total, histogram.max = values[-3:]
+            record["latency_histogram"] = histogram
+        return record
+
+    def drain(self):
+        """
+        :return: (list) Every record in the ring, oldest first
+        """
+        records = []
+        while True:
+            try:
+                records.append(self.get(timeout=0))
+            except queue.Empty:
+                return records
+
+    def empty(self):
+        """
+        :return: (boolean) True if no record is waiting
+        """
+        return self._positions[0] == self._positions[1]
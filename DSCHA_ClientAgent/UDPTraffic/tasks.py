@@ -1,11 +1,46 @@
+import os
+import tempfile
 from celery import task, shared_task, uuid
 from DSCHA_ClientAgent import celery_app
 from UDPTraffic.udptraffic import UDPTraffic
-from UDPTraffic.udpserver import UDPEchoServer
+from UDPTraffic.asyncudp import AsyncUDPTraffic
+from UDPTraffic.sharded import ShardedUDPTraffic
+from UDPTraffic.multiflow import MultiFlowUDPTraffic
+from UDPTraffic.tcptraffic import AsyncTCPTraffic
+from UDPTraffic.udpserver import UDPEchoServer, ReusePortEchoServer
+from UDPTraffic.tcpserver import ReusePortTCPServer
+from UDPTraffic.control import ControlChannel
+from UDPTraffic.rateprofile import parse_profile
+from UDPTraffic.packet import parse_payload_size
+from UDPTraffic.livestats import LiveStats
+from app.statstore import StatStore
 
+# Traffic engines by name, see app.models.UDPTraffic.engine
+ENGINES = {"thread": UDPTraffic,
+           "asyncio": AsyncUDPTraffic}
 
-@shared_task
-def start_udp_traffic(vip, vport, packet_rate, app_id):
+
+def _run_until_stopped(task, runner, commands=None):
+    """
+    Run runner.start() while listening for a stop request on the task's control channel,
+    see UDPTraffic.control.
+    :param task: (celery.Task) The bound task
+    :param runner: (object) Traffic engine or server with blocking start() and thread safe stop()
+    :param commands: (dict) Other commands the task takes, see ControlChannel.listen()
+    :return: None
+    """
+    channel = ControlChannel(task.request.id)
+    channel.listen(runner.stop, commands)
+    try:
+        runner.start()
+    finally:
+        channel.close()
+
+
+@shared_task(bind=True)
+def start_udp_traffic(self, vip, vport, packet_rate, app_id, batch_size=1, pacing_burst=8, shards=1,
+                      engine="thread", ship_histogram=False, timestamping="user", rate_profile=None,
+                      payload_size=0):
     """
     To start a task, call
     start_udp_traffic.apply_async((vip, vport, packet_rate), task_id = uuid())
@@ -13,25 +48,146 @@ def start_udp_traffic(vip, vport, packet_rate, app_id):
     :param vport:
     :param packet_rate:
     :param app_id:
+    :param batch_size: datagrams per sendmmsg/recvmmsg call, 1 sends packet by packet
+    :param pacing_burst: packets the pacer may send back to back to catch up after a stall
+    :param shards: number of sender processes packet_rate is split across
+    :param engine: "thread" for the sender/reader threads, "asyncio" for one event loop
+    :param ship_histogram: also post each interval's latency histogram in compact form
+    :param timestamping: "user", "kernel" (SO_TIMESTAMPNS receive stamps) or "kernel_tx" (plus
+        transmit stamps, batch_size 1 only), see UDPTraffic.timestamps
+    :param rate_profile: rate profile spec (or its JSON text) followed instead of packet_rate,
+        see UDPTraffic.rateprofile
+    :param payload_size: payload bytes, "imix" or a fixed/uniform/weighted size spec (or its JSON
+        text), see UDPTraffic.packet.parse_payload_size
     :return:
     """
-    udp = UDPTraffic(vip, vport, int(packet_rate))
+    if int(shards) > 1:
+        udp = ShardedUDPTraffic(vip, vport, int(packet_rate), int(shards), ENGINES[engine])
+    else:
+        udp = ENGINES[engine](vip, vport, int(packet_rate))
     # Use source ports 20000 - 35000
     udp.controller_app_id = app_id
+    udp.flow_id = int(app_id or 0)
+    udp.batch_size = int(batch_size)
+    udp.pacing_burst = int(pacing_burst)
+    udp.ship_histogram = bool(ship_histogram)
+    udp.timestamping = timestamping
+    udp.rate_profile = parse_profile(rate_profile)
+    udp.payload_size = parse_payload_size(payload_size)
+    udp.stat_store = StatStore("udp")
+    udp.stat_queue.live = LiveStats("udp")
     udp.udp_port_range_start = 20000
     udp.udp_port_range_stop = 35000
-    udp.start()
+    _run_until_stopped(self, udp)
+
+
+@shared_task(bind=True)
+def start_udp_flows(self, flows, group_id=None, batch_size=1, pacing_burst=8, ship_histogram=False,
+                    timestamping="user"):
+    """
+    To start one task sending to many destinations, call
+    start_udp_flows.apply_async(([[vip, vport, packet_rate, app_id], ...],), task_id = uuid())
+    While it runs, send_command(celery_id, "add", [vip, vport, packet_rate, app_id]) adds a
+    flow and send_command(celery_id, "remove", app_id) removes one, see UDPTraffic.control.
+    A flow may carry a rate profile spec and a payload size as fifth and sixth elements.
+    :param flows: [vip, vport, packet_rate, app_id(, rate_profile(, payload_size))] of the flows
+        to start with
+    :param group_id: id of the traffic group, names the directory unsent stats are spooled in
+    :param batch_size: datagrams per sendmmsg/recvmmsg call, 1 sends packet by packet
+    :param pacing_burst: packets a flow may send back to back to catch up after a stall
+    :param ship_histogram: also post each interval's latency histogram in compact form
+    :param timestamping: "user", "kernel" or "kernel_tx", see start_udp_traffic
+    :return:
+    """
+    udp = MultiFlowUDPTraffic(flows)
+    if group_id is not None:
+        udp.spool_dir = os.path.join(tempfile.gettempdir(), "udptraffic_spool", "group-%s" % group_id)
+    udp.batch_size = int(batch_size)
+    udp.pacing_burst = int(pacing_burst)
+    udp.ship_histogram = bool(ship_histogram)
+    udp.timestamping = timestamping
+    udp.stat_store = StatStore("udp")
+    udp.stat_queue.live = LiveStats("udp")
+    udp.udp_port_range_start = 20000
+    udp.udp_port_range_stop = 35000
+
+    def add(flow):
+        # The new UDPFlow is not an answer the control channel can send
+        udp.add_flow(*flow)
+
+    _run_until_stopped(self, udp, {"add": add, "remove": udp.remove_flow})
+
+
+@shared_task(bind=True)
+def start_tcp_traffic(self, vip, vport, rate, app_id, mode="cps", connections=0, ip_version=4, data="",
+                      payload_size=0, response_size=-1):
+    """
+    To start a task, call
+    start_tcp_traffic.apply_async((vip, vport, rate, app_id), {"mode": "concurrent", ...}, task_id = uuid())
+    :param vip:
+    :param vport:
+    :param rate: new connections per second in "cps" mode, requests per second in "concurrent" mode
+    :param app_id:
+    :param mode: "cps" for one request per short-lived connection, "concurrent" for requests over
+        long-lived connections, see UDPTraffic.tcptraffic
+    :param connections: connections kept open in "concurrent" mode, the most open at once in
+        "cps" mode (0: no limit)
+    :param ip_version: 4 or 6
+    :param data: request payload
+    :param payload_size: bytes the payload is zero padded up to
+    :param response_size: response bytes expected per request, -1 as many as sent, 0 none
+    :return:
+    """
+    tcp = AsyncTCPTraffic(vip, vport, mode, int(rate), int(connections))
+    tcp.controller_app_id = app_id
+    tcp.ip_version = int(ip_version)
+    tcp.data = data or ""
+    tcp.payload_size = int(payload_size)
+    tcp.response_size = int(response_size)
+    tcp.stat_store = StatStore("tcp")
+    tcp.stat_queue.live = LiveStats("tcp")
+    _run_until_stopped(self, tcp)
 
 
-@shared_task
-def start_udp_server(srv_ip, srv_port):
+@shared_task(bind=True)
+def start_udp_server(self, srv_ip, srv_port, mode="classic", workers=1, batch_size=1, timestamps=False):
     """
     To start this udp server, call
     start_udp_server.apply_async((vip, vport, packet_rate), task_id = uuid())
     :param srv_ip:
     :param srv_port:
+    :param mode: "classic" for the socketserver echo server, "reuseport" for SO_REUSEPORT workers
+    :param workers: number of reuseport worker processes, 0 for one per CPU
+    :param batch_size: datagrams per recvmmsg/sendmmsg call in reuseport mode
+    :param timestamps: append server receive/send timestamps to every echo, for one-way latency
+    :return:
+    """
+    if mode == "reuseport":
+        udp_srv = ReusePortEchoServer(srv_ip, srv_port, int(workers) or None, int(batch_size),
+                                      bool(timestamps))
+    else:
+        udp_srv = UDPEchoServer(srv_ip, srv_port, bool(timestamps))
+    _run_until_stopped(self, udp_srv)
+    print("UDP server stopped")
+
+
+@shared_task(bind=True)
+def start_tcp_server(self, srv_ip, srv_port, mode="echo", workers=1, response_size=0, request_size=0):
+    """
+    To start this tcp server, call
+    start_tcp_server.apply_async((srv_ip, srv_port), {"mode": "fixed", ...}, task_id = uuid())
+    While it runs, query(celery_id, "stats", seconds) returns its counters and the last
+    seconds of per-second records, see UDPTraffic.control.
+    :param srv_ip:
+    :param srv_port:
+    :param mode: "echo", "sink" or "fixed" to answer every request with response_size bytes,
+        see UDPTraffic.tcpserver
+    :param workers: number of SO_REUSEPORT worker processes, 0 for one per CPU
+    :param response_size: bytes answered per request in fixed mode
+    :param request_size: bytes per request in fixed mode, 0 answers every read
     :return:
     """
-    udp_srv = UDPEchoServer(srv_ip, srv_port)
-    udp_srv.start()
-    print("UDP server started")
\ No newline at end of file
+    tcp_srv = ReusePortTCPServer(srv_ip, srv_port, mode, int(workers) or None, int(response_size),
+                                 int(request_size))
+    _run_until_stopped(self, tcp_srv, {"stats": tcp_srv.stats})
+    print("TCP server stopped")
@@ -0,0 +1,484 @@
+"""
+TCP server for the TCP traffic engine to run against, see UDPTraffic.tcptraffic.
+
+ReusePortTCPServer runs several worker processes bound to the same ip:port with
+SO_REUSEPORT, so the kernel spreads new connections over them. Every worker is a single
+epoll loop over non-blocking sockets, level triggered, with no thread or coroutine per
+connection, so tens of thousands of connections cost a socket and a small slot each. It
+serves in one of three modes:
+
+  echo:  send every read back unchanged, from one receive buffer shared by the worker's
+         connections; only what the socket would not take yet is copied
+  sink:  read and count, send nothing
+  fixed: answer every request (request_size bytes, or every read when 0) with
+         response_size bytes. The response lives in an unlinked temporary file, repeated
+         to fill up to RESPONSE_FILE bytes, and goes out with os.sendfile() from the page
+         cache, several pipelined responses per system call, without passing through
+         user space
+
+A connection with output the socket would not take stops being read until it has drained,
+so a client that does not read its responses cannot make the server buffer without bound.
+
+The workers count connections, bytes, requests and errors into shared memory. The parent
+turns the counters into a per-second record every second and keeps the last HISTORY of
+them for stats(), which the start_tcp_server task answers the "stats" control command
+with, see UDPTraffic.control.
+"""
+import os
+import time
+import errno
+import select
+import socket
+import resource
+import tempfile
+import collections
+import multiprocessing
+
+MODE_ECHO = "echo"
+MODE_SINK = "sink"
+MODE_FIXED = "fixed"
+MODES = (MODE_ECHO, MODE_SINK, MODE_FIXED)
+# Counters every worker keeps, in shared memory
+COUNTERS = ("accepted", "closed", "bytes_received", "bytes_sent", "requests", "errors")
+ACCEPTED, CLOSED, BYTES_RECEIVED, BYTES_SENT, REQUESTS, ERRORS = range(len(COUNTERS))
+# Every connection of a worker reads into this one buffer
+RECV_BUFFER = 256 * 1024
+# Largest fixed response file, the response repeated as often as it fits
+RESPONSE_FILE = 1024 * 1024
+# Seconds between the workers' counter updates
+FLUSH_INTERVAL = 0.1
+LISTEN_BACKLOG = 4096
+MAX_EVENTS = 1024
+
+
+def _raise_fd_limit():
+    """
+    Private method
+    Raise the soft open file limit to the hard one, every connection takes a descriptor.
+    :return: None
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else 1024 * 1024
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class _Connection(object):
+    __slots__ = ("sock", "fd", "pending", "owed", "received", "writing")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        # Echo bytes the socket did not take yet
+        self.pending = None
+        # Fixed response bytes not sent yet, always up to the end of a response
+        self.owed = 0
+        # Bytes of the request being received, fixed mode with a request_size
+        self.received = 0
+        # Waiting for EPOLLOUT instead of EPOLLIN
+        self.writing = False
+
+
+class _ServerWorker(object):
+    """
+    The epoll loop of one worker process.
+    """
+
+    def __init__(self, listener, mode, response_fd, response_size, response_file_size, request_size,
+                 counters, slot):
+        """
+        Constructor
+        :param listener: (socket.socket) Listening socket
+        :param mode: (string) MODE_ECHO, MODE_SINK or MODE_FIXED
+        :param response_fd: (integer) File holding the fixed response, repeated
+        :param response_size: (integer) Bytes per fixed response
+        :param response_file_size: (integer) Size of the response file, a multiple of response_size
+        :param request_size: (integer) Bytes per request in fixed mode, 0: every read is one
+        :param counters: (multiprocessing.RawArray) Counters of every worker
+        :param slot: (integer) Index of the worker's first counter
+        :return: None
+        """
+        self.listener = listener
+        self.mode = mode
+        self.response_fd = response_fd
+        self.response_size = response_size
+        self.response_file_size = response_file_size
+        self.request_size = request_size
+        self.counters = counters
+        self.slot = slot
+        self.stats = [0] * len(COUNTERS)
+        self.connections = {}
+        self.epoll = select.epoll()
+        self.buffer = bytearray(RECV_BUFFER)
+        self.view = memoryview(self.buffer)
+
+    def run(self, stop_event, wakeup_fd, parent_pid):
+        """
+        Serve until stop_event is set or the parent is gone.
+        :param stop_event: (multiprocessing.Event) Set to stop the worker
+        :param wakeup_fd: (integer) Read end of a pipe that becomes readable when stop_event is set
+        :param parent_pid: (integer) Pid of the process that started the worker
+        :return: None
+        """
+        listen_fd = self.listener.fileno()
+        self.epoll.register(listen_fd, select.EPOLLIN)
+        self.epoll.register(wakeup_fd, select.EPOLLIN)
+        connections = self.connections
+        next_flush = 0
+        while not stop_event.is_set() and os.getppid() == parent_pid:
+            # Wake up now and then to notice a killed parent
+            for fd, events in self.epoll.poll(0.5, MAX_EVENTS):
+                if fd == listen_fd:
+                    self._accept()
+                    continue
+                connection = connections.get(fd)
+                if connection is None:
+                    # The wakeup pipe, stop_event is set
+                    continue
+                if connection.writing:
+                    self._send(connection)
+                else:
+                    self._receive(connection)
+            now = time.monotonic()
+            if now >= next_flush:
+                self._flush()
+                next_flush = now + FLUSH_INTERVAL
+        self._flush()
+
+    def close(self):
+        """
+        Close every connection and the poller.
+        :return: None
+        """
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        self._flush()
+        self.epoll.close()
+
+    def _flush(self):
+        """
+        Private method
+        Publish the worker's counters to the parent.
+        :return: None
+        """
+        for i, value in enumerate(self.stats):
+            self.counters[self.slot + i] = value
+
+    def _accept(self):
+        """
+        Private method
+        Accept every connection waiting on the listening socket.
+        :return: None
+        """
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of descriptors or buffers, the connection waits in the backlog
+                self.stats[ERRORS] += 1
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    time.sleep(0.01)
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _Connection(sock)
+            self.connections[connection.fd] = connection
+            self.epoll.register(connection.fd, select.EPOLLIN)
+            self.stats[ACCEPTED] += 1
+
+    def _close(self, connection):
+        """
+        Private method
+        :param connection: (_Connection) Connection to close
+        :return: None
+        """
+        del self.connections[connection.fd]
+        try:
+            self.epoll.unregister(connection.fd)
+        except OSError:
+            pass
+        connection.sock.close()
+        self.stats[CLOSED] += 1
+
+    def _receive(self, connection):
+        """
+        Private method
+        Read what arrived on a connection and answer it as the mode says.
+        :param connection: (_Connection) A readable connection
+        :return: None
+        """
+        try:
+            nbytes = connection.sock.recv_into(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.stats[ERRORS] += 1
+            self._close(connection)
+            return
+        if not nbytes:
+            # Nothing is left to send, connections with output are not read
+            self._close(connection)
+            return
+        self.stats[BYTES_RECEIVED] += nbytes
+        if self.mode == MODE_FIXED:
+            if self.request_size:
+                requests, connection.received = divmod(connection.received + nbytes, self.request_size)
+            else:
+                requests = 1
+            if requests:
+                self.stats[REQUESTS] += requests
+                connection.owed += requests * self.response_size
+                self._send(connection)
+            return
+        self.stats[REQUESTS] += 1
+        if self.mode == MODE_ECHO:
+            connection.pending = self.view[:nbytes]
+            self._send(connection)
+
+    def _send(self, connection):
+        """
+        Private method
+        Send a connection's pending echo or owed fixed responses, as much as the socket takes.
+        Stops reading the connection until the rest is sent.
+        :param connection: (_Connection) The connection
+        :return: None
+        """
+        try:
+            if connection.pending is not None:
+                data = connection.pending
+                sent = connection.sock.send(data)
+                self.stats[BYTES_SENT] += sent
+                connection.pending = data[sent:] if sent < len(data) else None
+            else:
+                size = self.response_size
+                while connection.owed:
+                    # The file holds whole responses, owed ends at the end of one
+                    offset = (size - connection.owed % size) % size
+                    count = min(connection.owed, self.response_file_size - offset)
+                    sent = os.sendfile(connection.fd, self.response_fd, offset, count)
+                    self.stats[BYTES_SENT] += sent
+                    connection.owed -= sent
+                    if sent < count:
+                        break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.stats[ERRORS] += 1
+            self._close(connection)
+            return
+        if type(connection.pending) is memoryview:
+            # Still a view of the shared buffer, which the next read overwrites
+            connection.pending = bytes(connection.pending)
+        writing = connection.pending is not None or connection.owed > 0
+        if writing != connection.writing:
+            connection.writing = writing
+            self.epoll.modify(connection.fd, select.EPOLLOUT if writing else select.EPOLLIN)
+
+
+def _serve_worker(ip, port, mode, response_fd, response_size, response_file_size, request_size,
+                  counters, slot, stop_event, wakeup_fd, parent_pid):
+    """
+    Process target: serve TCP on ip:port until stop_event is set, see _ServerWorker.
+    :param ip: (string) Address to listen on
+    :param port: (integer) Port to listen on
+    :param mode: (string) MODE_ECHO, MODE_SINK or MODE_FIXED
+    :param response_fd: (integer) File holding the fixed response, repeated, -1 in other modes
+    :param response_size: (integer) Bytes per fixed response
+    :param response_file_size: (integer) Size of the response file
+    :param request_size: (integer) Bytes per request in fixed mode, 0: every read is one
+    :param counters: (multiprocessing.RawArray) Counters of every worker
+    :param slot: (integer) Index of the worker's first counter
+    :param stop_event: (multiprocessing.Event) Set to stop the worker
+    :param wakeup_fd: (integer) Read end of a pipe that becomes readable when stop_event is set
+    :param parent_pid: (integer) The worker also stops once this process is gone, e.g. killed
+    :return: None
+    """
+    _raise_fd_limit()
+    listener = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((ip, port))
+    listener.listen(LISTEN_BACKLOG)
+    listener.setblocking(False)
+    worker = _ServerWorker(listener, mode, response_fd, response_size, response_file_size, request_size,
+                           counters, slot)
+    try:
+        worker.run(stop_event, wakeup_fd, parent_pid)
+    finally:
+        worker.close()
+        listener.close()
+
+
+class ReusePortTCPServer(object):
+    """
+    Echo, sink or fixed response TCP server: SO_REUSEPORT worker processes, each an epoll
+    loop over all of its connections.
+
+    .. python::
+    Example Usage
+    server = ReusePortTCPServer('10.2.1.100', 8080, MODE_FIXED, workers=4, response_size=1024)
+    server.start()  # Blocks until server.stop() is called from another thread
+    print(server.stats(10))  # From another thread while it runs
+    """
+    # Per-second records stats() keeps
+    HISTORY = 60
+
+    def __init__(self, ip, port, mode=MODE_ECHO, workers=None, response_size=0, request_size=0):
+        """
+        Constructor
+        :param ip: (string) The local IP address to listen on
+        :param port: (integer) The local port to listen on
+        :param mode: (string) MODE_ECHO, MODE_SINK or MODE_FIXED
+        :param workers: (integer) Number of worker processes, one per CPU when None
+        :param response_size: (integer) Bytes answered per request in fixed mode
+        :param request_size: (integer) Bytes per request in fixed mode, 0: every read is one
+        :return: None
+        """
+        if mode not in MODES:
+            raise ValueError("TCP server mode must be one of %s" % ", ".join(MODES))
+        if mode == MODE_FIXED and response_size <= 0:
+            raise ValueError("A fixed response server needs a response_size")
+        self.ip = ip
+        self.port = port
+        self.mode = mode
+        self.workers = workers or multiprocessing.cpu_count()
+        self.response_size = response_size
+        self.request_size = max(request_size, 0)
+        self.processes = []
+        self.stop_event = multiprocessing.Event()
+        self._wakeup = None
+        self._counters = None
+        self._history = collections.deque(maxlen=self.HISTORY)
+        self._totals = [0] * len(COUNTERS)
+
+    def start(self):
+        """
+        Start the workers, sample their counters every second and wait for them to exit.
+        :return: None
+        """
+        self.stop_event.clear()
+        self.processes = []
+        self._history.clear()
+        self._totals = [0] * len(COUNTERS)
+        self._counters = multiprocessing.RawArray("Q", self.workers * len(COUNTERS))
+        response_file, response_file_size = self._response_file()
+        # Written to by stop() so the workers leave poll() at once
+        self._wakeup = os.pipe()
+        try:
+            for i in range(self.workers):
+                process = multiprocessing.Process(target=_serve_worker,
+                                                  args=(self.ip, self.port, self.mode,
+                                                        response_file.fileno() if response_file else -1,
+                                                        self.response_size, response_file_size,
+                                                        self.request_size, self._counters, i * len(COUNTERS),
+                                                        self.stop_event, self._wakeup[0], os.getpid()))
+                process.daemon = True
+                process.start()
+                self.processes.append(process)
+            print("Start tcp %s server %s:%s, %d SO_REUSEPORT workers" %
+                  (self.mode, self.ip, self.port, self.workers))
+            self._sample_until_stopped()
+            for process in self.processes:
+                process.join()
+            self._sample(time.monotonic(), 0)
+        finally:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+            if response_file is not None:
+                response_file.close()
+
+    def stop(self):
+        """
+        Stop the workers.
+        :return: None
+        """
+        # Wake the workers first: they only exit, and start() only closes the pipe, once
+        # stop_event is set
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"\0")
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(2)
+            if process.is_alive():
+                process.terminate()
+
+    def stats(self, seconds=None):
+        """
+        The server's counters. Thread safe.
+        :param seconds: (integer) Per-second records to return, the last HISTORY when None
+        :return: (dict) Totals since start, the number of open connections and the latest
+            per-second records, oldest first
+        """
+        history = list(self._history)
+        if seconds is not None:
+            history = history[-int(seconds):] if int(seconds) > 0 else []
+        totals = dict(zip(COUNTERS, self._totals))
+        return {"mode": self.mode,
+                "workers": self.workers,
+                "active_connections": totals["accepted"] - totals["closed"],
+                "totals": totals,
+                "per_second": history}
+
+    def _response_file(self):
+        """
+        Private method
+        Write the fixed response, repeated to fill up to RESPONSE_FILE bytes, to an unlinked
+        file the workers send it from.
+        :return: (tuple) The file and its size, (None, 0) when the mode is not fixed
+        """
+        if self.mode != MODE_FIXED:
+            return None, 0
+        copies = max(RESPONSE_FILE // self.response_size, 1)
+        response_file = tempfile.TemporaryFile()
+        response = bytes(self.response_size)
+        for i in range(copies):
+            response_file.write(response)
+        response_file.flush()
+        return response_file, copies * self.response_size
+
+    def _sample_until_stopped(self):
+        """
+        Private method
+        Add a per-second record every second until stop() is called or every worker is gone.
+        :return: None
+        """
+        last = time.monotonic()
+        while not self.stop_event.wait(max(last + 1 - time.monotonic(), 0)):
+            now = time.monotonic()
+            self._sample(now, now - last)
+            last = now
+            if not any(process.is_alive() for process in self.processes):
+                return
+
+    def _sample(self, now, elapsed):
+        """
+        Private method
+        Sum the workers' counters and record what changed since the last sample.
+        :param now: (number) Monotonic time of the sample
+        :param elapsed: (number) Seconds since the last sample, 0 only updates the totals
+        :return: None
+        """
+        counters = self._counters
+        width = len(COUNTERS)
+        totals = [sum(counters[i::width]) for i in range(width)]
+        delta = [total - last for total, last in zip(totals, self._totals)]
+        self._totals = totals
+        if elapsed <= 0:
+            return
+        self._history.append({
+            "time": time.time(),
+            "active_connections": totals[ACCEPTED] - totals[CLOSED],
+            "connections_per_second": delta[ACCEPTED] / elapsed,
+            "closed_per_second": delta[CLOSED] / elapsed,
+            "requests_per_second": delta[REQUESTS] / elapsed,
+            "bytes_received": delta[BYTES_RECEIVED],
+            "bytes_sent": delta[BYTES_SENT],
+            "rx_bps": delta[BYTES_RECEIVED] * 8 / elapsed,
+            "tx_bps": delta[BYTES_SENT] * 8 / elapsed,
+            "errors": delta[ERRORS]})
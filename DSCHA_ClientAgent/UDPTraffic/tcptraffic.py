@@ -0,0 +1,552 @@
+"""
+asyncio TCP traffic engine.
+
+AsyncTCPTraffic generates TCP load against a VIP from one event loop, in one of two modes:
+
+  cps:        open connection_rate new connections per second, each sending one request,
+              reading its response and closing; at most max_connections are open at once
+  concurrent: keep `connections` connections open, re-opening any that close, and send
+              requests over them at request_rate requests per second in total (0: every
+              connection sends its next request as soon as the last response is in)
+
+A request is the payload (data, zero padded to payload_size) and its response is
+response_size bytes: -1 for as many as the request, as from an echo server, 0 for none, as
+to a sink. The payload is built once and written from the same buffer every time, and every
+connection reads into one shared receive buffer through BufferedProtocol, so requests cost
+no allocation in either direction.
+
+Every second a stat record goes on stat_queue and to the controller through the same
+StatReporter and spool as UDP traffic: connection and request counts, bytes, and the
+percentiles of the connect time, time to first byte and per-request transfer rate
+histograms.
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import datetime
+import tempfile
+import threading
+import configparser
+from global_var import *
+from UDPTraffic.histogram import LatencyHistogram
+from UDPTraffic.pacer import TokenBucketPacer
+from UDPTraffic.statqueue import StatQueue
+from UDPTraffic.reporter import StatReporter
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+MODE_CPS = "cps"
+MODE_CONCURRENT = "concurrent"
+MODES = (MODE_CPS, MODE_CONCURRENT)
+# Every connection reads into this one buffer, the data is only counted
+RECV_BUFFER = 256 * 1024
+
+
+class _TCPClientProtocol(asyncio.BufferedProtocol):
+    """
+    One connection. Counts what it receives into the engine's shared buffer and completes
+    the request in progress once its response is in.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+        # Request in progress: response bytes expected and received so far, when the first
+        # one arrived, and the future completed with the time the last one arrived
+        self.expected = 0
+        self.received = 0
+        self.first_byte_ns = 0
+        self.done = None
+        # Completed when the connection is gone
+        self.closed = engine.loop.create_future()
+        # Set while the transport's write buffer is over its high-water mark
+        self.writable = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.engine._recv_view
+
+    def buffer_updated(self, nbytes):
+        self.engine._bytes_received += nbytes
+        if self.done is None or self.done.done():
+            # Nothing asked for, or after a timeout: counted only
+            return
+        now = time.monotonic_ns()
+        if not self.received:
+            self.first_byte_ns = now
+        self.received += nbytes
+        if self.received >= self.expected:
+            self.done.set_result(now)
+
+    def eof_received(self):
+        # Close our side too
+        return False
+
+    def connection_lost(self, exc):
+        if self.done is not None and not self.done.done():
+            self.done.set_exception(exc or ConnectionResetError("Connection closed by the server"))
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writable = self.engine.loop.create_future()
+
+    def resume_writing(self):
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+        self.writable = None
+
+
+class AsyncTCPTraffic(object):
+    """
+    TCP traffic on an asyncio event loop. start() blocks until stop() is called from
+    another thread.
+
+    .. python::
+    Example Usage
+    t = AsyncTCPTraffic('10.1.1.125', 80, mode="cps", rate=500)
+    t.data = b"GET / HTTP/1.0\\r\\n\\r\\n"
+    t.response_size = 1024
+    threading.Thread(target=t.start).start()
+    t.stop()
+    """
+    # The loop's timers fire with about a millisecond of resolution, so the pacer is allowed
+    # to release the connections of this many seconds at once
+    TIMER_SLACK = 0.005
+    # Seconds a failed long-lived connection waits before it is opened again, doubling up to
+    # RECONNECT_MAX while it keeps failing
+    RECONNECT_START = 0.1
+    RECONNECT_MAX = 5.0
+
+    def __init__(self, destination_ip, destination_port, mode=MODE_CPS, rate=0, connections=1):
+        """
+        Constructor
+        :param destination_ip: (string) IP address to send traffic to (BIG-IP VIP)
+        :param destination_port: (integer) Port to send traffic to
+        :param mode: (string) MODE_CPS or MODE_CONCURRENT
+        :param rate: (integer) New connections per second in cps mode, requests per second
+            over all connections in concurrent mode
+        :param connections: (integer) Connections kept open in concurrent mode, the most open
+            at once in cps mode (0: no limit)
+        :return: None
+        """
+        if mode not in MODES:
+            raise ValueError("TCP traffic mode must be one of %s" % ", ".join(MODES))
+        if mode == MODE_CONCURRENT and connections < 1:
+            raise ValueError("Concurrent TCP traffic needs at least one connection")
+        self.destination_ip = destination_ip
+        self.destination_port = destination_port
+        self.mode = mode
+        self.rate = rate
+        self.connections = connections
+        # 4 or 6
+        self.ip_version = 4
+        # Request payload, zero padded up to payload_size, and the response expected to it
+        # (-1: as long as the request, 0: none)
+        self.data = b""
+        self.payload_size = 0
+        self.response_size = -1
+        self.connect_timeout = 3
+        self.response_timeout = 2
+        self.pacing_burst = 8
+        self.pacer = None
+        self.controller_app_id = None
+        self.report_stats = True
+        self.report_interval = 5
+        # Where batches wait while the controller is unreachable (None: a directory per
+        # controller_app_id under the system temp directory)
+        self.spool_dir = None
+        # Also keeps every posted batch on the agent, e.g. app.statstore.StatStore
+        self.stat_store = None
+        self.reporter = None
+        self.stat_queue = StatQueue()
+        # Run on uvloop when it is installed
+        self.use_uvloop = True
+        self.loop = None
+        self.sending = False
+        self._stop_requested = False
+        # Set while not running, and once the last stats of the run were queued
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._stop_event = None
+        self._payload = b""
+        self._expected = 0
+        self._recv_view = memoryview(bytearray(RECV_BUFFER))
+        # Connection and request tasks running, and connections open
+        self._tasks = set()
+        self._open = set()
+        self.connect_times = LatencyHistogram()
+        self.first_byte_times = LatencyHistogram()
+        self.transfer_rates = LatencyHistogram()
+        self._reset_counters()
+
+        # Configure logging
+        try:
+            import tcutils.common as tc
+            self._log = tc.stdout_logger("tcp_traffic.log")
+        except ImportError:
+            # running outside ITE, set own logger
+            import logging
+            self._log = logging.getLogger("tcp_traffic.log")
+            self._log.setLevel(logging.INFO)
+            if not self._log.handlers:
+                log_handler = logging.StreamHandler(sys.stdout)
+                log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s| %(message)s",
+                                                           datefmt="%H:%M:%S"))
+                self._log.addHandler(log_handler)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def log(self):
+        """
+        Access the logging interface. Call .info(), .error() or .debug() to log accordingly.
+            Returns a logging handle.
+        """
+        return self._log
+
+    def start(self):
+        """
+        Start generating TCP traffic and run the event loop until stop() is called and the
+        stats of the last interval are queued.
+        :return: None
+        """
+        self._stopped.clear()
+        if self._stop_requested:
+            # stop() came first
+            self._stopped.set()
+            return
+        self.sending = True
+        data = self.data.encode() if isinstance(self.data, str) else bytes(self.data or b"")
+        self._payload = data + bytes(max(self.payload_size - len(data), 0))
+        self._expected = len(self._payload) if self.response_size < 0 else self.response_size
+        self._reset_counters()
+        if uvloop is not None and self.use_uvloop:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        self.log.info("TCP traffic to %s:%d, %s mode, %d per second, %d byte requests, "
+                      "%d byte responses" % (self.destination_ip, self.destination_port, self.mode,
+                                             self.rate, len(self._payload), self._expected))
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+            self._stopped.set()
+
+    def stop(self):
+        """
+        Stop generating traffic, close every connection and wait until the last stats are
+        queued. Thread safe.
+        :return: None
+        """
+        self._stop_requested = True
+        self.sending = False
+        try:
+            if self._stop_event is not None:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+        if not self._stopped.wait(self.response_timeout + 5):
+            self.log.warning("Traffic did not stop in %d seconds" % (self.response_timeout + 5))
+
+    def _reset_counters(self):
+        """
+        Private method
+        Zero the interval counters and histograms.
+        :return: None
+        """
+        self._connections_attempted = 0
+        self._connections_established = 0
+        self._connect_failures = 0
+        self._connections_closed = 0
+        self._connections_skipped = 0
+        self._requests = 0
+        self._responses = 0
+        self._request_failures = 0
+        self._bytes_sent = 0
+        self._bytes_received = 0
+        self.connect_times.reset()
+        self.first_byte_times.reset()
+        self.transfer_rates.reset()
+
+    async def _run(self):
+        """
+        Private method
+        Generate traffic and close a stat interval every second until stopped.
+        :return: None
+        """
+        self._stop_event = asyncio.Event()
+        if self._stop_requested:
+            self._stop_event.set()
+        reporter = None
+        done = asyncio.Event()
+        if self.report_stats:
+            reporter = self.loop.create_task(self._report_stat_async(done))
+        if self.mode == MODE_CPS:
+            runners = [self.loop.create_task(self._open_connections())]
+        else:
+            runners = [self.loop.create_task(self._long_lived(i)) for i in range(self.connections)]
+        self._interval_start = time.monotonic_ns()
+        self._interval = 0
+        self._next_interval = self._interval_start + 10 ** 9
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(),
+                                           max(self._next_interval - time.monotonic_ns(), 0) / 10 ** 9)
+                except asyncio.TimeoutError:
+                    pass
+                now = time.monotonic_ns()
+                if now >= self._next_interval:
+                    self._close_interval(now)
+        finally:
+            self.sending = False
+            for task in runners + list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*(runners + list(self._tasks)), return_exceptions=True)
+            for protocol in list(self._open):
+                self._close(protocol)
+            self._close_interval(time.monotonic_ns())
+            done.set()
+            if reporter is not None:
+                await reporter
+
+    async def _open_connections(self):
+        """
+        Private method
+        cps mode: start a one-shot connection whenever the pacer allows one.
+        :return: None
+        """
+        burst = max(self.pacing_burst, int(self.rate * self.TIMER_SLACK))
+        self.pacer = TokenBucketPacer(self.rate, burst)
+        while self.sending:
+            now = time.monotonic_ns()
+            count = self.pacer.due(now)
+            if count:
+                for i in range(count):
+                    if self.connections and len(self._tasks) >= self.connections:
+                        # The server is too slow for the rate, do not pile up connections
+                        self._connections_skipped += 1
+                        continue
+                    task = self.loop.create_task(self._one_shot())
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                self.pacer.grant(count, now)
+            wake = self.pacer.next_send_time()
+            if wake is None:
+                wake = now + 10 ** 8
+            await asyncio.sleep(max(wake - time.monotonic_ns(), 0) / 10 ** 9)
+
+    async def _one_shot(self):
+        """
+        Private method
+        Connect, send one request, read its response and close.
+        :return: None
+        """
+        protocol = await self._connect()
+        if protocol is None:
+            return
+        try:
+            if self._payload or self._expected:
+                await self._request(protocol)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._request_failures += 1
+            self.log.debug("Request failed: %r" % e)
+        finally:
+            self._close(protocol)
+
+    async def _long_lived(self, index):
+        """
+        Private method
+        concurrent mode: keep one connection open and send this connection's share of the
+        requests over it, opening it again whenever it closes.
+        :param index: (integer) Number of the connection, staggers the connections' requests
+        :return: None
+        """
+        pacer = None
+        if self.rate > 0:
+            rate = self.rate / self.connections
+            # Like cps mode: a burst lets the connection catch up on late timer wakeups
+            pacer = TokenBucketPacer(rate, max(self.pacing_burst, int(rate * self.TIMER_SLACK)))
+            pacer.start_at(time.monotonic_ns() + index * 10 ** 9 // self.rate)
+        backoff = self.RECONNECT_START
+        while self.sending:
+            protocol = await self._connect()
+            if protocol is None:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.RECONNECT_MAX)
+                continue
+            backoff = self.RECONNECT_START
+            try:
+                if not self._payload and not self._expected:
+                    # Nothing to send, just hold the connection
+                    await protocol.closed
+                while self.sending and not protocol.closed.done():
+                    if pacer is not None:
+                        now = time.monotonic_ns()
+                        if not pacer.due(now):
+                            await asyncio.sleep(max(pacer.next_send_time() - now, 0) / 10 ** 9)
+                            continue
+                        pacer.grant(1, now)
+                    await self._request(protocol)
+            except (OSError, asyncio.TimeoutError) as e:
+                self._request_failures += 1
+                self.log.debug("Request failed: %r" % e)
+            finally:
+                self._close(protocol)
+
+    async def _connect(self):
+        """
+        Private method
+        :return: (_TCPClientProtocol) The new connection, None if it could not be opened
+        """
+        self._connections_attempted += 1
+        family = socket.AF_INET6 if int(self.ip_version) == 6 else socket.AF_INET
+        start = time.monotonic_ns()
+        try:
+            transport, protocol = await asyncio.wait_for(
+                self.loop.create_connection(lambda: _TCPClientProtocol(self), self.destination_ip,
+                                            self.destination_port, family=family),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._connect_failures += 1
+            self.log.debug("Connect failed: %r" % e)
+            return None
+        self.connect_times.record(time.monotonic_ns() - start)
+        self._connections_established += 1
+        self._open.add(protocol)
+        return protocol
+
+    def _close(self, protocol):
+        """
+        Private method
+        :param protocol: (_TCPClientProtocol) Connection to close
+        :return: None
+        """
+        if protocol in self._open:
+            self._open.discard(protocol)
+            protocol.transport.close()
+            self._connections_closed += 1
+
+    async def _request(self, protocol):
+        """
+        Private method
+        Send the payload and wait for the whole response.
+        :param protocol: (_TCPClientProtocol) An open connection
+        :return: None
+        """
+        start = time.monotonic_ns()
+        protocol.received = 0
+        protocol.expected = self._expected
+        protocol.done = self.loop.create_future() if self._expected else None
+        self._requests += 1
+        if self._payload:
+            protocol.transport.write(self._payload)
+            self._bytes_sent += len(self._payload)
+        if protocol.writable is not None:
+            # The socket buffer is full, wait for it to drain
+            await protocol.writable
+        if protocol.done is None:
+            self._responses += 1
+            # Let the loop run between writes to a sink
+            await asyncio.sleep(0)
+            return
+        end = await asyncio.wait_for(protocol.done, self.response_timeout)
+        self._responses += 1
+        self.first_byte_times.record(protocol.first_byte_ns - start)
+        self.transfer_rates.record((len(self._payload) + protocol.received) * 10 ** 9 // max(end - start, 1))
+
+    def _close_interval(self, now):
+        """
+        Private method
+        Put the stat record of the interval ending at now on stat_queue and start the next.
+        :param now: (integer) Monotonic ns time
+        :return: None
+        """
+        elapsed = max(now - self._interval_start, 1) / 10 ** 9
+        stat = {"app_id": self.controller_app_id,
+                "pkt_time": str(datetime.datetime.now()),
+                "interval": self._interval,
+                "mode": self.mode,
+                "connections_attempted": self._connections_attempted,
+                "connections_established": self._connections_established,
+                "connect_failures": self._connect_failures,
+                "connections_closed": self._connections_closed,
+                "connections_skipped": self._connections_skipped,
+                "connections_open": len(self._open),
+                "requests": self._requests,
+                "responses": self._responses,
+                "request_failures": self._request_failures,
+                "byte_sent": self._bytes_sent,
+                "byte_receive": self._bytes_received,
+                "bps_sent": self._bytes_sent * 8 / elapsed,
+                "bps_receive": self._bytes_received * 8 / elapsed,
+                "achieved_cps": self._connections_established / elapsed,
+                "achieved_rps": self._responses / elapsed}
+        stat.update(self.connect_times.stats("connect_time_"))
+        stat.update(self.first_byte_times.stats("ttfb_"))
+        # Bytes per second, both directions, of each request from its write to the last byte
+        stat.update(self.transfer_rates.stats("transfer_rate_", 1))
+        self.log.info("Interval %d: %d connections (%d failed), %d/%d responses, connect p99 %.4f s, "
+                      "TTFB p99 %.4f s" %
+                      (self._interval, self._connections_established, self._connect_failures,
+                       self._responses, self._requests, stat["connect_time_p99"], stat["ttfb_p99"]))
+        self.stat_queue.put(stat)
+        self._reset_counters()
+        self._interval_start = now
+        self._interval += 1
+        self._next_interval += 10 ** 9
+        if self._next_interval <= now:
+            # Fell more than a second behind
+            self._next_interval = now + 10 ** 9
+
+    def _controller_url(self):
+        """
+        Private method
+        :return: (string) URL of the harness controller's TCP traffic stat endpoint
+        """
+        config = configparser.ConfigParser()
+        config.read(harness_config_path)
+        controller_ip = config.get("harness", "controller")
+        return "http://%s:8000/api/v1/tcptrafficstat/" % controller_ip
+
+    async def _report_stat_async(self, done):
+        """
+        Private method
+        Post queued stat records to the harness controller every report_interval seconds
+        until done is set, then post the rest. The post runs in the default executor so a
+        slow controller does not stall the connections.
+        :param done: (asyncio.Event) Set once the last stats are queued
+        :return: None
+        """
+        self.log.info("Start posting stat to harness controller")
+        spool_dir = self.spool_dir
+        if spool_dir is None:
+            spool_dir = os.path.join(tempfile.gettempdir(), "tcptraffic_spool", str(self.controller_app_id))
+        self.reporter = StatReporter(self._controller_url(), spool_dir, log=self.log, store=self.stat_store)
+        try:
+            while not done.is_set():
+                try:
+                    await asyncio.wait_for(done.wait(), self.report_interval)
+                except asyncio.TimeoutError:
+                    pass
+                data_list = self.stat_queue.drain()
+                await self.loop.run_in_executor(None, self.reporter.post, data_list)
+        finally:
+            self.reporter.close()
+        self.log.info("Stat reporting: %s" % self.reporter.stats())
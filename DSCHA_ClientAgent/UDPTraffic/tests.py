@@ -1,3 +1,335 @@
-from django.test import TestCase
+import socket
+import logging
+import threading
+from unittest import mock
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from UDPTraffic.multiflow import MultiFlowUDPTraffic
+from UDPTraffic.timestamps import CLOCK_KERNEL, CLOCK_KERNEL_TX
+from UDPTraffic.tracker import InFlightTracker
+from UDPTraffic.outage import GapDetector, Outage
+from UDPTraffic.udptraffic import UDPTraffic
+from UDPTraffic.reorder import ReorderWindow, REORDER_BUCKETS
+from UDPTraffic.rateprofile import parse_profile
+
+# One packet a millisecond in the outage tests
+GAP_NS = 10 ** 6
+
+
+def _echo_server():
+    """
+    Private method
+    :return: (tuple) Socket of a loopback UDP echo server running in a daemon thread, and its port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def echo():
+        while True:
+            try:
+                data, address = sock.recvfrom(2048)
+                sock.sendto(data, address)
+            except OSError:
+                return
+    thread = threading.Thread(target=echo)
+    thread.daemon = True
+    thread.start()
+    return sock, sock.getsockname()[1]
+
+
+def _send(tracker, first, stop, lost=()):
+    """
+    Private method
+    Track packets [first, stop), sent GAP_NS apart, and ack all but the lost ones.
+    :param tracker: (InFlightTracker) The tracker
+    :param first: (integer) First sequence number
+    :param stop: (integer) End of the sequence range (exclusive)
+    :param lost: (range) Sequences never echoed
+    :return: None
+    """
+    for sequence in range(first, stop):
+        tracker.sent(sequence, sequence * GAP_NS)
+        if sequence not in lost:
+            tracker.ack(sequence, 100000)
+
+
+class GapDetectorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tracker = InFlightTracker(4096)
+        self.gaps = GapDetector(GAP_NS, 0)
+
+    def test_gap_opens_and_closes(self):
+        _send(self.tracker, 1, 2001, range(1000, 1300))
+        self.assertEqual(self.tracker.expire(1, 2001, gaps=self.gaps), (2000, 1700, 1700 * 100000))
+        outages = self.gaps.pop()
+        self.assertEqual(len(outages), 1)
+        outage = outages[0]
+        self.assertEqual((outage.start_seq, outage.end_seq), (1000, 1299))
+        self.assertAlmostEqual(outage.last_timestamp, 1.0)
+        self.assertAlmostEqual(outage.resume_timestamp, 1.3)
+        self.assertAlmostEqual(outage.offline_time, 0.3)
+        self.assertFalse(self.gaps.is_open)
+        self.assertEqual(self.gaps.pop(), [])
+
+    def test_separate_gaps(self):
+        _send(self.tracker, 1, 101, [10, 11, 50])
+        self.tracker.expire(1, 101, gaps=self.gaps)
+        self.assertEqual([(outage.start_seq, outage.end_seq) for outage in self.gaps.pop()], [(10, 11), (50, 50)])
+
+    def test_gap_across_interval_boundary(self):
+        # Expired one interval at a time, the gap stays open over the boundary
+        _send(self.tracker, 1, 2001, range(1000, 1300))
+        self.tracker.expire(1, 1101, gaps=self.gaps)
+        self.assertTrue(self.gaps.is_open)
+        self.assertEqual(self.gaps.pop(), [])
+        self.assertEqual((self.gaps.start_seq, self.gaps.end_seq), (1000, 1100))
+        self.tracker.expire(1101, 2001, gaps=self.gaps)
+        outages = self.gaps.pop()
+        self.assertEqual([(outage.start_seq, outage.end_seq) for outage in outages], [(1000, 1299)])
+        self.assertAlmostEqual(outages[0].offline_time, 0.3)
+
+    def test_gap_open_when_traffic_stops(self):
+        _send(self.tracker, 1, 2001, range(1900, 2001))
+        self.tracker.expire(1, 2001, gaps=self.gaps)
+        self.assertEqual(self.gaps.pop(), [])
+        self.gaps.finish()
+        outages = self.gaps.pop()
+        self.assertEqual([(outage.start_seq, outage.end_seq) for outage in outages], [(1900, 2000)])
+        self.assertIsNone(outages[0].resume_timestamp)
+        # Up to the last lost packet, plus its own gap
+        self.assertAlmostEqual(outages[0].offline_time, 0.101)
+
+    def test_overwritten_packets_are_lost(self):
+        tracker = InFlightTracker(1024)
+        _send(tracker, 1, 1025)
+        # Sequence 1025 takes the slot of 1
+        _send(tracker, 1025, 1026)
+        self.assertEqual(tracker.evicted, 1)
+        self.assertEqual(tracker.expire(1, 3, gaps=self.gaps)[:2], (2, 1))
+        self.assertEqual([(outage.start_seq, outage.end_seq) for outage in self.gaps.pop()], [(1, 1)])
+
+
+class AnalyzeResultsTest(SimpleTestCase):
+
+    def test_no_outages(self):
+        self.assertEqual(UDPTraffic("127.0.0.1", 9, 1000).analyze_results(), ([], 0))
+
+    def test_totals(self):
+        udp = UDPTraffic("127.0.0.1", 9, 1000)
+        tracker = InFlightTracker(4096)
+        gaps = GapDetector(GAP_NS, 0)
+        _send(tracker, 1, 3001, list(range(2000, 2100)) + list(range(500, 800)))
+        # Two intervals, outages closed in each go into the results as _put_stat() adds them
+        tracker.expire(1, 1501, gaps=gaps)
+        udp.outages.extend(gaps.pop())
+        tracker.expire(1501, 3001, gaps=gaps)
+        udp.outages.extend(gaps.pop())
+        # Found again by another shard, half overlapping the first one
+        udp.outages.append(Outage(5000, 5199, 0.65, 0.85, 0.2))
+        outages, offline = udp.analyze_results()
+        self.assertEqual([(outage.start_seq, outage.end_seq) for outage in outages],
+                         [(500, 799), (5000, 5199), (2000, 2099)])
+        # 0.5-0.85 and 2.0-2.1, the overlap counted once
+        self.assertAlmostEqual(offline, 0.45)
+
+
+class ReorderWindowTest(SimpleTestCase):
+
+    def setUp(self):
+        self.window = ReorderWindow(16)
+
+    def feed(self, sequences, in_flight=True):
+        for sequence in sequences:
+            self.window.record(sequence, in_flight)
+
+    def counts(self):
+        stats = self.window.pop_stats()
+        return stats["reordered_packets"], stats["duplicate_packets"], stats["late_packets"]
+
+    def test_in_order(self):
+        self.feed(range(1, 100))
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_reordered(self):
+        self.feed([1, 2, 4, 3, 8, 5])
+        stats = self.window.pop_stats()
+        self.assertEqual(stats["reordered_packets"], 2)
+        # Distance 1 in bucket 0, distance 3 in bucket 1
+        self.assertEqual(stats["reorder_distance"], [1, 1] + [0] * (REORDER_BUCKETS - 2))
+
+    def test_duplicates(self):
+        self.feed([1, 2, 2, 4, 3])
+        # The tracker no longer takes an echo it already matched
+        self.feed([3, 1], in_flight=False)
+        self.assertEqual(self.counts(), (1, 3, 0))
+
+    def test_late(self):
+        self.feed([1, 2, 3, 5])
+        # Behind the highest echo, first of its kind, but its packet expired already
+        self.feed([4], in_flight=False)
+        # Too far behind the highest echo to tell
+        self.feed([40, 20])
+        # Ahead of every echo, but evicted from an overfull tracker
+        self.feed([41], in_flight=False)
+        self.assertEqual(self.counts(), (0, 0, 3))
+
+    def test_reordered_across_wrap(self):
+        # 32 takes bit 0 of the ring, set by 16; skipping it clears the bit
+        self.feed(range(1, 32))
+        self.feed([33, 32])
+        stats = self.window.pop_stats()
+        self.assertEqual((stats["reordered_packets"], stats["duplicate_packets"]), (1, 0))
+        self.assertEqual(stats["reorder_distance"][0], 1)
+        # A jump of a whole window clears every bit: 45 takes the bit 13 set, and is no duplicate
+        self.feed([60, 45, 45])
+        stats = self.window.pop_stats()
+        self.assertEqual((stats["reordered_packets"], stats["duplicate_packets"]), (1, 1))
+        self.assertEqual(stats["reorder_distance"][3], 1)
+
+    def test_pop_stats_counts_since_last_call(self):
+        self.feed([1, 3, 2, 2])
+        self.assertEqual(self.counts(), (1, 1, 0))
+        self.assertEqual(self.counts(), (0, 0, 0))
+        self.feed([5, 4])
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+
+class RateProfileTest(SimpleTestCase):
+    # (spec, [(seconds since start, rate), ...]) around the edges of every segment
+    RATES = [
+        ({"type": "ramp", "start": 1000, "stop": 5000, "duration": 4},
+         [(-1, 1000), (0, 1000), (1, 2000), (3.999, 4999), (4, 5000), (100, 5000)]),
+        ({"type": "ramp", "start": 5000, "stop": 0, "duration": 10},
+         [(0, 5000), (5, 2500), (10, 0), (11, 0)]),
+        ({"type": "step", "start": 1000, "step": 1000, "every": 10, "stop": 2500},
+         [(0, 1000), (9.999, 1000), (10, 2000), (19.999, 2000), (20, 2500), (1000, 2500)]),
+        ({"type": "step", "start": 3000, "step": -1000, "every": 1},
+         [(0, 3000), (1, 2000), (2.5, 1000), (3, 0), (10, 0)]),
+        ({"type": "step", "start": 3000, "step": -1000, "every": 1, "stop": 1500},
+         [(1, 2000), (2, 1500), (5, 1500)]),
+        ({"type": "burst", "base": 100, "peak": 2000, "period": 10, "length": 0.5},
+         [(0, 2000), (0.499, 2000), (0.5, 100), (9.999, 100), (10, 2000), (10.5, 100)]),
+        ({"type": "sine", "mean": 1000, "amplitude": 500, "period": 4},
+         [(0, 1000), (1, 1500), (2, 1000), (3, 500), (4, 1000)]),
+        ({"type": "sine", "mean": 100, "amplitude": 500, "period": 4},
+         [(1, 600), (3, 0)]),
+        ({"type": "points", "points": [[10, 3000], [0, 1000], [20, 3000]]},
+         [(-1, 1000), (0, 1000), (5, 2000), (10, 3000), (15, 3000), (20, 3000), (30, 3000)]),
+        ({"type": "points", "points": [[0, 1000], [10, 3000], [20, 0]], "interpolate": False},
+         [(0, 1000), (9.999, 1000), (10, 3000), (19.999, 3000), (20, 0), (25, 0)]),
+        ({"type": "points", "points": [[0, 1000], [10, 3000]], "repeat": True},
+         [(5, 2000), (10, 1000), (15, 2000), (29.999, 2999.8)]),
+    ]
+    BAD = [
+        [1],
+        "{",
+        {"type": "zigzag"},
+        {"type": [1]},
+        {"type": "ramp", "start": 1000, "stop": 5000},
+        {"type": "ramp", "start": 1000, "stop": 5000, "duration": 0},
+        {"type": "ramp", "start": -1, "stop": 5000, "duration": 10},
+        {"type": "ramp", "start": "fast", "stop": 5000, "duration": 10},
+        {"type": "ramp", "start": 1000, "stop": float("inf"), "duration": 10},
+        {"type": "ramp", "start": 1000, "stop": float("nan"), "duration": 10},
+        {"type": "step", "start": 1000, "step": 1000, "every": 10},
+        {"type": "step", "start": 1000, "step": [1], "every": 1, "stop": 2000},
+        {"type": "step", "start": 1000, "step": 1000, "every": -1, "stop": 2000},
+        {"type": "burst", "base": 100, "peak": {}, "period": 10, "length": 1},
+        {"type": "burst", "base": 100, "peak": 2000, "period": 10, "length": 0},
+        {"type": "sine", "mean": 100, "amplitude": 50},
+        {"type": "points"},
+        {"type": "points", "points": []},
+        {"type": "points", "points": [[0]]},
+        {"type": "points", "points": [[0, "x"]]},
+        {"type": "points", "points": [[0, -5]]},
+        {"type": "points", "points": [[0, 1000]], "repeat": True},
+    ]
+
+    def test_rates(self):
+        for spec, rates in self.RATES:
+            profile = parse_profile(spec)
+            for t, rate in rates:
+                with self.subTest(spec=spec, t=t):
+                    self.assertAlmostEqual(profile.rate(t), rate, places=6)
+
+    def test_json_spec(self):
+        profile = parse_profile('{"type": "ramp", "start": 0, "stop": 100, "duration": 10}')
+        self.assertAlmostEqual(profile.rate(5), 50)
+        self.assertEqual(profile.peak(), 100)
+
+    def test_constant_rate(self):
+        for spec in (None, "", {}):
+            self.assertIsNone(parse_profile(spec))
+
+    def test_scaled(self):
+        profile = parse_profile({"type": "burst", "base": 100, "peak": 2000, "period": 10, "length": 1})
+        shard = profile.scaled(0.25)
+        self.assertAlmostEqual(shard.rate(0), 500)
+        self.assertAlmostEqual(shard.peak(), 500)
+        self.assertAlmostEqual(profile.rate(0), 2000)
+
+    def test_bad_specs(self):
+        for spec in self.BAD:
+            with self.subTest(spec=spec):
+                self.assertRaises(ValueError, parse_profile, spec)
+
+
+class MultiFlowTimestampingTest(SimpleTestCase):
+    """
+    A group with kernel timestamps must convert the CLOCK_REALTIME stamps its reader gets
+    with the engine's offset, or its latencies come out as the time since the epoch.
+    """
+
+    def run_group(self, timestamping):
+        server, port = _echo_server()
+        self.addCleanup(server.close)
+        udp = MultiFlowUDPTraffic([("127.0.0.1", port, 500, 1)])
+        udp.report_stats = False
+        udp.log.setLevel(logging.WARNING)
+        udp.timestamping = timestamping
+        udp.udp_port_range_start = 41000
+        udp.udp_port_range_stop = 41008
+        threading.Timer(2.5, udp.stop).start()
+        udp.start()
+        records = [record for record in udp.stat_queue.drain() if record["packets_receive"]]
+        self.assertTrue(records)
+        for record in records:
+            self.assertEqual(record["clock_source"], timestamping)
+            self.assertGreater(record["avg_latency"], 0)
+            self.assertLess(record["avg_latency"], 1)
+            self.assertLess(record["latency_max"], 1)
+
+    def test_kernel(self):
+        self.run_group(CLOCK_KERNEL)
+
+    def test_kernel_tx(self):
+        self.run_group(CLOCK_KERNEL_TX)
+
+
+class TxTimestampTest(SimpleTestCase):
+    """
+    Transmit stamps are collected by the reader on EPOLLERR, every acked packet must be timed
+    from its own stamp.
+    """
+
+    def test_every_packet_stamped(self):
+        server, port = _echo_server()
+        self.addCleanup(server.close)
+        udp = UDPTraffic("127.0.0.1", port, 500)
+        udp.report_stats = False
+        udp.log.setLevel(logging.WARNING)
+        udp.timestamping = CLOCK_KERNEL_TX
+        udp.udp_port_range_start = 41100
+        udp.udp_port_range_stop = 41108
+        threading.Timer(2.5, udp.stop).start()
+        with mock.patch.object(InFlightTracker, "stamp_sent", autospec=True,
+                               side_effect=InFlightTracker.stamp_sent) as stamp_sent:
+            udp.start()
+        self.assertEqual(udp.clock_source, CLOCK_KERNEL_TX)
+        self.assertGreater(udp.acked_packets, 0)
+        self.assertGreaterEqual(stamp_sent.call_count, udp.acked_packets)
+        records = [record for record in udp.stat_queue.drain() if record["packets_receive"]]
+        for record in records:
+            self.assertGreater(record["avg_latency"], 0)
+            self.assertLess(record["latency_max"], 1)
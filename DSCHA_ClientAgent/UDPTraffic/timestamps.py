@@ -0,0 +1,110 @@
+"""
+Kernel packet timestamps.
+
+With SO_TIMESTAMPNS the kernel stamps every received datagram when it reaches the socket, and
+recvmsg() hands the stamp over as ancillary data, so the receive time no longer includes the
+wait for the reader thread (and the GIL). With SO_TIMESTAMPING and SOF_TIMESTAMPING_TX_SOFTWARE
+the kernel also reports, on the socket's error queue, when a sent datagram left the stack,
+together with the datagram's number on that socket (SOF_TIMESTAMPING_OPT_ID) so a stamp can
+not be credited to the wrong packet.
+
+Kernel stamps are on CLOCK_REALTIME while the engine runs on the monotonic clock; realtime_offset()
+gives the difference to convert them. Linux only; elsewhere enabling fails and the engine keeps
+its user space clock.
+"""
+import time
+import struct
+import socket
+
+# Values from <asm-generic/socket.h> and <linux/net_tstamp.h>, not all exported by the socket module
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SO_TIMESTAMPING = getattr(socket, "SO_TIMESTAMPING", 37)
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_ID = 1 << 7
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+
+# struct timespec, and the three of struct scm_timestamping (software stamp first)
+_TIMESPEC = struct.Struct("@qq")
+# struct sock_extended_err, ee_data holds the OPT_ID counter of the stamped datagram
+_EXTENDED_ERR = struct.Struct("@IBBBBII")
+_IP_RECVERR = getattr(socket, "IP_RECVERR", 11)
+_IPV6_RECVERR = getattr(socket, "IPV6_RECVERR", 25)
+# Room for the ancillary data of one receive or one error queue read
+RX_CONTROL_SIZE = socket.CMSG_SPACE(_TIMESPEC.size) if hasattr(socket, "CMSG_SPACE") else 32
+TX_CONTROL_SIZE = 256
+
+# Clock sources reported in the stat records
+CLOCK_USER = "user"
+CLOCK_KERNEL = "kernel"
+CLOCK_KERNEL_TX = "kernel_tx"
+
+
+def realtime_offset():
+    """
+    :return: (integer) CLOCK_REALTIME minus the monotonic clock, in ns
+    """
+    return time.time_ns() - time.monotonic_ns()
+
+
+def enable_rx_timestamps(sock):
+    """
+    :param sock: (socket) UDP socket
+    :return: (boolean) True if the kernel will stamp datagrams received on sock
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError:
+        return False
+    return True
+
+
+def enable_tx_timestamps(sock):
+    """
+    :param sock: (socket) UDP socket
+    :return: (boolean) True if the kernel will report when datagrams sent on sock leave the stack
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+                        SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE |
+                        SOF_TIMESTAMPING_OPT_ID | SOF_TIMESTAMPING_OPT_TSONLY)
+    except OSError:
+        return False
+    return True
+
+
+def parse_rx_timestamp(ancdata):
+    """
+    :param ancdata: (list) Ancillary data from recvmsg()
+    :return: (integer) Kernel receive time in realtime ns, None if the datagram was not stamped
+    """
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= _TIMESPEC.size:
+            seconds, nanoseconds = _TIMESPEC.unpack_from(data)
+            return seconds * 10 ** 9 + nanoseconds
+    return None
+
+
+def read_tx_timestamp(sock):
+    """
+    Pop one transmit timestamp from the socket's error queue without blocking.
+    :param sock: (socket) Socket with TX timestamps enabled
+    :return: (tuple) (number of the datagram on the socket counting from 0, time it left the
+        stack in realtime ns), None if nothing was queued
+    """
+    try:
+        data, ancdata, flags, address = sock.recvmsg(0, TX_CONTROL_SIZE, MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return None
+    stamp = None
+    number = None
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPING and len(data) >= _TIMESPEC.size:
+            seconds, nanoseconds = _TIMESPEC.unpack_from(data)
+            stamp = seconds * 10 ** 9 + nanoseconds
+        elif kind in (_IP_RECVERR, _IPV6_RECVERR) and len(data) >= _EXTENDED_ERR.size:
+            number = _EXTENDED_ERR.unpack_from(data)[6]
+    if stamp is None or number is None:
+        return None
+    return number, stamp
@@ -0,0 +1,147 @@
+"""
+In-flight packet tracking.
+
+InFlightTracker replaces the {str(sequence): [send_time, ack_time, sock]} dictionary with a
+fixed-size ring indexed by sequence modulo capacity. Send times and measured latencies live
+in preallocated array('q') columns, so sending, acking and expiring a packet are O(1) and
+allocate nothing, and memory stays fixed for the whole run whatever the rate.
+"""
+from array import array
+
+# Bounds for the automatically sized ring, in slots
+MIN_CAPACITY = 1024
+MAX_CAPACITY = 2 ** 20
+
+
+def ring_capacity(packet_rate, seconds):
+    """
+    :param packet_rate: (integer) Packets per second
+    :param seconds: (integer) Seconds a packet stays in flight before it expires
+    :return: (integer) Power of two number of slots holding packet_rate * seconds packets
+    """
+    wanted = min(max(int(packet_rate * seconds), MIN_CAPACITY), MAX_CAPACITY)
+    capacity = MIN_CAPACITY
+    while capacity < wanted:
+        capacity *= 2
+    return capacity
+
+
+class InFlightTracker(object):
+    """
+    .. python::
+    Example Usage
+    tracker = InFlightTracker(ring_capacity(10000, 4))
+    tracker.sent(1, time.monotonic_ns())
+    tracker.ack(1, latency_ns)
+    sent, acked, latency_ns = tracker.expire(1, 2)
+    """
+
+    def __init__(self, capacity):
+        """
+        Constructor
+        :param capacity: (integer) Number of slots, rounded up to a power of two
+        :return: None
+        """
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.capacity = size
+        self.mask = size - 1
+        zeros = bytes(8 * size)
+        # Sequence owning each slot, 0 when the slot is free (sequences start at 1)
+        self.sequences = array("q", zeros)
+        self.send_ns = array("q", zeros)
+        # Round trip time, -1 until the echo comes back
+        self.latency_ns = array("q", [-1]) * size
+        # Packets overwritten before they expired because the ring was too small
+        self.evicted = 0
+
+    def sent(self, sequence, now):
+        """
+        Start tracking a packet.
+        :param sequence: (integer) Packet sequence number
+        :param now: (integer) Send time in monotonic ns
+        :return: None
+        """
+        slot = sequence & self.mask
+        if self.sequences[slot]:
+            self.evicted += 1
+        self.sequences[slot] = sequence
+        self.send_ns[slot] = now
+        self.latency_ns[slot] = -1
+
+    def stamp_sent(self, sequence, now):
+        """
+        Correct the send time of a packet, e.g. with the kernel's transmit timestamp.
+        :param sequence: (integer) Packet sequence number
+        :param now: (integer) Send time in monotonic ns
+        :return: None
+        """
+        slot = sequence & self.mask
+        if self.sequences[slot] == sequence:
+            self.send_ns[slot] = now
+
+    def ack_at(self, sequence, now):
+        """
+        Record the echo of a packet, measuring the round trip from the tracked send time.
+        :param sequence: (integer) Packet sequence number
+        :param now: (integer) Receive time in monotonic ns
+        :return: (boolean) True if the packet was in flight and not acked yet
+        """
+        slot = sequence & self.mask
+        if self.sequences[slot] != sequence:
+            return False
+        return self.ack(sequence, now - self.send_ns[slot])
+
+    def ack(self, sequence, latency):
+        """
+        Record the echo of a packet.
+        :param sequence: (integer) Packet sequence number
+        :param latency: (integer) Round trip time in ns
+        :return: (boolean) True if the packet was in flight and not acked yet
+        """
+        slot = sequence & self.mask
+        if self.sequences[slot] != sequence or self.latency_ns[slot] >= 0:
+            return False
+        self.latency_ns[slot] = latency
+        return True
+
+    def expire(self, first, stop, histogram=None, gaps=None):
+        """
+        Stop tracking the packets [first, stop) and summarise them.
+        :param first: (integer) First sequence number
+        :param stop: (integer) End of the sequence range (exclusive)
+        :param histogram: (LatencyHistogram) Optional histogram the latencies are recorded in
+        :param gaps: (GapDetector) Optional detector told where runs of lost packets start and end
+        :return: (tuple) (packets, acked packets, summed latency of the acked packets in ns)
+        """
+        acked = 0
+        latency = 0
+        mask = self.mask
+        sequences = self.sequences
+        send_ns = self.send_ns
+        latency_ns = self.latency_ns
+        in_gap = gaps is not None and gaps.is_open
+        # Last packet seen, lost packets overwritten in the ring take its send time
+        previous_ns = gaps.end_ns if in_gap else 0
+        for sequence in range(first, stop):
+            slot = sequence & mask
+            # A slot taken over by a newer packet counts as lost
+            if sequences[slot] == sequence:
+                previous_ns = send_ns[slot]
+                sequences[slot] = 0
+                if latency_ns[slot] >= 0:
+                    acked += 1
+                    latency += latency_ns[slot]
+                    if histogram is not None:
+                        histogram.record(latency_ns[slot])
+                    if in_gap:
+                        gaps.close(sequence - 1, previous_ns)
+                        in_gap = False
+                    continue
+            if gaps is not None and not in_gap:
+                gaps.open(sequence, previous_ns)
+                in_gap = True
+        if in_gap:
+            gaps.extend(stop - 1, previous_ns)
+        return stop - first, acked, latency
@@ -2,30 +2,181 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import time
+import select
+import socket
 import socketserver
+import multiprocessing
+
+from UDPTraffic.batchio import make_batch, MAX_DATAGRAM
+from UDPTraffic.packet import TRAILER, append_timestamps, server_clock_ns
+
+# Offset from the monotonic clock to the server clock the timestamps are taken with
+_CLOCK_OFFSET_NS = server_clock_ns() - time.monotonic_ns()
+
+
+def stamp_echo(buf, length, rx_ns):
+    """
+    Append the server receive and send timestamps to a datagram about to be echoed.
+    :param buf: (bytearray) Buffer holding the datagram
+    :param length: (integer) Length of the datagram
+    :param rx_ns: (integer) Monotonic ns time the datagram was received
+    :return: (integer) Length of the datagram to echo
+    """
+    if length + TRAILER.size > len(buf):
+        return length
+    return append_timestamps(buf, length, rx_ns + _CLOCK_OFFSET_NS, server_clock_ns())
 
 
 class MyUDPHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
-        data = self.request[0].strip()
+        # Echo the payload unchanged, it is binary
+        data = self.request[0]
         socket = self.request[1]
+        if self.server.timestamps:
+            rx_ns = time.monotonic_ns()
+            buf = bytearray(data)
+            buf.extend(bytes(TRAILER.size))
+            data = memoryview(buf)[:stamp_echo(buf, len(data), rx_ns)]
         socket.sendto(data, self.client_address)
 
 
 class UDPEchoServer(object):
+    # Seconds serve_forever() takes to notice stop()
+    POLL_INTERVAL = 0.05
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, timestamps=False):
 
         self.ip = ip
         self.port = port
+        # Append receive and send timestamps to every echo, see UDPTraffic.packet
+        self.timestamps = timestamps
         self.server = None
 
     def start(self):
 
         self.server = socketserver.UDPServer((self.ip, self.port), MyUDPHandler)
-        print("Start udp server %s:%s" % (self.ip, self.port))
-        self.server.serve_forever()
+        self.server.timestamps = self.timestamps
+        print("Start udp server %s:%s%s" % (self.ip, self.port, " with timestamps" if self.timestamps else ""))
+        try:
+            self.server.serve_forever(self.POLL_INTERVAL)
+        finally:
+            self.server.server_close()
+
+    def stop(self):
+        """
+        Stop serving, start() returns once the current echo is sent.
+        :return: None
+        """
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def _echo_worker(ip, port, batch_size, timestamps, stop_event, wakeup_fd, parent_pid):
+    """
+    Process target: echo datagrams on ip:port until stop_event is set. Every worker binds the
+    same address with SO_REUSEPORT and the kernel spreads the client flows over them.
+    :param ip: (string) Address to listen on
+    :param port: (integer) Port to listen on
+    :param batch_size: (integer) Datagrams per recvmmsg/sendmmsg call, 1 echoes packet by packet
+    :param timestamps: (boolean) Append receive and send timestamps to every echo
+    :param stop_event: (multiprocessing.Event) Set to stop the worker
+    :param wakeup_fd: (integer) Read end of a pipe that becomes readable when stop_event is set
+    :param parent_pid: (integer) The worker also stops once this process is gone, e.g. killed
+    :return: None
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((ip, port))
+    batch = make_batch(batch_size, MAX_DATAGRAM)
+    stamp = stamp_echo if timestamps else None
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLIN)
+    poller.register(wakeup_fd, select.POLLIN)
+    try:
+        while not stop_event.is_set() and os.getppid() == parent_pid:
+            # Wake up now and then to notice a killed parent
+            if not poller.poll(500):
+                continue
+            # Drain the socket, a short batch means it is empty
+            while batch.echo(sock, stamp=stamp) == batch.size:
+                pass
+    finally:
+        sock.close()
+
+
+class ReusePortEchoServer(object):
+    """
+    Echo server for high packet rates: several worker processes bound to the same ip:port
+    with SO_REUSEPORT, each echoing byte for byte from a reused buffer, optionally a whole
+    recvmmsg/sendmmsg batch per system call.
+
+    .. python::
+    Example Usage
+    server = ReusePortEchoServer('10.2.1.100', 11242, workers=4, batch_size=32)
+    server.start()  # Blocks until server.stop() is called from another thread
+    """
+
+    def __init__(self, ip, port, workers=None, batch_size=1, timestamps=False):
+        """
+        Constructor
+        :param ip: (string) The local IP address to listen on
+        :param port: (integer) The local port to listen on
+        :param workers: (integer) Number of worker processes, one per CPU when None
+        :param batch_size: (integer) Datagrams per recvmmsg/sendmmsg call
+        :param timestamps: (boolean) Append receive and send timestamps to every echo
+        :return: None
+        """
+        self.ip = ip
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.timestamps = timestamps
+        self.processes = []
+        self.stop_event = multiprocessing.Event()
+        self._wakeup = None
+
+    def start(self):
+        """
+        Start the workers and wait for them to exit.
+        :return: None
+        """
+        self.stop_event.clear()
+        self.processes = []
+        # Written to by stop() so the workers leave poll() at once
+        self._wakeup = os.pipe()
+        for i in range(self.workers):
+            process = multiprocessing.Process(target=_echo_worker,
+                                              args=(self.ip, self.port, self.batch_size, self.timestamps,
+                                                    self.stop_event, self._wakeup[0], os.getpid()))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        print("Start udp server %s:%s, %d SO_REUSEPORT workers, batch size %d" %
+              (self.ip, self.port, self.workers, self.batch_size))
+        for process in self.processes:
+            process.join()
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
+
+    def stop(self):
+        """
+        Stop the workers.
+        :return: None
+        """
+        # Wake the workers first: they only exit, and start() only closes the pipe, once
+        # stop_event is set
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"\0")
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(2)
+            if process.is_alive():
+                process.terminate()
 
 
 # import socket
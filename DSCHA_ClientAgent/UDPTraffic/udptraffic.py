@@ -13,23 +13,38 @@ It provides both the server and client which are both intended to run on CS1. If
 helper methods (setup_bigIP and cleanup_bigip) can be used to configure the pool, node, and
 virtual server to process the UDP traffic.
 
-Sent UDP packets contain a sequence ID. The server uses the received sequence ID's to determine
-what packets were dropped. The UDP source port will change for each sent packet to help distribute
+Sent UDP packets carry a binary header (see UDPTraffic.packet) with the flow id, sequence ID and
+send time. The client uses the echoed sequence ID's to determine what packets were dropped and
+the echoed send time to measure latency. The UDP source port will change for each sent packet to help distribute
 the load across TMMs.
 
 For questions, comments, enhancements, or general tips at being awesome, email robz@f5.com
 """
+import os
 import sys
 import time
-import errno
 import threading
 import select
-import configparser
-import requests
 import socket
+import configparser
 import datetime
-import multiprocessing
+import tempfile
+import collections
 from global_var import *
+from UDPTraffic.socketpool import UDPSocketPool
+from UDPTraffic.batchio import make_batch, MMsgBatch, HAVE_MMSG, MAX_DATAGRAM
+from UDPTraffic.pacer import TokenBucketPacer
+from UDPTraffic.rateprofile import RATE_STEP_NS
+from UDPTraffic.tracker import InFlightTracker, ring_capacity
+from UDPTraffic.packet import PacketBuilder, parse_header, parse_timestamps
+from UDPTraffic.clocksync import ClockOffsetEstimator
+from UDPTraffic.timestamps import CLOCK_USER, CLOCK_KERNEL, CLOCK_KERNEL_TX, SO_TIMESTAMPNS, RX_CONTROL_SIZE, \
+    enable_rx_timestamps, enable_tx_timestamps, parse_rx_timestamp, read_tx_timestamp, realtime_offset
+from UDPTraffic.histogram import LatencyHistogram
+from UDPTraffic.reporter import StatReporter
+from UDPTraffic.statqueue import StatQueue
+from UDPTraffic.outage import GapDetector, offline_time
+from UDPTraffic.reorder import ReorderWindow
 
 
 class UDPPacket(object):
@@ -62,8 +77,16 @@ class UDPTraffic(object):
        print missing.end_seq    # The last packet ID dropped
        print missing.last_timestamp # Timestamp of the first missing packet
        print missing.resume_timestamp # Timestamp of when traffic resumed
+       print missing.offline_time # Seconds without traffic
     """
-    MAX_SEQUENCE = 2 ** 31 - 1
+    MAX_SEQUENCE = 2 ** 63 - 1
+    # IPv4 and UDP headers carried by every datagram on top of its payload
+    WIRE_OVERHEAD = 20 + 8
+    # Smallest recvmmsg batch the reader drains sockets with
+    READ_BATCH = 8
+    # Sent packets per socket still waiting for their transmit stamp. Stamps come back within
+    # microseconds; the ones older than this many packets are taken as lost.
+    TX_PENDING = 4096
 
     def __init__(self, destination_ip, destination_port, packet_rate):
         """
@@ -80,20 +103,112 @@ class UDPTraffic(object):
 
         self.report_stat_thread = None
         self.client_read_thread = None
-        self.epoll_obj = select.epoll()
+        # Created by start(), so an engine that never runs holds no fd
+        self.epoll_obj = None
+        self.socket_pool = None
         self.connections = {}
+        # Datagrams per sendmmsg/recvmmsg call. 1 keeps the per-packet sendto/recv path; with
+        # batching each batch leaves from one source port and the next batch from the next one.
+        self.batch_size = 1
+        self.send_batch = None
+        self.recv_batch = None
+        # Packets that may go out back to back when the sender falls behind its schedule
+        self.pacing_burst = 8
+        self.pacer = None
         self.client_read_timeout = 2
+        # On stop, echoes are awaited until every packet is acked, none arrived for
+        # stop_drain_idle seconds or client_read_timeout passed
+        self.stop_drain_idle = 0.05
+        # Longest the reader blocks in epoll, and the most events it takes per wakeup
+        self.read_poll_timeout = 0.1
+        self.read_max_events = 1024
+        # Echoes and echoed payload bytes read, and CPU time the reader thread spent
+        self.received_packets = 0
+        self.received_bytes = 0
+        self.reader_cpu_ns = 0
+        # Packets sent and acked in the whole run, and when the last echo arrived
+        self.sent_packets = 0
+        self.acked_packets = 0
+        self._last_reply_ns = 0
+        # Echoes stamped by the server (see UDPEchoServer timestamps), the summed raw forward
+        # and return times (offset by the clock difference) and the summed server dwell time
+        self.server_samples = 0
+        self.forward_raw_ns = 0
+        self.return_raw_ns = 0
+        self.server_dwell_ns = 0
+        self.clock_offset = None
+        # Where send and receive times come from: CLOCK_USER (the engine reads the clock),
+        # CLOCK_KERNEL (SO_TIMESTAMPNS receive stamps) or CLOCK_KERNEL_TX (also SO_TIMESTAMPING
+        # transmit stamps, per-packet sending only). clock_source is what start() could enable.
+        self.timestamping = CLOCK_USER
+        self.clock_source = CLOCK_USER
+        self._realtime_offset = 0
+        self._sent_sequence = None
+        # Datagrams sent per socket fd, to match transmit stamps to packets, and per fd the
+        # (datagram number, sender, sequence) of the packets whose stamp the reader awaits
+        self._tx_counts = {}
+        self._tx_expected = {}
         self.lock = threading.RLock()
         self.sending_client_data = False
+        # stop() may come before start() got going, start() then returns at once
+        self._stop_requested = False
+        # Set while not running, and once the last stats of the run were queued
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._flushed = threading.Event()
+        # Pipe registered with epoll_obj to wake the reader up on stop
+        self._wakeup = None
         self.read_client_data = False
         self.udp_port_range_start = 20000
         self.udp_port_range_stop = 40000
-        self.current_port = self.udp_port_range_start
+        # Sequence numbers used by this sender, wrapping from sequence_stop back to
+        # sequence_start. Shards get disjoint ranges so sequences stay globally unique.
+        self.sequence_start = 1
+        self.sequence_stop = self.MAX_SEQUENCE
         self.packet_sequence = 1
+        # Flow id stamped into every packet; echoes carrying another flow id are not ours
+        self.flow_id = 0
+        # Payload size in bytes, or a fixed, uniform or weighted (e.g. IMIX) size spec, see
+        # packet.parse_payload_size(); packets are zero padded beyond the header
+        self.payload_size = 0
+        self.packet_builder = None
+        # Echoes that were too short, corrupted or belong to another flow
+        self.bad_packets = 0
+        # Monotonic ns time the one second stat intervals are aligned to (None: start time).
+        # Each stat record carries the index of its interval so shards can be merged.
+        self.interval_origin = None
+        # Post stats to the controller; shards leave this to the process that merges them
+        self.report_stats = True
         self.report_timer = time.time()
+        # Seconds between posts, and where batches wait while the controller is unreachable
+        # (None: a directory per controller_app_id under the system temp directory)
+        self.report_interval = 5
+        self.spool_dir = None
+        # Also keeps every posted batch on the agent, e.g. app.statstore.StatStore
+        self.stat_store = None
+        self.reporter = None
         self.packet_rate = packet_rate
-        self.udp_data_dictionary = {}
-        self.stat_queue = multiprocessing.Queue()
+        # RateProfile the pacer follows instead of the constant packet_rate (see rateprofile)
+        self.rate_profile = None
+        # Packets the pacer was set to send in the current interval, counted up to
+        # _rate_updated at _target_rate, for target_pps
+        self._target_packets = 0.0
+        self._target_rate = 0
+        self._rate_updated = 0
+        # Ring of in-flight packets, sized from the peak rate at start() unless set here
+        self.tracker_capacity = None
+        self.tracker = None
+        # Runs of lost packets, found as packets expire, and every outage of the run
+        self.gaps = None
+        self.outages = []
+        # Echoes that came back out of order, twice or after their packet expired
+        self.reorder = None
+        # Latencies of the interval being expired, reported as percentiles
+        self.latency_histogram = LatencyHistogram()
+        # Also put the histogram itself, in compact form, in every stat record
+        self.ship_histogram = False
+        # Stat records for the reporting thread; shards get a SharedStatRing from their parent
+        self.stat_queue = StatQueue()
         self.controller_app_id = None
 
         # Configure logging
@@ -105,10 +220,12 @@ class UDPTraffic(object):
             import logging
             self._log = logging.getLogger("udp_traffic.log")
             self._log.setLevel(logging.INFO)
-            log_handler = logging.StreamHandler(sys.stdout)
-            log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s| %(message)s",
-                                                       datefmt="%H:%M:%S"))
-            self._log.addHandler(log_handler)
+            # The logger is shared by every instance (and inherited by forked shards)
+            if not self._log.handlers:
+                log_handler = logging.StreamHandler(sys.stdout)
+                log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s| %(message)s",
+                                                           datefmt="%H:%M:%S"))
+                self._log.addHandler(log_handler)
 
     def __enter__(self):
         """
@@ -137,16 +254,49 @@ class UDPTraffic(object):
     def start(self):
         """
         Start sending UDP traffic to the previously configured destination.
-         Packets are sent as fast as possible. If throttling is desired,
-         set self.packet_pause to the number of seconds to pause between sends.
+         Packets are spaced evenly at packet_rate per second. Set self.pacing_burst to let
+         the sender catch up with short bursts when it falls behind. Returns once stop() was
+         called and the stats of the last packets are queued.
         """
+        self._stopped.clear()
+        if self._stop_requested:
+            # stop() came first
+            self._stopped.set()
+            return
+        self._flushed.clear()
+        self.sending_client_data = True
 
-        # Clear out our dictionary of results
-        # dict data structure {<data>: (<packet obj>, <send time>, <ack time>)}
-        self.udp_data_dictionary = {}
-        self.connections = {}
+        # Packets stay tracked for client_read_timeout seconds plus the interval they were sent in
+        self.tracker = InFlightTracker(self.tracker_capacity or
+                                       ring_capacity(self._peak_rate(), self.client_read_timeout + 2))
+        # A batch is built before it is sent, so each of its packets needs a buffer of its own
+        self.packet_builder = PacketBuilder(self.flow_id, self.payload_size, self.batch_size)
+        self._reset_counters()
+        self.epoll_obj = select.epoll()
+        # Bind every source port once; the sockets stay registered with epoll for the whole run
+        self.socket_pool = UDPSocketPool(self.udp_port_range_start, self.udp_port_range_stop,
+                                         self.epoll_obj)
+        self.socket_pool.open()
+        self.connections = self.socket_pool.connections
+        self.log.info("Socket pool: %(pool_sockets)s sockets, %(open_fds)s fds open, "
+                      "fd limit %(fd_limit)s" % self.socket_pool.fd_usage())
+        if self.batch_size > 1 and HAVE_MMSG:
+            self.send_batch = make_batch(self.batch_size)
+            self.log.info("Batched I/O: %d datagrams per sendmmsg/recvmmsg" % self.batch_size)
+        else:
+            self.send_batch = None
+        # The reader drains with recvmmsg whenever it exists: a short batch tells it the socket
+        # is empty, where a recv() loop pays an extra failing call per socket to find out.
+        self.clock_source = self._enable_timestamping()
+        if not HAVE_MMSG:
+            self.recv_batch = None
+        elif self.clock_source == CLOCK_USER:
+            self.recv_batch = make_batch(max(self.batch_size, self.READ_BATCH))
+        else:
+            self.recv_batch = MMsgBatch(max(self.batch_size, self.READ_BATCH), MAX_DATAGRAM, RX_CONTROL_SIZE)
+        self._wakeup = os.pipe()
+        self.epoll_obj.register(self._wakeup[0], select.EPOLLIN)
         # Start the client thread
-        self.sending_client_data = True
         self.read_client_data = True
         # self.client_thread = threading.Thread(target=self._send_client_traffic)
         # self.client_thread.daemon = True
@@ -154,185 +304,675 @@ class UDPTraffic(object):
         self.client_read_thread = threading.Thread(target=self._read_server_msg)
         self.client_read_thread.daemon = True
         self.client_read_thread.start()
-        self.report_stat_thread = threading.Thread(target=self._report_stat)
-        self.report_stat_thread.start()
-        self._send_client_traffic()
+        if self.report_stats:
+            self.report_stat_thread = threading.Thread(target=self._report_stat)
+            self.report_stat_thread.start()
+        try:
+            self._send_client_traffic()
+        finally:
+            self._finish()
 
     def stop(self):
         """
-        Stop sending traffic.
+        Stop sending traffic and wait until the echoes of the last packets are in and their
+        stats are queued. Thread safe, returns within milliseconds when the echoes are.
         :return: None
         """
-        if self.sending_client_data:
-            self.sending_client_data = False
-        time.sleep(self.client_read_timeout)
+        self._stop_requested = True
+        self.sending_client_data = False
+        if self.pacer is not None:
+            self.pacer.interrupt()
+        if not self._stopped.wait(self.client_read_timeout + 5):
+            self.log.warning("Traffic did not stop in %d seconds" % (self.client_read_timeout + 5))
+        if self.epoll_obj is not None:
+            self.epoll_obj.close()
+
+    def _finish(self):
+        """
+        Private method
+        Wind the run down once the sender stopped: wait for the last echoes, queue the stats
+        of every interval not reported yet, stop the reader and the reporter and close the
+        sockets.
+        :return: None
+        """
+        stop_ns = time.monotonic_ns()
+        self._end_sending(stop_ns)
+        now = stop_ns
+        while self._draining(stop_ns, now):
+            time.sleep(0.001)
+            now = time.monotonic_ns()
+        self._flush_intervals(now)
         self.read_client_data = False
+        os.write(self._wakeup[1], b"\0")
+        self.client_read_thread.join(self.read_poll_timeout + 1)
+        self._finish_reporting()
+        self.socket_pool.close()
         self.epoll_obj.close()
+        for fd in self._wakeup:
+            os.close(fd)
+        self.log.info("Traffic stopped, %d of %d packets acked, %.1f ms after the last send" %
+                      (self.acked_packets, self.sent_packets, (time.monotonic_ns() - stop_ns) / 10 ** 6))
+        self._stopped.set()
 
-    def _send_client_traffic(self):
+    def _draining(self, stop_ns, now):
         """
         Private method
-        This is the thread which sends traffic. It will operate until self.sending_client_data is
-        set to False by UDPTraffic.stop(). Each packet will be sent from a new source port to
-        help distribute load across TMMs.
+        :param stop_ns: (integer) Monotonic ns time the last packet was sent
+        :param now: (integer) Monotonic ns time
+        :return: (boolean) True while echoes of the packets sent may still come back
+        """
+        if self.acked_packets >= self.sent_packets or now - stop_ns >= self.client_read_timeout * 10 ** 9:
+            return False
+        return now - max(self._last_reply_ns, stop_ns) < self.stop_drain_idle * 10 ** 9
+
+    def _flush_intervals(self, now):
+        """
+        Private method
+        Close the current, partial interval and put the stat record of every interval not
+        reported yet on stat_queue, oldest first. Their packets expire now, whatever their age.
+        :param now: (integer) Monotonic ns time sending stopped
         :return: None
         """
-        self.packet_sequence = 1
-        self.current_port = self.udp_port_range_start
+        if self.sent_packets and now > self._interval_start:
+            self._close_interval(now)
+        slots = self.client_read_timeout + 1
+        check_pt = self._check_pt % slots if self._check_pt is not None else 0
+        while check_pt != self._cur_pt:
+            # An outage still open ends with the run and goes into the last record
+            self._put_stat(check_pt, (check_pt + 1) % slots == self._cur_pt)
+            check_pt = (check_pt + 1) % slots
+        self._check_pt = None
+        self._cur_pt = 0
+        self.gaps.finish()
+        self.outages.extend(self.gaps.pop())
+
+    def analyze_results(self):
+        """
+        Outages of the run so far, complete once start() returned.
+        :return: (tuple) (list of Outage, oldest first, total offline time in seconds)
+        """
+        outages = sorted(self.outages, key=lambda outage: outage.last_timestamp)
+        return outages, offline_time(outages)
 
-        check_list = [[] for i in range(self.client_read_timeout+1)]
-        cur_pt = 0
-        check_pt = None
+    def _finish_reporting(self):
+        """
+        Private method
+        Let the reporting thread post the last stats and wait for it.
+        :return: None
+        """
+        self._flushed.set()
+        if self.report_stat_thread is not None:
+            self.report_stat_thread.join(sum(StatReporter.TIMEOUT))
 
+    def _send_client_traffic(self):
+        """
+        Private method
+        This is the thread which sends traffic. It will operate until self.sending_client_data is
+        set to False by UDPTraffic.stop(). Each packet will be sent from the next socket of the
+        source port pool to help distribute load across TMMs.
+        :return: None
+        """
         self.log.info("Starting client traffic thread")
         self.log.info("Traffic destination: %s:%d" % (self.destination_ip,
                                                       self.destination_port))
-        current_time = time.time()
+        # Packets are spaced evenly over each second by the pacer; stats close every second
+        self.pacer = TokenBucketPacer(self.packet_rate, self.pacing_burst)
+        self._reset_intervals()
+        destination = (self.destination_ip, self.destination_port)
         # Send packets until the main thread tells us to stop.
-        packet_count = 0
         while self.sending_client_data is True:
+            count = 1 if self.send_batch is None else self.batch_size
+            if self.pacer.wait(count, min(self._next_interval, self._next_rate_update)):
+                sock = self.socket_pool.next_socket()
+                if self.send_batch is None:
+                    packet = self._next_packet()
+                    if self.clock_source == CLOCK_KERNEL_TX:
+                        self._expect_tx_timestamp(sock)
+                    sock.sendto(packet, 0, destination)
+                else:
+                    self.send_batch.send(sock, [self._next_packet() for i in range(count)], destination)
 
-            while time.time() - current_time < 1:
-                if packet_count >= self.packet_rate:
-                    break
+            now = time.monotonic_ns()
+            if now >= self._next_rate_update:
+                self._update_rate(now)
+            if now >= self._next_interval:
+                self._close_interval(now)
 
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                # Send from the specified source port
-                try:
-                    sock.bind(('0.0.0.0', self.current_port))
-                except socket.error as err:
-
-                    # IP/port combo currently in use, skip it.
-                    if err == errno.EADDRINUSE:
-                        self.log.error("Source port (%d) in use - skipping." %
-                                       self.current_port)
-                        sock.close()
-                        self.current_port += 1
-
-                        # Wrap the UDP source port
-                        if self.current_port == self.udp_port_range_stop:
-                            self.current_port = self.udp_port_range_start
-
-                        # Jump back to the top of the loop, skipping the send/pause logic
-                        continue
-                    else:
-                        raise
-
-                self.udp_data_dictionary[str(self.packet_sequence)] = [time.time(), None, sock]
-                # Register this socket to epoll
-                self.epoll_obj.register(sock.fileno(), select.EPOLLIN)
-                # Update connections dict
-                self.connections[sock.fileno()] = sock
-                # Packet is a stringified version of the current sequence number
-                sock.sendto(bytes(str(self.packet_sequence), "utf-8"),
-                            0, (self.destination_ip, self.destination_port))
-                check_list[cur_pt].append(str(self.packet_sequence))
-
-                self.packet_sequence += 1
-                self.current_port += 1
-
-                # Wrap the UDP source port
-                if self.current_port == self.udp_port_range_stop:
-                    self.current_port = self.udp_port_range_start
-
-                # Wrap the sequence number
-                if self.packet_sequence > self.MAX_SEQUENCE:
-                    self.packet_sequence = 1
-
-                packet_count += 1
-
-            time.sleep(.001)
-
-            if time.time() - current_time >= 1:
-                cur_pt += 1
-                if check_pt is None and cur_pt < self.client_read_timeout + 1:
-                    pass
-                else:
-                    if cur_pt == self.client_read_timeout + 1:
-                        cur_pt = 0
-                    if check_pt is None or check_pt == self.client_read_timeout + 1:
-                        check_pt = 0
-                    latency = 0.0
-                    check_pkt_count = 0
-                    drop_packet = 0
-                    avg_latency = -1
-                    total_bits = 0
-                    self.log.debug("=========Check Data=======")
-                    self.log.debug(check_list[check_pt])
-                    self.log.debug("=========Check Dict=======")
-                    self.log.debug(self.udp_data_dictionary)
-                    for data in check_list[check_pt]:
-                        total_bits += sys.getsizeof(data)
-                        if self.udp_data_dictionary[data][1] is None:
-                            drop_packet += 1
-                        else:
-                            latency += self.udp_data_dictionary[data][1] - self.udp_data_dictionary[data][0]
-                            check_pkt_count += 1
-                        dict_socket = self.udp_data_dictionary[data][2]
-                        del self.udp_data_dictionary[data]
-                        self.epoll_obj.unregister(dict_socket.fileno())
-                        del self.connections[dict_socket.fileno()]
-                        dict_socket.close()
-                    if check_pkt_count != 0:
-                        avg_latency = latency/check_pkt_count
-                    self.log.info("====================STAT===================")
-                    # self.log.info("Total bytes sent: %s" % total_bits)
-                    self.log.info("Total packets sent: %s" % len(check_list[check_pt]))
-                    # self.log.info("Total packets received: %s" %
-                    #               (len(check_list[check_pt]) - drop_packet))
-                    self.log.info("Total drop packets: %s" % drop_packet)
-                    self.log.info("Average latency: %.4F" % avg_latency)
-                    self.stat_queue.put({"app_id": self.controller_app_id,
-                                         "byte_sent": total_bits,
-                                         "packets_sent": len(check_list[check_pt]),
-                                         "packets_receive": len(check_list[check_pt]) - drop_packet,
-                                         "drop_packets": drop_packet,
-                                         "avg_latency": avg_latency,
-                                         "pkt_time": str(datetime.datetime.now())})
-                    check_list[check_pt] = []
-                    check_pt += 1
-                current_time = time.time()
-                packet_count = 0
-
-        time.sleep(.001)
+    def _enable_timestamping(self):
+        """
+        Private method
+        Turn on the kernel timestamps self.timestamping asks for on every pool socket.
+        :return: (string) The clock source in use, CLOCK_USER when the kernel does not cooperate
+        """
+        if self.timestamping == CLOCK_USER:
+            return CLOCK_USER
+        sockets = self.socket_pool.sockets
+        if not all([enable_rx_timestamps(sock) for sock in sockets]):
+            self.log.warning("SO_TIMESTAMPNS is not available, timing packets in user space")
+            return CLOCK_USER
+        if self.timestamping != CLOCK_KERNEL_TX:
+            return CLOCK_KERNEL
+        if self.batch_size > 1:
+            self.log.warning("Transmit timestamps need batch_size 1, using receive timestamps only")
+            return CLOCK_KERNEL
+        if not all([enable_tx_timestamps(sock) for sock in sockets]):
+            self.log.warning("SO_TIMESTAMPING is not available, using receive timestamps only")
+            return CLOCK_KERNEL
+        self._tx_counts = {}
+        self._tx_expected = {}
+        # The stamps raise EPOLLERR, the reader collects them there instead of the sender
+        for sock in sockets:
+            self._tx_expected[sock.fileno()] = collections.deque(maxlen=self.TX_PENDING)
+            self.epoll_obj.modify(sock.fileno(), select.EPOLLIN | select.EPOLLERR)
+        return CLOCK_KERNEL_TX
+
+    def _expect_tx_timestamp(self, sock):
+        """
+        Private method
+        Note the packet about to be sent, so the reader takes its transmit stamp as its send
+        time. Called before sendto(), the stamp may reach the reader before sendto() returns.
+        :param sock: (socket) Socket the packet is sent from
+        :return: None
+        """
+        fd = sock.fileno()
+        number = self._tx_counts.get(fd, 0)
+        self._tx_counts[fd] = number + 1
+        self._tx_expected[fd].append((number, self, self._sent_sequence))
+
+    def _drain_tx_timestamps(self, sock):
+        """
+        Private method
+        Read every transmit stamp queued on a socket's error queue and hand each to the sender
+        of its packet. Packets whose stamp never came keep their user space send time.
+        :param sock: (socket) A pool socket with EPOLLERR raised
+        :return: None
+        """
+        expected = self._tx_expected.get(sock.fileno())
+        while True:
+            stamp = read_tx_timestamp(sock)
+            if stamp is None or expected is None:
+                return
+            number, stamp_ns = stamp
+            while expected and expected[0][0] < number:
+                expected.popleft()
+            if expected and expected[0][0] == number:
+                number, sender, sequence = expected.popleft()
+                sender.tracker.stamp_sent(sequence, stamp_ns - self._realtime_offset)
+
+    def _reset_counters(self):
+        """
+        Private method
+        Zero the counters the receive path maintains, before it starts.
+        :return: None
+        """
+        self.bad_packets = 0
+        self.received_packets = 0
+        self.received_bytes = 0
+        self.reader_cpu_ns = 0
+        self.sent_packets = 0
+        self.acked_packets = 0
+        self._last_reply_ns = 0
+        self.server_samples = 0
+        self.forward_raw_ns = 0
+        self.return_raw_ns = 0
+        self.server_dwell_ns = 0
+        self.clock_offset = ClockOffsetEstimator()
+        self.gaps = GapDetector(int(10 ** 9 // max(self._peak_rate(), 1)), realtime_offset())
+        self.outages = []
+        self.reorder = ReorderWindow(self.tracker.capacity)
+
+    def _reset_intervals(self):
+        """
+        Private method
+        Reset the sequence number and the per-interval bookkeeping before sending starts.
+        The engines only differ in how packets move; sent packets go through _next_packet(),
+        echoes through _handle_reply() and every second ends with _close_interval(), so every
+        engine produces the same stat records.
+        :return: None
+        """
+        self.packet_sequence = self.sequence_start
+        slots = self.client_read_timeout + 1
+        # [first, stop) sequence ranges and bytes sent in each of the last client_read_timeout+1 intervals
+        self._check_list = [[] for i in range(slots)]
+        self._check_bytes = [0] * slots
+        self._interval_stats = [{} for i in range(slots)]
+        self._cur_pt = 0
+        self._check_pt = None
+        # Counter values at the start of the current interval
+        self._bad_packets_mark = self.bad_packets
+        self._received_mark = self.received_packets
+        self._received_bytes_mark = self.received_bytes
+        self._reader_cpu_mark = self.reader_cpu_ns
+        self._server_marks = (0, 0, 0, 0)
+        self._packet_count = 0
+        self._interval_start = time.monotonic_ns()
+        self._realtime_offset = realtime_offset()
+        self._origin = self.interval_origin if self.interval_origin is not None else self._interval_start
+        self._interval = max((self._interval_start - self._origin) // 10 ** 9, 0)
+        self._next_interval = self._origin + (self._interval + 1) * 10 ** 9
+        # The profile's clock starts with the first packet
+        self._profile_start = self._interval_start
+        self._rate_updated = self._interval_start
+        self._target_packets = 0.0
+        self._update_rate(self._interval_start)
+
+    def _peak_rate(self):
+        """
+        Private method
+        :return: (number) Highest packet rate of the run, what buffers are sized for
+        """
+        if self.rate_profile is None:
+            return self.packet_rate
+        return max(self.packet_rate, self.rate_profile.peak())
+
+    def _update_rate(self, now):
+        """
+        Private method
+        Set the pacer to the rate profile's rate at now, and schedule the next update
+        RATE_STEP_NS later. Without a profile the pacer keeps packet_rate.
+        :param now: (integer) Monotonic ns time
+        :return: (boolean) True if the rate changed
+        """
+        self._count_target(now)
+        if self.rate_profile is None:
+            self._target_rate = self.pacer.rate
+            self._next_rate_update = float("inf")
+            return False
+        self._next_rate_update = now + RATE_STEP_NS
+        rate = self.rate_profile.rate((now - self._profile_start) / 10 ** 9)
+        self._target_rate = rate
+        if rate == self.pacer.rate:
+            return False
+        self.pacer.set_rate(rate, now)
+        return True
+
+    def _count_target(self, now):
+        """
+        Private method
+        Add the packets due at the target rate since the last count to the interval's.
+        :param now: (integer) Monotonic ns time
+        :return: None
+        """
+        self._target_packets += self._target_rate * (now - self._rate_updated) / 10 ** 9
+        self._rate_updated = now
+
+    def _end_sending(self, stop_ns):
+        """
+        Private method
+        Stop counting target packets once the sender stopped, so the wait for the last
+        echoes does not lower the last interval's achieved rate against its target.
+        :param stop_ns: (integer) Monotonic ns time the sender stopped
+        :return: None
+        """
+        self._count_target(stop_ns)
+        self._target_rate = 0
+
+    def _close_interval(self, now):
+        """
+        Private method
+        Close the current one second interval, and once an interval is client_read_timeout
+        seconds old, expire its packets and put its stat record on stat_queue.
+        :param now: (integer) Monotonic ns time, at or past the end of the interval
+        :return: None
+        """
+        cur_pt = self._cur_pt
+        interval_stats = self.pacer.pop_stats()
+        interval_stats["achieved_pps"] = self._packet_count * 10 ** 9 / (now - self._interval_start)
+        self._count_target(now)
+        interval_stats["target_pps"] = self._target_packets * 10 ** 9 / (now - self._interval_start)
+        self._target_packets = 0.0
+        interval_stats["interval"] = self._interval
+        interval_stats["clock_source"] = self.clock_source
+        interval_stats["bad_packets"] = self.bad_packets - self._bad_packets_mark
+        self._bad_packets_mark = self.bad_packets
+        interval_stats["reader_cpu_per_packet_us"] = -1
+        if self.received_packets > self._received_mark and self.reader_cpu_ns is not None:
+            interval_stats["reader_cpu_per_packet_us"] = \
+                (self.reader_cpu_ns - self._reader_cpu_mark) / (self.received_packets - self._received_mark) / 1000
+        interval_stats.update(self._throughput(now))
+        interval_stats.update(self._server_latency())
+        interval_stats.update(self.reorder.pop_stats())
+        self._received_mark = self.received_packets
+        self._reader_cpu_mark = self.reader_cpu_ns
+        self._interval_stats[cur_pt] = interval_stats
+        self.log.info("Achieved rate: %.1f pps (target %.1f), %.3f Mbps on the wire, pacing error %.1f us "
+                      "(target gap %.1f us)" %
+                      (interval_stats["achieved_pps"],
+                       interval_stats["target_pps"],
+                       interval_stats["wire_bps_sent"] / 10 ** 6,
+                       interval_stats["pacing_error_us"],
+                       interval_stats["target_gap_us"]))
+        if interval_stats["reordered_packets"] or interval_stats["duplicate_packets"] or \
+                interval_stats["late_packets"]:
+            self.log.info("Echoes reordered: %d, duplicated: %d, late: %d" %
+                          (interval_stats["reordered_packets"], interval_stats["duplicate_packets"],
+                           interval_stats["late_packets"]))
+        cur_pt += 1
+        if self._check_pt is None and cur_pt < self.client_read_timeout + 1:
+            pass
+        else:
+            if cur_pt == self.client_read_timeout + 1:
+                cur_pt = 0
+            if self._check_pt is None or self._check_pt == self.client_read_timeout + 1:
+                self._check_pt = 0
+            self._put_stat(self._check_pt)
+            self._check_pt += 1
+        self._cur_pt = cur_pt
+
+        self._interval_start = now
+        # Follow clock adjustments for the conversion of kernel timestamps
+        self._realtime_offset = realtime_offset()
+        self._interval += 1
+        self._next_interval += 10 ** 9
+        if self._next_interval <= now:
+            # Fell more than a second behind, skip to the current interval
+            self._interval = (now - self._origin) // 10 ** 9
+            self._next_interval = self._origin + (self._interval + 1) * 10 ** 9
+        self._packet_count = 0
+
+    def _throughput(self, now):
+        """
+        Private method
+        Bytes sent and echoed during the current interval, as payload bytes and as bytes on
+        the wire (payload plus IP and UDP headers), and the matching rates in bits per second.
+        :param now: (integer) Monotonic ns time the interval ends
+        :return: (dict) Throughput stats of the interval
+        """
+        seconds = (now - self._interval_start) / 10 ** 9
+        sent = self._check_bytes[self._cur_pt]
+        received = self.received_bytes - self._received_bytes_mark
+        self._received_bytes_mark = self.received_bytes
+        wire_sent = sent + self._packet_count * self.WIRE_OVERHEAD
+        wire_received = received + (self.received_packets - self._received_mark) * self.WIRE_OVERHEAD
+        return {"wire_byte_sent": wire_sent,
+                "byte_receive": received,
+                "wire_byte_receive": wire_received,
+                "bps_sent": sent * 8 / seconds,
+                "wire_bps_sent": wire_sent * 8 / seconds,
+                "bps_receive": received * 8 / seconds,
+                "wire_bps_receive": wire_received * 8 / seconds}
+
+    def _server_latency(self):
+        """
+        Private method
+        One-way latencies of the echoes received during the current interval, from the
+        timestamps the server appended: forward (client to server), return (server to client)
+        and the time the packets spent in the server, as averages in seconds, -1 without
+        stamped echoes. The clock offset between client and server comes from the samples
+        themselves, see ClockOffsetEstimator.
+        :return: (dict) Server latency stats of the interval
+        """
+        counters = (self.server_samples, self.forward_raw_ns, self.return_raw_ns, self.server_dwell_ns)
+        samples, forward, back, dwell = [counters[i] - self._server_marks[i] for i in range(4)]
+        self._server_marks = counters
+        offset = self.clock_offset.offset()
+        self.clock_offset.rotate()
+        stats = {"server_samples": samples,
+                 "forward_latency": -1,
+                 "return_latency": -1,
+                 "server_dwell": -1,
+                 "clock_offset": offset / 10 ** 9 if offset is not None else None}
+        if samples and offset is not None:
+            # The offset is about the time since the epoch, apply it to the integer sums
+            stats["forward_latency"] = (forward - offset * samples) / samples / 10 ** 9
+            stats["return_latency"] = (back + offset * samples) / samples / 10 ** 9
+            stats["server_dwell"] = dwell / samples / 10 ** 9
+        return stats
+
+    def _put_stat(self, check_pt, final=False):
+        """
+        Private method
+        Expire the packets of an interval slot and put its stat record on stat_queue, with
+        the outages that ended among them.
+        :param check_pt: (integer) Interval slot to expire
+        :param final: (boolean) The last interval of the run, an open outage ends here
+        :return: None
+        """
+        latency = 0
+        packets_sent = 0
+        check_pkt_count = 0
+        avg_latency = -1
+        self.log.debug("=========Check Data=======")
+        self.log.debug(self._check_list[check_pt])
+        histogram = self.latency_histogram
+        histogram.reset()
+        for first, stop in self._check_list[check_pt]:
+            sent, acked, latency_ns = self.tracker.expire(first, stop, histogram, self.gaps)
+            packets_sent += sent
+            check_pkt_count += acked
+            latency += latency_ns
+        drop_packet = packets_sent - check_pkt_count
+        if check_pkt_count != 0:
+            avg_latency = latency / check_pkt_count / 10 ** 9
+        self.log.info("====================STAT===================")
+        self.log.info("Total bytes sent: %s" % self._check_bytes[check_pt])
+        self.log.info("Total packets sent: %s" % packets_sent)
+        # self.log.info("Total packets received: %s" % check_pkt_count)
+        self.log.info("Total drop packets: %s" % drop_packet)
+        self.log.info("Average latency: %.4F" % avg_latency)
+        percentiles = histogram.stats()
+        self.log.info("Latency p50/p99/p99.9/max: %.4F/%.4F/%.4F/%.4F" %
+                      (percentiles["latency_p50"], percentiles["latency_p99"],
+                       percentiles["latency_p999"], percentiles["latency_max"]))
+        if final:
+            self.gaps.finish()
+        outages = self.gaps.pop()
+        for outage in outages:
+            self.log.warning("Outage: packets %d-%d lost, %.1f ms offline" %
+                             (outage.start_seq, outage.end_seq, outage.offline_time * 1000))
+        self.outages.extend(outages)
+        if self.tracker.evicted:
+            self.log.warning("%d packets evicted from the in-flight ring of %d slots" %
+                             (self.tracker.evicted, self.tracker.capacity))
+        self.log.info("Open fds: %(open_fds)s (pool %(pool_sockets)s, limit %(fd_limit)s)"
+                      % self.socket_pool.fd_usage())
+        stat = {"app_id": self.controller_app_id,
+                "byte_sent": self._check_bytes[check_pt],
+                "packets_sent": packets_sent,
+                "packets_receive": check_pkt_count,
+                "drop_packets": drop_packet,
+                "avg_latency": avg_latency,
+                "pkt_time": str(datetime.datetime.now())}
+        stat.update(percentiles)
+        stat["outage_count"] = len(outages)
+        stat["offline_time"] = sum(outage.offline_time for outage in outages)
+        stat["outages"] = [outage.to_dict() for outage in outages]
+        if self.ship_histogram:
+            # A queue that copies the record right away can take the histogram itself
+            stat["latency_histogram"] = histogram if self.stat_queue.copies_records else histogram.to_compact()
+        stat.update(self._interval_stats[check_pt])
+        self.stat_queue.put(stat)
+        self._check_list[check_pt] = []
+        self._check_bytes[check_pt] = 0
+
+    def _next_packet(self):
+        """
+        Private method
+        Build the next packet, start tracking it in the current interval and advance the
+        sequence number.
+        :return: (memoryview) The packet payload, in one of packet_builder's buffers
+        """
+        sequence = self.packet_sequence
+        self._sent_sequence = sequence
+        now = time.monotonic_ns()
+        self.tracker.sent(sequence, now)
+        sent_ranges = self._check_list[self._cur_pt]
+        if sent_ranges and sent_ranges[-1][1] == sequence:
+            sent_ranges[-1][1] = sequence + 1
+        else:
+            sent_ranges.append([sequence, sequence + 1])
+
+        self.packet_sequence += 1
+        # Wrap the sequence number
+        if self.packet_sequence > self.sequence_stop:
+            self.packet_sequence = self.sequence_start
+
+        data = self.packet_builder.build(sequence, now)
+        self._check_bytes[self._cur_pt] += len(data)
+        self._packet_count += 1
+        self.sent_packets += 1
+        return data
 
     def _read_server_msg(self):
+        """
+        Private method
+        This is the thread which reads the echoes. It blocks in epoll for up to
+        read_poll_timeout seconds, then drains every ready socket until it would block, taking
+        the receive timestamp right after each recv. Transmit stamps on a socket's error queue
+        are drained before its echoes, so an echo is timed from the stamp of its packet. It
+        runs until self.read_client_data is set to False by UDPTraffic.stop().
+        :return: None
+        """
         self.log.info("Start client reading thread")
+        cpu_start = time.thread_time_ns()
         while self.read_client_data:
             # Linux, using epoll the poll data
-            events = self.epoll_obj.poll(0)
+            try:
+                events = self.epoll_obj.poll(self.read_poll_timeout, self.read_max_events)
+            except (OSError, ValueError):
+                # epoll object closed by stop()
+                break
             for fd, event in events:
+                sock = self.connections.get(fd)
+                if sock is None:
+                    continue
+                if event & select.EPOLLERR and self.clock_source == CLOCK_KERNEL_TX:
+                    self._drain_tx_timestamps(sock)
                 if event & select.EPOLLIN:
-                    recv_data = str(self.connections[fd].recv(1024), "utf-8")
-                    if recv_data in self.udp_data_dictionary:
-                        self.udp_data_dictionary[recv_data][1] = time.time()
-            time.sleep(.001)
+                    self._drain_socket(sock)
+            self.reader_cpu_ns = time.thread_time_ns() - cpu_start
+        if self.received_packets:
+            self.log.info("Reader CPU per received packet: %.2f us" %
+                          (self.reader_cpu_ns / self.received_packets / 1000))
 
-    def _report_stat(self):
-        self.log.info("Start posting stat to harness controller")
+    def _drain_socket(self, sock):
+        """
+        Private method
+        Read every echo queued on a socket.
+        :param sock: (socket) A ready pool socket
+        :return: None
+        """
+        if self.clock_source != CLOCK_USER:
+            self._drain_timestamped(sock)
+        elif self.recv_batch is None:
+            while True:
+                try:
+                    reply = sock.recv(MAX_DATAGRAM, socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    return
+                self._handle_reply(reply, time.monotonic_ns())
+        else:
+            while True:
+                replies = self.recv_batch.recv(sock)
+                now = time.monotonic_ns()
+                for reply in replies:
+                    self._handle_reply(reply, now)
+                if len(replies) < self.recv_batch.size:
+                    return
+
+    def _drain_timestamped(self, sock):
+        """
+        Private method
+        Read every echo queued on a socket with its kernel receive time.
+        :param sock: (socket) A ready pool socket with SO_TIMESTAMPNS enabled
+        :return: None
+        """
+        offset = self._realtime_offset
+        if self.recv_batch is None:
+            while True:
+                try:
+                    reply, ancdata, flags, address = sock.recvmsg(MAX_DATAGRAM, RX_CONTROL_SIZE,
+                                                                  socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    return
+                stamp = parse_rx_timestamp(ancdata)
+                self._handle_reply(reply, stamp - offset if stamp is not None else time.monotonic_ns())
+        else:
+            while True:
+                replies, stamps = self.recv_batch.recv_timestamped(sock, socket.SOL_SOCKET, SO_TIMESTAMPNS)
+                now = time.monotonic_ns()
+                for i in range(len(replies)):
+                    self._handle_reply(replies[i], stamps[i] - offset if stamps[i] is not None else now)
+                if len(replies) < self.recv_batch.size:
+                    return
+
+    def _handle_reply(self, reply, now):
+        """
+        Private method
+        Match an echo to its packet, and tell whether it came in order, reordered, twice or late.
+        :param reply: (bytes) Echoed payload
+        :param now: (integer) Receive time in monotonic ns
+        :return: None
+        """
+        self.received_packets += 1
+        self.received_bytes += len(reply)
+        self._last_reply_ns = now
+        header = parse_header(reply)
+        if header is None or header[0] != self.flow_id:
+            self.bad_packets += 1
+            return
+        # RTT straight from the echoed send time, or from the kernel's transmit stamp
+        if self.clock_source == CLOCK_KERNEL_TX:
+            acked = self.tracker.ack_at(header[1], now)
+        else:
+            acked = self.tracker.ack(header[1], now - header[2])
+        self.reorder.record(header[1], acked)
+        if acked:
+            self.acked_packets += 1
+            stamps = parse_timestamps(reply)
+            if stamps is not None:
+                rx_ns, tx_ns = stamps
+                self.server_samples += 1
+                self.forward_raw_ns += rx_ns - header[2]
+                self.return_raw_ns += now - tx_ns
+                self.server_dwell_ns += tx_ns - rx_ns
+                self.clock_offset.add(header[2], rx_ns, tx_ns, now)
+
+    def _controller_url(self):
+        """
+        Private method
+        :return: (string) URL of the harness controller's UDP traffic stat endpoint
+        """
         config = configparser.ConfigParser()
         config.read(harness_config_path)
         controller_ip = config.get("harness", "controller")
-        url = "http://%s:8000/api/v1/udptrafficstat/" % controller_ip
+        return "http://%s:8000/api/v1/udptrafficstat/" % controller_ip
 
-        while self.sending_client_data is True:
-            if time.time() - self.report_timer > 5:
-                data_list = []
-                try:
-                    while self.stat_queue.empty() is False:
-                        data_list.append(self.stat_queue.get())
-                except IOError:
-                    pass
-                r = requests.post(url,
-                                  json={"data_list": data_list})
-                # if r.status_code == 201:
-                #     self.log.info("Post UDP traffic stats success")
-                # else:
-                #     self.log.error("Post UDP traffic stats fail")
-                #     self.log.error(r.text)
-                self.report_timer = time.time()
-            time.sleep(0.1)
+    def _drain_stat_queue(self):
+        """
+        Private method
+        :return: (list) Every stat record queued so far
+        """
+        return self.stat_queue.drain()
+
+    def _make_reporter(self):
+        """
+        Private method
+        :return: (StatReporter) Reporter posting to the harness controller
+        """
+        spool_dir = self.spool_dir
+        if spool_dir is None:
+            spool_dir = os.path.join(tempfile.gettempdir(), "udptraffic_spool", str(self.controller_app_id))
+        return StatReporter(self._controller_url(), spool_dir, log=self.log, store=self.stat_store)
+
+    def _report_stat(self):
+        """
+        Private method
+        Post queued stat records to the harness controller every report_interval seconds
+        until the last stats of the run are queued, then post those.
+        :return: None
+        """
+        self.log.info("Start posting stat to harness controller")
+        self.reporter = self._make_reporter()
+        try:
+            while not self._flushed.wait(0.1):
+                if time.time() - self.report_timer > self.report_interval:
+                    self.reporter.post(self._drain_stat_queue())
+                    self.report_timer = time.time()
+            self.reporter.post(self._drain_stat_queue())
+        finally:
+            self.reporter.close()
+        self.log.info("Stat reporting: %s" % self.reporter.stats())
 
 
 # def get_parser():
@@ -283,7 +283,8 @@ class UDPTraffic(object):
                     self.log.debug("=========Check Dict=======")
                     self.log.debug(self.udp_data_dictionary)
                     for data in check_list[check_pt]:
-                        total_bits += sys.getsizeof(data)
+                        # The payload is the ASCII sequence number, one byte per character
+                        total_bits += len(data)
                         if self.udp_data_dictionary[data][1] is None:
                             drop_packet += 1
                         else:
@@ -1,7 +1,10 @@
 from django.contrib import admin
-from app.models import TCPTraffic, UDPTraffic, UDPServer
+from app.models import TCPTraffic, UDPTraffic, UDPTrafficGroup, UDPServer, TCPServer, TrafficStat
 
 # Register your models here.
 admin.site.register(TCPTraffic)
 admin.site.register(UDPTraffic)
-admin.site.register(UDPServer)
\ No newline at end of file
+admin.site.register(UDPTrafficGroup)
+admin.site.register(UDPServer)
+admin.site.register(TCPServer)
+admin.site.register(TrafficStat)
\ No newline at end of file
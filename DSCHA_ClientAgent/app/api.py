@@ -1,12 +1,191 @@
+import json
+import time
 import logging
-from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
-from .serializers import UDPTrafficSerializer, UDPServerSerializer
-from UDPTraffic.tasks import start_udp_traffic, start_udp_server
+import datetime
+import threading
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView, RetrieveAPIView, \
+    GenericAPIView
+from .serializers import TCPTrafficSerializer, UDPTrafficSerializer, UDPTrafficGroupSerializer, UDPServerSerializer, \
+    TCPServerSerializer, TrafficStatSerializer
+from UDPTraffic.tasks import start_udp_traffic, start_udp_flows, start_tcp_traffic, start_udp_server, \
+    start_tcp_server
+from UDPTraffic.control import request_stop, send_command, query
+from UDPTraffic.livestats import LiveStatRing, ring_path, read_ring, remove_ring
 from celery.task.control import revoke
-from .models import TCPTraffic, UDPTraffic, UDPServer
+from .models import TCPTraffic, UDPTraffic, UDPTrafficGroup, UDPServer, TCPServer
+from .statstore import stat_range
 from celery import uuid
 
 logger = logging.getLogger(__name__)
+# Live stats: records returned by default, longest long poll and seconds between ring reads
+LIVE_COUNT = 10
+LIVE_MAX_WAIT = 10
+LIVE_POLL = 0.2
+# Seconds between keepalives on an idle event stream, and before a stream ends; the browser's
+# EventSource reconnects and resumes from Last-Event-ID, which also frees the worker thread
+LIVE_HEARTBEAT = 15
+LIVE_STREAM_SECONDS = 30
+# Event streams and waiting long polls a web process serves at once (LIVE_MAX_CLIENTS in the
+# settings overrides it): each holds a worker thread, the others must stay free for the API
+LIVE_MAX_CLIENTS = getattr(settings, "LIVE_MAX_CLIENTS", 4)
+_live_clients = threading.BoundedSemaphore(LIVE_MAX_CLIENTS)
+
+
+def stop_task(celery_id):
+    """
+    Stop a traffic or server task through its control channel, so it flushes its last stats
+    and frees its sockets. Tasks that do not answer (still queued, or stuck) are revoked.
+    :param celery_id: (string) Id of the task
+    :return: None
+    """
+    if not request_stop(celery_id):
+        logger.warning("Task %s did not stop on request, revoking it" % celery_id)
+        revoke(celery_id, terminate=True, signal="SIGKILL")
+
+
+def start_group(group):
+    """
+    Start the multi-flow task of a traffic group, sending every started row of the group.
+    :param group: (UDPTrafficGroup) The group
+    :return: (string) Celery id of the task
+    """
+    celery_id = uuid()
+    flows = [[flow.dst_ip, flow.dst_port, flow.packet_per_second, flow.id, flow.rate_profile, flow.payload_size]
+             for flow in group.flows.filter(is_start=True)]
+    start_udp_flows.apply_async((flows,),
+                                {'group_id': group.id,
+                                 'timestamping': group.timestamping},
+                                task_id=celery_id)
+    return celery_id
+
+
+def update_group_flow(flow, start):
+    """
+    Add a traffic row to, or remove it from, the running task of its group. Nothing to do
+    while the group is stopped: the row's is_start is picked up when the group starts.
+    :param flow: (UDPTraffic) A row with a group
+    :param start: (boolean) True to add the row, False to remove it
+    :return: None
+    """
+    group = flow.group
+    if not group.is_start:
+        return
+    if start:
+        done = send_command(group.celery_id, "add",
+                            [flow.dst_ip, flow.dst_port, flow.packet_per_second, flow.id, flow.rate_profile,
+                             flow.payload_size])
+    else:
+        done = send_command(group.celery_id, "remove", flow.id)
+    if not done:
+        logger.warning("Could not %s UDP traffic %d in group task %s" %
+                       ("add" if start else "remove", flow.id, group.celery_id))
+
+
+def start_tcp(traffic):
+    """
+    Start the TCP traffic task of a row.
+    :param traffic: (TCPTraffic) The row
+    :return: (string) Celery id of the task
+    """
+    celery_id = uuid()
+    start_tcp_traffic.apply_async((traffic.dst_ip, traffic.dst_port, traffic.packet_per_second, traffic.id),
+                                  {'mode': traffic.mode,
+                                   'connections': traffic.count,
+                                   'ip_version': traffic.ip_version,
+                                   'data': traffic.data,
+                                   'payload_size': traffic.payload_size,
+                                   'response_size': traffic.response_size},
+                                  task_id=celery_id)
+    return celery_id
+
+
+def parse_time(value):
+    """
+    :param value: (string) ISO 8601 time, UTC when it has no offset, or Unix seconds
+    :return: (datetime.datetime) The aware time
+    :raise ValueError: if value is neither
+    """
+    try:
+        return datetime.datetime.fromtimestamp(float(value), timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError("Not an ISO 8601 time or Unix seconds: %s" % value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def live_events(kind, app_id, after=None, count=LIVE_COUNT):
+    """
+    Server-sent events of a row's live stat ring: the latest count records, or those after
+    after, then every new one as it is written, for LIVE_STREAM_SECONDS. The caller holds a
+    _live_clients slot for the stream and must start the generator (its first item is empty),
+    so that closing it releases the slot.
+    :param kind: (string) "udp" or "tcp"
+    :param app_id: (integer) Id of the traffic row
+    :param after: (integer) Number of the last record the client has, e.g. its Last-Event-ID
+    :param count: (integer) Most records sent at first
+    :return: (generator) Event stream text
+    """
+    ring = None
+    started = last_sent = time.monotonic()
+    try:
+        yield ""
+        # Tells EventSource to reconnect a second after the stream ends
+        yield "retry: 1000\n\n"
+        while time.monotonic() - started < LIVE_STREAM_SECONDS:
+            if ring is None or ring.replaced():
+                if ring is not None:
+                    ring.close()
+                    # Started over, its records are numbered from 0 again
+                    after = None
+                try:
+                    ring = LiveStatRing(ring_path(kind, app_id))
+                except (FileNotFoundError, ValueError):
+                    ring = None
+            records = ring.read(after, count if after is None else None) if ring is not None else []
+            for number, record in records:
+                after = number
+                yield "id: %d\ndata: %s\n\n" % (number, json.dumps(record, separators=(",", ":")))
+            now = time.monotonic()
+            if records:
+                last_sent = now
+            elif now - last_sent >= LIVE_HEARTBEAT:
+                # A comment: keeps proxies from closing the stream, and finds out about a gone client
+                yield ": keepalive\n\n"
+                last_sent = now
+            time.sleep(LIVE_POLL)
+    finally:
+        if ring is not None:
+            ring.close()
+        _live_clients.release()
+
+
+def start_tcp_srv(server):
+    """
+    Start the TCP server task of a row.
+    :param server: (TCPServer) The row
+    :return: (string) Celery id of the task
+    """
+    celery_id = uuid()
+    start_tcp_server.apply_async((server.ip, server.port),
+                                 {'mode': server.mode,
+                                  'workers': server.workers,
+                                  'response_size': server.response_size,
+                                  'request_size': server.request_size},
+                                 task_id=celery_id)
+    return celery_id
 
 
 class UDPTrafficListCreateApiView(ListCreateAPIView):
@@ -25,7 +204,9 @@ class UDPTrafficListCreateApiView(ListCreateAPIView):
         #                                    serializer.validated_data['dst_port'],
         #                                    serializer.validated_data['packet_per_second']),
         #                                   task_id=celery_id)
-        serializer.save()
+        flow = serializer.save()
+        if flow.group is not None and flow.is_start:
+            update_group_flow(flow, True)
 
 
 class UDPTrafficDetailApiView(RetrieveUpdateDestroyAPIView):
@@ -40,11 +221,15 @@ class UDPTrafficDetailApiView(RetrieveUpdateDestroyAPIView):
         logger.debug("Patch model data:")
         logger.debug(model_data)
         logger.debug(data)
-        if 'is_start' in data:
+        if 'is_start' in data and instance.group is not None:
+            # The row runs in its group's task, not in one of its own
+            if model_data['is_start'] != data['is_start']:
+                update_group_flow(instance, data['is_start'])
+        elif 'is_start' in data:
             if model_data['is_start'] is True and data['is_start'] is False:
                 request.data['celery_id'] = ''
                 logger.info("Stop UDP Traffic, celery id: %s" % model_data['celery_id'])
-                revoke(model_data['celery_id'], terminate=True, signal="SIGKILL")
+                stop_task(model_data['celery_id'])
             elif model_data['is_start'] is False and data['is_start'] is True:
                 celery_id = uuid()
                 request.data['celery_id'] = celery_id
@@ -52,6 +237,11 @@ class UDPTrafficDetailApiView(RetrieveUpdateDestroyAPIView):
                                                model_data['dst_port'],
                                                model_data['packet_per_second'],
                                                model_data['id']),
+                                              {'shards': model_data['shards'],
+                                               'engine': model_data['engine'],
+                                               'timestamping': model_data['timestamping'],
+                                               'rate_profile': model_data['rate_profile'],
+                                               'payload_size': model_data['payload_size']},
                                               task_id=celery_id)
         return self.partial_update(request, *args, **kwargs)
 
@@ -61,8 +251,99 @@ class UDPTrafficDetailApiView(RetrieveUpdateDestroyAPIView):
         model_data = serializer.data
         # Stop server celery task if it's running
         if 'is_start' in model_data and model_data['is_start'] is True:
-            logger.info("Stop UDP traffic, celery id: %s" % model_data['celery_id'])
-            revoke(model_data['celery_id'], terminate=True, signal="SIGKILL")
+            if instance.group is not None:
+                update_group_flow(instance, False)
+            else:
+                logger.info("Stop UDP traffic, celery id: %s" % model_data['celery_id'])
+                stop_task(model_data['celery_id'])
+        remove_ring("udp", instance.id)
+        return self.destroy(request, *args, **kwargs)
+
+
+class UDPTrafficGroupListCreateApiView(ListCreateAPIView):
+    serializer_class = UDPTrafficGroupSerializer
+
+    def get_queryset(self):
+        return UDPTrafficGroup.objects.all()
+
+    def perform_create(self, serializer):
+        group = serializer.save()
+        if group.is_start:
+            group.celery_id = start_group(group)
+            group.save()
+
+
+class UDPTrafficGroupDetailApiView(RetrieveUpdateDestroyAPIView):
+    serializer_class = UDPTrafficGroupSerializer
+    queryset = UDPTrafficGroup.objects.all()
+
+    def patch(self, request, *args, **kwargs):
+        data = request.data
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        if 'is_start' in data:
+            if model_data['is_start'] is True and data['is_start'] is False:
+                request.data['celery_id'] = ''
+                logger.info("Stop UDP traffic group, celery id: %s" % model_data['celery_id'])
+                stop_task(model_data['celery_id'])
+            elif model_data['is_start'] is False and data['is_start'] is True:
+                request.data['celery_id'] = start_group(instance)
+        return self.partial_update(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        # Stop the group's celery task if it's running
+        if 'is_start' in model_data and model_data['is_start'] is True:
+            logger.info("Stop UDP traffic group, celery id: %s" % model_data['celery_id'])
+            stop_task(model_data['celery_id'])
+        # The rows stay, without a group and with no task of their own sending them
+        instance.flows.update(is_start=False, celery_id='')
+        return self.destroy(request, *args, **kwargs)
+
+
+class TCPTrafficListCreateApiView(ListCreateAPIView):
+    serializer_class = TCPTrafficSerializer
+
+    def get_queryset(self):
+        return TCPTraffic.objects.all()
+
+    def perform_create(self, serializer):
+        traffic = serializer.save()
+        if traffic.is_start:
+            traffic.celery_id = start_tcp(traffic)
+            traffic.save()
+
+
+class TCPTrafficDetailApiView(RetrieveUpdateDestroyAPIView):
+    serializer_class = TCPTrafficSerializer
+    queryset = TCPTraffic.objects.all()
+
+    def patch(self, request, *args, **kwargs):
+        data = request.data
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        if 'is_start' in data:
+            if model_data['is_start'] is True and data['is_start'] is False:
+                request.data['celery_id'] = ''
+                logger.info("Stop TCP traffic, celery id: %s" % model_data['celery_id'])
+                stop_task(model_data['celery_id'])
+            elif model_data['is_start'] is False and data['is_start'] is True:
+                request.data['celery_id'] = start_tcp(instance)
+        return self.partial_update(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        # Stop the traffic celery task if it's running
+        if 'is_start' in model_data and model_data['is_start'] is True:
+            logger.info("Stop TCP traffic, celery id: %s" % model_data['celery_id'])
+            stop_task(model_data['celery_id'])
+        remove_ring("tcp", instance.id)
         return self.destroy(request, *args, **kwargs)
 
 
@@ -78,6 +359,10 @@ class UDPServerListCreateApiView(ListCreateAPIView):
             celery_id = uuid()
             serializer.validated_data['celery_id'] = celery_id
             start_udp_server.apply_async((serializer.validated_data['ip'], serializer.validated_data['port']),
+                                         {'mode': serializer.validated_data.get('mode', 'classic'),
+                                          'workers': serializer.validated_data.get('workers', 1),
+                                          'batch_size': serializer.validated_data.get('batch_size', 1),
+                                          'timestamps': serializer.validated_data.get('timestamps', False)},
                                          task_id=celery_id)
         serializer.save()
 
@@ -95,12 +380,16 @@ class UDPServerDetailApiView(RetrieveUpdateDestroyAPIView):
             if model_data['is_start'] is True and data['is_start'] is False:
                 request.data['celery_id'] = ''
                 logger.info("Stop UDP server, celery id: %s" % model_data['celery_id'])
-                revoke(model_data['celery_id'], terminate=True, signal="SIGKILL")
+                stop_task(model_data['celery_id'])
             elif model_data['is_start'] is False and data['is_start'] is True:
                 celery_id = uuid()
                 request.data['celery_id'] = celery_id
                 start_udp_server.apply_async((model_data['ip'],
                                               model_data['port']),
+                                             {'mode': model_data['mode'],
+                                              'workers': model_data['workers'],
+                                              'batch_size': model_data['batch_size'],
+                                              'timestamps': model_data['timestamps']},
                                              task_id=celery_id)
         return self.partial_update(request, *args, **kwargs)
 
@@ -111,5 +400,184 @@ class UDPServerDetailApiView(RetrieveUpdateDestroyAPIView):
         # Stop server celery task if it's running
         if 'is_start' in model_data and model_data['is_start'] is True:
             logger.info("Stop UDP server, celery id: %s" % model_data['celery_id'])
-            revoke(model_data['celery_id'], terminate=True, signal="SIGKILL")
-        return self.destroy(request, *args, **kwargs)
\ No newline at end of file
+            stop_task(model_data['celery_id'])
+        return self.destroy(request, *args, **kwargs)
+
+
+class TCPServerListCreateApiView(ListCreateAPIView):
+    serializer_class = TCPServerSerializer
+
+    def get_queryset(self):
+        return TCPServer.objects.all()
+
+    def perform_create(self, serializer):
+        server = serializer.save()
+        if server.is_start:
+            server.celery_id = start_tcp_srv(server)
+            server.save()
+
+
+class TCPServerDetailApiView(RetrieveUpdateDestroyAPIView):
+    serializer_class = TCPServerSerializer
+    queryset = TCPServer.objects.all()
+
+    def patch(self, request, *args, **kwargs):
+        data = request.data
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        if 'is_start' in data:
+            if model_data['is_start'] is True and data['is_start'] is False:
+                request.data['celery_id'] = ''
+                logger.info("Stop TCP server, celery id: %s" % model_data['celery_id'])
+                stop_task(model_data['celery_id'])
+            elif model_data['is_start'] is False and data['is_start'] is True:
+                request.data['celery_id'] = start_tcp_srv(instance)
+        return self.partial_update(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        model_data = serializer.data
+        # Stop server celery task if it's running
+        if 'is_start' in model_data and model_data['is_start'] is True:
+            logger.info("Stop TCP server, celery id: %s" % model_data['celery_id'])
+            stop_task(model_data['celery_id'])
+        return self.destroy(request, *args, **kwargs)
+
+
+class TCPServerStatsApiView(RetrieveAPIView):
+    """
+    Counters of a running TCP server: totals, open connections and the per-second records of
+    the last ?seconds= seconds (all it keeps by default).
+    """
+    queryset = TCPServer.objects.all()
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        if not instance.is_start:
+            return Response({'detail': 'TCP server is not running'}, status=status.HTTP_409_CONFLICT)
+        seconds = request.query_params.get('seconds')
+        if seconds is not None:
+            try:
+                seconds = int(seconds)
+            except ValueError:
+                return Response({'detail': 'seconds must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        stats = query(instance.celery_id, "stats", seconds)
+        if stats is None:
+            return Response({'detail': 'TCP server task did not answer'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        stats['id'] = instance.id
+        return Response(stats)
+
+
+class TrafficStatRangeApiView(GenericAPIView):
+    """
+    Stats history of a traffic row kept on the agent, see app.statstore:
+    ?start=&end= (ISO 8601 or Unix seconds, default the last hour) and optionally
+    &resolution=1|60|3600, picked from the window otherwise.
+    """
+    serializer_class = TrafficStatSerializer
+    # "udp" or "tcp"
+    kind = None
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            end = parse_time(params['end']) if 'end' in params else timezone.now()
+            start = parse_time(params['start']) if 'start' in params else end - datetime.timedelta(hours=1)
+            resolution = int(params['resolution']) if 'resolution' in params else None
+            if start >= end:
+                raise ValueError("start must be before end")
+            resolution, stats = stat_range(self.kind, int(kwargs['pk']), start, end, resolution)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'id': int(kwargs['pk']),
+                         'start': start,
+                         'end': end,
+                         'resolution': resolution,
+                         'stats': self.get_serializer(stats, many=True).data})
+
+
+class UDPTrafficStatRangeApiView(TrafficStatRangeApiView):
+    kind = "udp"
+
+
+class TCPTrafficStatRangeApiView(TrafficStatRangeApiView):
+    kind = "tcp"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets requests accepting only text/event-stream through content negotiation, the stream
+    itself is a StreamingHttpResponse.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode('utf-8')
+
+
+class LiveStatApiView(APIView):
+    """
+    Latest stat intervals of a traffic row from its live stat ring, see UDPTraffic.livestats,
+    without touching the database or the sender: ?count=N returns the latest N (default
+    LIVE_COUNT); ?after=<number> only newer ones, waiting up to ?wait= seconds for one (long
+    poll); Accept: text/event-stream or ?stream=1 streams them as server-sent events for
+    LIVE_STREAM_SECONDS, then the browser reconnects.
+    Streams and waiting polls hold a worker thread each, so a web process serves at most
+    LIVE_MAX_CLIENTS of them: further streams get 503, further polls an answer right away.
+    """
+    # Not even a session lookup
+    authentication_classes = ()
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (EventStreamRenderer,)
+    # "udp" or "tcp"
+    kind = None
+
+    def get(self, request, *args, **kwargs):
+        app_id = int(kwargs['pk'])
+        params = request.query_params
+        try:
+            count = int(params.get('count', LIVE_COUNT))
+            after = int(params['after']) if 'after' in params else None
+            wait = min(float(params.get('wait', 0)), LIVE_MAX_WAIT)
+            if request.META.get('HTTP_LAST_EVENT_ID'):
+                after = int(request.META['HTTP_LAST_EVENT_ID'])
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if params.get('stream') or 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+            if not _live_clients.acquire(False):
+                response = Response({'detail': "Too many live stat streams, try again later"},
+                                    status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                response['Retry-After'] = str(LIVE_STREAM_SECONDS)
+                return response
+            events = live_events(self.kind, app_id, after, count)
+            # From here on closing the stream releases the slot
+            next(events)
+            response = StreamingHttpResponse(events, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            # Or nginx holds the events back
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        records = read_ring(self.kind, app_id, after, count)
+        if not records and wait > 0 and _live_clients.acquire(False):
+            try:
+                deadline = time.monotonic() + wait
+                while not records and time.monotonic() < deadline:
+                    time.sleep(LIVE_POLL)
+                    records = read_ring(self.kind, app_id, after, count)
+            finally:
+                _live_clients.release()
+        return Response({'id': app_id,
+                         'last': records[-1][0] if records else after,
+                         'stats': [record for number, record in records]})
+
+
+class UDPTrafficLiveStatApiView(LiveStatApiView):
+    kind = "udp"
+
+
+class TCPTrafficLiveStatApiView(LiveStatApiView):
+    kind = "tcp"
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_auto_20180318_2156'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udptraffic',
+            name='shards',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 09:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_udptraffic_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udptraffic',
+            name='engine',
+            field=models.CharField(choices=[('thread', 'thread'), ('asyncio', 'asyncio')], default='thread', max_length=16),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.0.1 on 2026-10-18 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_udptraffic_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UDPServer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip', models.GenericIPAddressField()),
+                ('port', models.IntegerField()),
+                ('mode', models.CharField(choices=[('classic', 'classic'), ('reuseport', 'reuseport')], default='classic', max_length=16)),
+                ('workers', models.IntegerField(default=1)),
+                ('batch_size', models.IntegerField(default=1)),
+                ('is_start', models.BooleanField(default=False)),
+                ('celery_id', models.CharField(blank=True, max_length=1024)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_udpserver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udpserver',
+            name='timestamps',
+            field=models.BooleanField(default=False),
+        ),
+    ]
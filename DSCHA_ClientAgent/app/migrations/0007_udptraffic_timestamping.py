@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_udpserver_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udptraffic',
+            name='timestamping',
+            field=models.CharField(choices=[('user', 'user'), ('kernel', 'kernel'), ('kernel_tx', 'kernel_tx')], default='user', max_length=16),
+        ),
+    ]
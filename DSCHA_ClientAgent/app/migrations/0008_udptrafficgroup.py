@@ -0,0 +1,28 @@
+# Generated by Django 2.0.1 on 2026-10-18 10:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_udptraffic_timestamping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UDPTrafficGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamping', models.CharField(choices=[('user', 'user'), ('kernel', 'kernel'), ('kernel_tx', 'kernel_tx')], default='user', max_length=16)),
+                ('is_start', models.BooleanField(default=False)),
+                ('celery_id', models.CharField(blank=True, max_length=1024)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='udptraffic',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='flows', to='app.UDPTrafficGroup'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_udptrafficgroup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udptraffic',
+            name='rate_profile',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_udptraffic_rate_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='udptraffic',
+            name='payload_size',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
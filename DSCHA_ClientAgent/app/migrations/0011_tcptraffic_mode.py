@@ -0,0 +1,33 @@
+# Generated by Django 2.0.1 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_udptraffic_payload_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tcptraffic',
+            name='mode',
+            field=models.CharField(choices=[('cps', 'cps'), ('concurrent', 'concurrent')], default='cps', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='tcptraffic',
+            name='payload_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tcptraffic',
+            name='response_size',
+            field=models.IntegerField(default=-1),
+        ),
+        migrations.AlterField(
+            model_name='tcptraffic',
+            name='celery_id',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.1 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_tcptraffic_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TCPServer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip', models.GenericIPAddressField()),
+                ('port', models.IntegerField()),
+                ('mode', models.CharField(choices=[('echo', 'echo'), ('sink', 'sink'), ('fixed', 'fixed')], default='echo', max_length=16)),
+                ('workers', models.IntegerField(default=1)),
+                ('response_size', models.IntegerField(default=0)),
+                ('request_size', models.IntegerField(default=0)),
+                ('is_start', models.BooleanField(default=False)),
+                ('celery_id', models.CharField(blank=True, max_length=1024)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.1 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_tcpserver'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrafficStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('udp', 'udp'), ('tcp', 'tcp')], max_length=8)),
+                ('app_id', models.IntegerField()),
+                ('resolution', models.IntegerField(default=1)),
+                ('samples', models.IntegerField(default=1)),
+                ('time', models.DateTimeField()),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='trafficstat',
+            index=models.Index(fields=['kind', 'app_id', 'resolution', 'time'], name='app_traffic_kind_24ca8d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trafficstat',
+            index=models.Index(fields=['resolution', 'time'], name='app_traffic_resolut_adff20_idx'),
+        ),
+    ]
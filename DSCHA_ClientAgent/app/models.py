@@ -7,6 +7,23 @@ class UDPTraffic(models.Model):
     dst_ip = models.GenericIPAddressField()
     dst_port = models.IntegerField()
     packet_per_second = models.BigIntegerField()
+    # Number of sender processes packet_per_second is split across
+    shards = models.IntegerField(default=1)
+    # Traffic engine: sender and reader threads, or a single asyncio event loop
+    engine = models.CharField(max_length=16, default="thread",
+                              choices=(("thread", "thread"), ("asyncio", "asyncio")))
+    # Clock packets are timed with: user space, kernel receive stamps, or receive and transmit stamps
+    timestamping = models.CharField(max_length=16, default="user",
+                                    choices=(("user", "user"), ("kernel", "kernel"), ("kernel_tx", "kernel_tx")))
+    # Traffic group the row runs in; is_start then adds it to or removes it from the group's task
+    group = models.ForeignKey("UDPTrafficGroup", null=True, blank=True, related_name="flows",
+                              on_delete=models.SET_NULL)
+    # JSON rate profile (ramp, step, burst, sine or points) followed instead of packet_per_second,
+    # see UDPTraffic.rateprofile; empty for a constant rate
+    rate_profile = models.TextField(blank=True, default="")
+    # Payload bytes, "imix" or a JSON fixed/uniform/weighted size spec, see UDPTraffic.packet;
+    # empty for header-only packets
+    payload_size = models.TextField(blank=True, default="")
     is_start = models.BooleanField(default=False)
     celery_id = models.CharField(max_length=1024, blank=True)
 
@@ -15,9 +32,29 @@ class UDPTraffic(models.Model):
         return "VIP: {}:{}".format(self.dst_ip, self.dst_port)
 
 
+class UDPTrafficGroup(models.Model):
+    # UDP traffic rows sent by one multi-flow task, sharing its source ports and threads
+    timestamping = models.CharField(max_length=16, default="user",
+                                    choices=(("user", "user"), ("kernel", "kernel"), ("kernel_tx", "kernel_tx")))
+    is_start = models.BooleanField(default=False)
+    celery_id = models.CharField(max_length=1024, blank=True)
+
+    def __str__(self):
+
+        return "UDP traffic group {}".format(self.id)
+
+
 class UDPServer(models.Model):
     ip = models.GenericIPAddressField()
     port = models.IntegerField()
+    # Echo server: socketserver based, or SO_REUSEPORT worker processes with batched I/O
+    mode = models.CharField(max_length=16, default="classic",
+                            choices=(("classic", "classic"), ("reuseport", "reuseport")))
+    # Worker processes (0: one per CPU) and datagrams per recvmmsg/sendmmsg, reuseport mode only
+    workers = models.IntegerField(default=1)
+    batch_size = models.IntegerField(default=1)
+    # Append receive/send timestamps to echoes so clients can split forward and return latency
+    timestamps = models.BooleanField(default=False)
     is_start = models.BooleanField(default=False)
     celery_id = models.CharField(max_length=1024, blank=True)
 
@@ -26,18 +63,68 @@ class UDPServer(models.Model):
         return "Server: {}:{}".format(self.ip, self.port)
 
 
+class TCPServer(models.Model):
+    ip = models.GenericIPAddressField()
+    port = models.IntegerField()
+    # echo: reads sent back; sink: reads dropped; fixed: response_size bytes per request
+    mode = models.CharField(max_length=16, default="echo",
+                            choices=(("echo", "echo"), ("sink", "sink"), ("fixed", "fixed")))
+    # SO_REUSEPORT worker processes, 0: one per CPU
+    workers = models.IntegerField(default=1)
+    # Fixed mode only: bytes answered per request, and bytes per request (0: every read is one)
+    response_size = models.IntegerField(default=0)
+    request_size = models.IntegerField(default=0)
+    is_start = models.BooleanField(default=False)
+    celery_id = models.CharField(max_length=1024, blank=True)
+
+    def __str__(self):
+
+        return "TCP server: {}:{}".format(self.ip, self.port)
+
+
 class TCPTraffic(models.Model):
 
     dst_ip = models.GenericIPAddressField()
     dst_port = models.IntegerField()
+    # Connections kept open in concurrent mode, the most open at once in cps mode (0: no limit)
     count = models.IntegerField()
     exclude = models.CharField(max_length=300, blank=True)
     ip_version = models.IntegerField()
+    # New connections per second in cps mode, requests per second in concurrent mode
     packet_per_second = models.BigIntegerField()
+    # cps: a request per short-lived connection; concurrent: requests over long-lived connections
+    mode = models.CharField(max_length=16, default="cps",
+                            choices=(("cps", "cps"), ("concurrent", "concurrent")))
+    # Request payload, zero padded up to payload_size bytes
     data = models.TextField(blank=True, null=True)
+    payload_size = models.IntegerField(default=0)
+    # Response bytes expected per request: -1 as many as sent (echo), 0 none (sink)
+    response_size = models.IntegerField(default=-1)
     is_start = models.BooleanField(default=False)
-    celery_id = models.CharField(max_length=1024)
+    celery_id = models.CharField(max_length=1024, blank=True)
 
     def __str__(self):
 
         return "Destination: {}:{}".format(self.dst_ip, self.dst_port)
+
+
+class TrafficStat(models.Model):
+    # Stats of a UDPTraffic or TCPTraffic row: one per second as reported, rolled up per minute
+    # and per hour, see app.statstore
+    kind = models.CharField(max_length=8, choices=(("udp", "udp"), ("tcp", "tcp")))
+    app_id = models.IntegerField()
+    # Seconds the row covers, and the per-second records it was rolled up from
+    resolution = models.IntegerField(default=1)
+    samples = models.IntegerField(default=1)
+    # Start of the second, minute or hour, UTC
+    time = models.DateTimeField()
+    # The numeric fields of the records as JSON
+    data = models.TextField()
+
+    class Meta:
+        indexes = [models.Index(fields=["kind", "app_id", "resolution", "time"]),
+                   models.Index(fields=["resolution", "time"])]
+
+    def __str__(self):
+
+        return "{} traffic {} stats at {} ({} s)".format(self.kind.upper(), self.app_id, self.time, self.resolution)
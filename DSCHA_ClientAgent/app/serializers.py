@@ -1,23 +1,84 @@
+import json
 from rest_framework import serializers
-from .models import TCPTraffic, UDPTraffic, UDPServer
+from .models import TCPTraffic, UDPTraffic, UDPTrafficGroup, UDPServer, TCPServer, TrafficStat
+from UDPTraffic.rateprofile import parse_profile
+from UDPTraffic.packet import parse_payload_size
 
 
 class TCPTrafficSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = TCPTraffic
-        fields = ('id', 'dst_ip', 'dst_port', 'count', 'exclude', 'ip_version', 'data', 'is_start')
+        fields = ('id', 'dst_ip', 'dst_port', 'count', 'exclude', 'ip_version', 'packet_per_second', 'mode', 'data',
+                  'payload_size', 'response_size', 'is_start', 'celery_id')
+
+    def validate(self, attrs):
+        # A partial update may change only one of the two
+        mode = attrs.get('mode', getattr(self.instance, 'mode', 'cps'))
+        count = attrs.get('count', getattr(self.instance, 'count', 0))
+        if mode == 'concurrent' and count < 1:
+            raise serializers.ValidationError("Concurrent mode needs a count of at least one connection")
+        return attrs
 
 
 class UDPTrafficSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UDPTraffic
-        fields = ('id', 'dst_ip', 'dst_port', 'packet_per_second', 'is_start', 'celery_id')
+        fields = ('id', 'dst_ip', 'dst_port', 'packet_per_second', 'shards', 'engine', 'timestamping', 'group',
+                  'rate_profile', 'payload_size', 'is_start', 'celery_id')
+
+    def validate_rate_profile(self, value):
+        try:
+            parse_profile(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+    def validate_payload_size(self, value):
+        try:
+            parse_payload_size(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+
+class UDPTrafficGroupSerializer(serializers.ModelSerializer):
+    flows = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = UDPTrafficGroup
+        fields = ('id', 'timestamping', 'flows', 'is_start', 'celery_id')
 
 
 class UDPServerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UDPServer
-        fields = ('id', 'ip', 'port', 'is_start', 'celery_id')
\ No newline at end of file
+        fields = ('id', 'ip', 'port', 'mode', 'workers', 'batch_size', 'timestamps', 'is_start', 'celery_id')
+
+
+class TCPServerSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = TCPServer
+        fields = ('id', 'ip', 'port', 'mode', 'workers', 'response_size', 'request_size', 'is_start', 'celery_id')
+
+    def validate(self, attrs):
+        # A partial update may change only one of the two
+        mode = attrs.get('mode', getattr(self.instance, 'mode', 'echo'))
+        response_size = attrs.get('response_size', getattr(self.instance, 'response_size', 0))
+        if mode == 'fixed' and response_size <= 0:
+            raise serializers.ValidationError("A fixed response server needs a response_size")
+        return attrs
+
+
+class TrafficStatSerializer(serializers.ModelSerializer):
+    data = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TrafficStat
+        fields = ('time', 'resolution', 'samples', 'data')
+
+    def get_data(self, stat):
+        return json.loads(stat.data)
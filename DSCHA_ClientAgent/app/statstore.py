@@ -0,0 +1,287 @@
+"""
+Agent-side stats history.
+
+The traffic engines only keep stat records until their reporter posts them to the
+controller. StatStore keeps them on the agent as well: the reporter hands every batch it
+posts (one every report interval, from its own thread, off the sender's path) to write(),
+which saves the records' numeric fields as TrafficStat rows with one bulk_create.
+
+Per-second rows are rolled up into per-minute rows once a minute is complete, and those
+into per-hour rows once an hour is. Counters are summed, rates, latencies and the other
+measurements averaged (weighted by the seconds they cover, -1 meaning "no data" is
+skipped), and maxima and the p99/p99.9 percentiles take the worst second. Rows older than
+the retention of their resolution (STAT_RETENTION in the settings overrides the defaults)
+are pruned, so the database stays bounded however long the agent runs.
+
+stat_range() reads a time window back at the finest resolution that still covers it and
+keeps the answer under MAX_POINTS rows.
+"""
+import json
+import logging
+import datetime
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import TrafficStat
+
+# Seconds a row covers, finest first; every resolution is rolled up from the one before
+RESOLUTIONS = (1, 60, 3600)
+# Seconds the rows of each resolution are kept
+RETENTION = {1: 6 * 3600,
+             60: 7 * 24 * 3600,
+             3600: 90 * 24 * 3600}
+# Seconds between prunes
+PRUNE_INTERVAL = 60
+# Most rows stat_range() picks a resolution for
+MAX_POINTS = 1000
+# Rows per INSERT
+BATCH_SIZE = 500
+# Record fields that are not measurements
+SKIPPED = ("app_id", "interval")
+# Integers that are levels rather than counts, averaged instead of summed
+GAUGES = ("connections_open",)
+# Floats that are amounts, summed instead of averaged
+AMOUNTS = ("offline_time",)
+# Float suffixes rolled up as the worst second
+WORST = ("_max", "_p99", "_p999")
+# Value of a measurement with no data in the interval, e.g. latency without echoes
+NO_DATA = -1
+
+logger = logging.getLogger(__name__)
+
+
+def retention():
+    """
+    :return: (dict) Seconds the rows of each resolution are kept, RETENTION updated with the
+        STAT_RETENTION setting
+    """
+    periods = dict(RETENTION)
+    periods.update(getattr(settings, "STAT_RETENTION", {}))
+    return periods
+
+
+def floor_time(moment, resolution):
+    """
+    :param moment: (datetime.datetime) Aware time
+    :param resolution: (integer) Seconds
+    :return: (datetime.datetime) Start of the second, minute or hour moment falls in, UTC
+    """
+    seconds = int(moment.timestamp())
+    return datetime.datetime.fromtimestamp(seconds - seconds % resolution, timezone.utc)
+
+
+def record_time(record):
+    """
+    :param record: (dict) Stat record
+    :return: (datetime.datetime) Time the record was closed, from its local pkt_time, now if
+        it has none
+    """
+    pkt_time = record.get("pkt_time")
+    if pkt_time:
+        for time_format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+            try:
+                # pkt_time is the agent's local time, timestamp() reads it as such
+                local = datetime.datetime.strptime(pkt_time, time_format)
+                return datetime.datetime.fromtimestamp(local.timestamp(), timezone.utc)
+            except ValueError:
+                pass
+    return timezone.now()
+
+
+def measurements(record):
+    """
+    :param record: (dict) Stat record
+    :return: (dict) Its numeric fields, the ones rolled up and served back
+    """
+    return {key: value for key, value in record.items()
+            if key not in SKIPPED and isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+
+def roll_up(rows):
+    """
+    Combine measurements into those of a longer period.
+    :param rows: (list) (samples, measurements) of each row the period covers
+    :return: (dict) Measurements of the period
+    """
+    values = {}
+    for samples, data in rows:
+        for key, value in data.items():
+            # Counters are never negative, -1 can only mean no data
+            if value is None or value == NO_DATA:
+                continue
+            values.setdefault(key, []).append((samples, value))
+    combined = {}
+    for key, weighted in values.items():
+        if key in AMOUNTS or key not in GAUGES and all(isinstance(value, int) for samples, value in weighted):
+            combined[key] = sum(value for samples, value in weighted)
+        elif key.endswith(WORST) or key.startswith("max_"):
+            combined[key] = max(value for samples, value in weighted)
+        else:
+            combined[key] = (sum(samples * value for samples, value in weighted) /
+                             sum(samples for samples, value in weighted))
+    return combined
+
+
+class StatStore(object):
+    """
+    Writes the stat records of one traffic task and rolls them up.
+
+    .. python::
+    Example Usage
+    store = StatStore("udp")
+    reporter = StatReporter(url, spool_dir, store=store)   # Calls store.write(records) per batch
+    reporter.close()                                       # Calls store.close()
+    """
+
+    def __init__(self, kind):
+        """
+        Constructor
+        :param kind: (string) "udp" or "tcp", the model the records' app_id refers to
+        :return: None
+        """
+        self.kind = kind
+        # Traffic rows the task wrote stats of
+        self._app_ids = set()
+        # Start of the first period of each coarser resolution not rolled up yet
+        self._pending = {}
+        # Start of the second of the latest record written
+        self._latest = None
+        self._next_prune = 0
+        self.written = 0
+
+    def write(self, data_list):
+        """
+        Save a batch of stat records, then roll up the periods they completed and prune.
+        :param data_list: (list) Stat records, app_id naming the traffic row
+        :return: None
+        """
+        rows = []
+        for record in data_list:
+            if record.get("app_id") in (None, ""):
+                continue
+            app_id = int(record["app_id"])
+            second = floor_time(record_time(record), 1)
+            rows.append(TrafficStat(kind=self.kind, app_id=app_id, resolution=1, samples=1, time=second,
+                                    data=json.dumps(measurements(record), separators=(",", ":"))))
+            self._app_ids.add(app_id)
+            if self._latest is None or second > self._latest:
+                self._latest = second
+        if not rows:
+            return
+        first = min(row.time for row in rows)
+        for resolution in RESOLUTIONS[1:]:
+            # Records of periods already rolled up, e.g. another flow's, have them redone
+            start = floor_time(first, resolution)
+            if resolution not in self._pending or start < self._pending[resolution]:
+                self._pending[resolution] = start
+        with transaction.atomic():
+            TrafficStat.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+            self._roll_up(False)
+        self.written += len(rows)
+        self._prune()
+
+    def close(self):
+        """
+        Roll up the periods the run ended in, though they are not complete.
+        :return: None
+        """
+        if self._latest is None:
+            return
+        with transaction.atomic():
+            self._roll_up(True)
+        self._prune()
+
+    def _roll_up(self, final):
+        """
+        Private method
+        Roll up every complete period, or every period up to the latest record when final.
+        :param final: (boolean) Also roll up the periods in progress
+        :return: None
+        """
+        # A period is complete once the resolution it is rolled up from got past its end
+        done_until = self._latest + datetime.timedelta(seconds=1) if final else self._latest
+        for source, resolution in zip(RESOLUTIONS, RESOLUTIONS[1:]):
+            period = datetime.timedelta(seconds=resolution)
+            start = self._pending[resolution]
+            while start + period <= done_until or final and start < done_until:
+                self._roll_up_period(source, resolution, start)
+                start += period
+            self._pending[resolution] = start
+            if not final:
+                done_until = start
+
+    def _roll_up_period(self, source, resolution, start):
+        """
+        Private method
+        (Re)write the rows of one period of every app_id the task wrote. Rolling up from all
+        the rows of the period, not only this task's, lets a restarted task redo it.
+        :param source: (integer) Resolution rolled up from
+        :param resolution: (integer) Resolution of the period
+        :param start: (datetime.datetime) Start of the period
+        :return: None
+        """
+        end = start + datetime.timedelta(seconds=resolution)
+        rows = {}
+        for stat in TrafficStat.objects.filter(kind=self.kind, app_id__in=self._app_ids, resolution=source,
+                                               time__gte=start, time__lt=end).only("app_id", "samples", "data"):
+            rows.setdefault(stat.app_id, []).append((stat.samples, json.loads(stat.data)))
+        TrafficStat.objects.filter(kind=self.kind, app_id__in=rows.keys(), resolution=resolution, time=start).delete()
+        TrafficStat.objects.bulk_create([TrafficStat(kind=self.kind, app_id=app_id, resolution=resolution,
+                                                     samples=sum(samples for samples, data in app_rows),
+                                                     time=start,
+                                                     data=json.dumps(roll_up(app_rows), separators=(",", ":")))
+                                         for app_id, app_rows in rows.items()], batch_size=BATCH_SIZE)
+
+    def _prune(self):
+        """
+        Private method
+        Delete the rows past their retention, every PRUNE_INTERVAL seconds at most.
+        :return: None
+        """
+        now = timezone.now()
+        if now.timestamp() < self._next_prune:
+            return
+        self._next_prune = now.timestamp() + PRUNE_INTERVAL
+        for resolution, seconds in retention().items():
+            deleted, per_model = TrafficStat.objects.filter(
+                resolution=resolution, time__lt=now - datetime.timedelta(seconds=seconds)).delete()
+            if deleted:
+                logger.info("Pruned %d %d s stat rows" % (deleted, resolution))
+
+
+def pick_resolution(start, end, now=None):
+    """
+    :param start: (datetime.datetime) Start of the window
+    :param end: (datetime.datetime) End of the window
+    :param now: (datetime.datetime) Current time, None reads the clock
+    :return: (integer) Finest resolution still kept at start with at most MAX_POINTS rows in
+        the window, the coarsest if none is
+    """
+    now = now or timezone.now()
+    periods = retention()
+    window = (end - start).total_seconds()
+    for resolution in RESOLUTIONS:
+        if start >= now - datetime.timedelta(seconds=periods[resolution]) and window / resolution <= MAX_POINTS:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def stat_range(kind, app_id, start, end, resolution=None):
+    """
+    :param kind: (string) "udp" or "tcp"
+    :param app_id: (integer) Id of the traffic row
+    :param start: (datetime.datetime) Start of the window
+    :param end: (datetime.datetime) End of the window, exclusive
+    :param resolution: (integer) One of RESOLUTIONS, None picks one, see pick_resolution()
+    :return: (tuple) The resolution and the TrafficStat rows in the window, oldest first
+    """
+    if resolution is None:
+        resolution = pick_resolution(start, end)
+    elif resolution not in RESOLUTIONS:
+        raise ValueError("Resolution must be one of %s" % ", ".join(str(r) for r in RESOLUTIONS))
+    # A period that started before the window may still overlap it
+    rows = TrafficStat.objects.filter(kind=kind, app_id=app_id, resolution=resolution,
+                                      time__gt=start - datetime.timedelta(seconds=resolution),
+                                      time__lt=end).order_by("time")
+    return resolution, rows
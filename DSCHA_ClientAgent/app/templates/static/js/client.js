@@ -18,5 +18,36 @@ $(function() {
             error:function (xhr, textStatus, thrownError){}
         });
     });
-});
 
+    // Follow the live stats of every traffic row, see LiveStatApiView
+    $('[data-live-url]').each(function () {
+        follow($(this));
+    });
+
+    function follow(container) {
+        var events = new EventSource(container.data('live-url') + '?stream=1&count=1');
+        events.onerror = function () {
+            // EventSource gives up on an error status, e.g. a 503 when the agent serves
+            // too many streams: try again a little later
+            if (events.readyState === EventSource.CLOSED) {
+                setTimeout(function () {
+                    follow(container);
+                }, 10000);
+            }
+        };
+        events.onmessage = function (event) {
+            var stat = JSON.parse(event.data);
+            container.find('[data-key]').each(function () {
+                var cell = $(this);
+                var value = stat[cell.data('key')];
+                if (value === undefined) {
+                    return;
+                }
+                if (cell.data('per-second') && stat.interval) {
+                    value = value / stat.interval;
+                }
+                cell.text(Math.round(value).toLocaleString());
+            });
+        };
+    }
+});
@@ -1,3 +1,223 @@
-from django.test import TestCase
+import json
+import datetime
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+from .models import TrafficStat
+from .statstore import StatStore, roll_up, floor_time, pick_resolution, stat_range
+
+
+def _record(moment, app_id=7, **fields):
+    """
+    Private method
+    :param moment: (datetime.datetime) Aware time the record was closed
+    :param app_id: (integer) Traffic row
+    :param fields: Measurements
+    :return: (dict) Stat record as the engines put it on stat_queue, pkt_time in local time
+    """
+    record = {"app_id": app_id, "interval": 0,
+              "pkt_time": str(datetime.datetime.fromtimestamp(moment.timestamp()))}
+    record.update(fields)
+    return record
+
+
+def _rows(resolution):
+    return list(TrafficStat.objects.filter(resolution=resolution).order_by("app_id", "time"))
+
+
+class RollUpTest(SimpleTestCase):
+
+    def test_aggregation(self):
+        combined = roll_up([(1, {"packets_sent": 100, "connections_open": 10, "offline_time": 0.25,
+                                 "avg_latency": 0.001, "latency_p99": 0.004, "latency_max": 0.01,
+                                 "max_pacing_error_us": 5.0}),
+                            (3, {"packets_sent": 50, "connections_open": 20, "offline_time": 0.5,
+                                 "avg_latency": 0.003, "latency_p99": 0.002, "latency_max": 0.02,
+                                 "max_pacing_error_us": 2.0})])
+        self.assertEqual(combined["packets_sent"], 150)
+        # A gauge is a level, averaged over the seconds
+        self.assertAlmostEqual(combined["connections_open"], 17.5)
+        self.assertAlmostEqual(combined["offline_time"], 0.75)
+        self.assertAlmostEqual(combined["avg_latency"], 0.0025)
+        self.assertEqual(combined["latency_p99"], 0.004)
+        self.assertEqual(combined["latency_max"], 0.02)
+        self.assertEqual(combined["max_pacing_error_us"], 5.0)
+
+    def test_no_data_skipped(self):
+        combined = roll_up([(1, {"avg_latency": -1, "forward_latency": None, "packets_sent": 10}),
+                            (1, {"avg_latency": 0.002, "forward_latency": -1, "packets_sent": 10})])
+        self.assertEqual(combined, {"avg_latency": 0.002, "packets_sent": 20})
+
+    def test_int_sentinel_is_not_a_counter(self):
+        # avg_latency is -1 (an int) without echoes, it must not turn the key into a counter
+        combined = roll_up([(1, {"avg_latency": -1}), (1, {"avg_latency": 2}), (1, {"avg_latency": 0.5})])
+        self.assertAlmostEqual(combined["avg_latency"], 1.25)
+
+
+class StatStoreTest(TestCase):
+
+    def setUp(self):
+        # Ten minutes into an hour well within the retention of per-second rows
+        self.start = floor_time(timezone.now() - datetime.timedelta(hours=2), 3600) + datetime.timedelta(minutes=10)
+
+    def write(self, store, seconds, app_id=7):
+        store.write([_record(self.start + datetime.timedelta(seconds=i), app_id, packets_sent=10,
+                             avg_latency=0.001 * (i % 2 + 1))
+                     for i in seconds])
+
+    def test_rolls_up_complete_periods(self):
+        store = StatStore("udp")
+        self.write(store, range(90))
+        self.assertEqual(len(_rows(1)), 90)
+        minutes = _rows(60)
+        self.assertEqual([(row.time, row.samples) for row in minutes], [(self.start, 60)])
+        data = json.loads(minutes[0].data)
+        self.assertEqual(data["packets_sent"], 600)
+        self.assertAlmostEqual(data["avg_latency"], 0.0015)
+        self.assertNotIn("app_id", data)
+        self.assertNotIn("interval", data)
+        self.assertEqual(_rows(3600), [])
+
+    def test_close_rolls_up_partial_periods(self):
+        store = StatStore("udp")
+        self.write(store, range(90))
+        self.write(store, range(90), app_id=8)
+        store.close()
+        minutes = _rows(60)
+        self.assertEqual([(row.app_id, row.samples) for row in minutes], [(7, 60), (7, 30), (8, 60), (8, 30)])
+        hours = _rows(3600)
+        self.assertEqual([(row.app_id, row.time, row.samples) for row in hours],
+                         [(7, floor_time(self.start, 3600), 90), (8, floor_time(self.start, 3600), 90)])
+        self.assertEqual(json.loads(hours[0].data)["packets_sent"], 900)
+
+    def test_records_over_batches(self):
+        store = StatStore("tcp")
+        self.write(store, range(50))
+        self.assertEqual(_rows(60), [])
+        self.write(store, range(50, 130))
+        self.assertEqual([row.samples for row in _rows(60)], [60, 60])
+        self.assertEqual(TrafficStat.objects.exclude(kind="tcp").count(), 0)
+
+    def test_restarted_store_redoes_period(self):
+        self.write(StatStore("udp"), range(30))
+        # A new task of the same row carries on within the same minute
+        store = StatStore("udp")
+        self.write(store, range(30, 61))
+        self.assertEqual([row.samples for row in _rows(60)], [60])
+
+    def test_records_without_app_id_skipped(self):
+        store = StatStore("udp")
+        store.write([_record(self.start, app_id=""), {"packets_sent": 1}])
+        store.close()
+        self.assertEqual(TrafficStat.objects.count(), 0)
+
+
+class PruneTest(TestCase):
+
+    def add(self, resolution, age):
+        TrafficStat.objects.create(kind="udp", app_id=7, resolution=resolution,
+                                   time=timezone.now() - datetime.timedelta(seconds=age), data="{}")
+
+    @override_settings(STAT_RETENTION={1: 3600})
+    def test_prunes_past_retention(self):
+        self.add(1, 3500)
+        self.add(1, 3700)
+        self.add(60, 6 * 24 * 3600)
+        self.add(60, 8 * 24 * 3600)
+        self.add(3600, 80 * 24 * 3600)
+        self.add(3600, 100 * 24 * 3600)
+        store = StatStore("udp")
+        store.write([_record(timezone.now())])
+        kept = sorted((row.resolution, row.time) for row in TrafficStat.objects.all())
+        self.assertEqual([resolution for resolution, time in kept], [1, 1, 60, 3600])
+
+    def test_prunes_once_per_interval(self):
+        store = StatStore("udp")
+        store.write([_record(timezone.now())])
+        self.add(1, 7 * 3600)
+        store.write([_record(timezone.now())])
+        self.assertEqual(TrafficStat.objects.filter(resolution=1).count(), 3)
+
+
+class ResolutionTest(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def pick(self, ago, length):
+        start = self.now - datetime.timedelta(seconds=ago)
+        return pick_resolution(start, start + datetime.timedelta(seconds=length), self.now)
+
+    def test_by_range_length(self):
+        self.assertEqual(self.pick(600, 600), 1)
+        self.assertEqual(self.pick(1000, 1000), 1)
+        self.assertEqual(self.pick(1001, 1001), 60)
+        self.assertEqual(self.pick(2 * 3600, 2 * 3600), 60)
+        self.assertEqual(self.pick(30 * 24 * 3600, 30 * 24 * 3600), 3600)
+
+    def test_by_retention(self):
+        # Short, but older than the per-second rows are kept
+        self.assertEqual(self.pick(8 * 3600, 600), 60)
+        self.assertEqual(self.pick(10 * 24 * 3600, 600), 3600)
+        # Nothing covers it, the coarsest is the best there is
+        self.assertEqual(self.pick(200 * 24 * 3600, 600), 3600)
+
+    @override_settings(STAT_RETENTION={1: 24 * 3600})
+    def test_retention_setting(self):
+        self.assertEqual(self.pick(8 * 3600, 600), 1)
+
+    def test_stat_range(self):
+        hour = floor_time(self.now, 3600)
+        for minutes in (0, 1, 2, 3):
+            TrafficStat.objects.create(kind="udp", app_id=7, resolution=60,
+                                       time=hour + datetime.timedelta(minutes=minutes), data="{}")
+        TrafficStat.objects.create(kind="tcp", app_id=7, resolution=60, time=hour, data="{}")
+        # The minute the window starts in overlaps it, the one it ends at does not
+        resolution, rows = stat_range("udp", 7, hour + datetime.timedelta(seconds=30),
+                                      hour + datetime.timedelta(minutes=3), 60)
+        self.assertEqual(resolution, 60)
+        self.assertEqual([row.time.minute for row in rows], [0, 1, 2])
+        self.assertRaises(ValueError, stat_range, "udp", 7, hour, self.now, 5)
+
+
+class StatRangeApiTest(TestCase):
+
+    def setUp(self):
+        self.start = floor_time(timezone.now() - datetime.timedelta(minutes=30), 60)
+        store = StatStore("udp")
+        store.write([_record(self.start + datetime.timedelta(seconds=i), packets_sent=10) for i in range(120)])
+        store.close()
+
+    def get(self, query):
+        return self.client.get("/api/v1/UDPTraffics/7/stats/" + query)
+
+    def test_default_window(self):
+        response = self.get("")
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["id"], body["resolution"]), (7, 60))
+        self.assertEqual([stat["samples"] for stat in body["stats"]], [60, 60])
+        self.assertEqual(body["stats"][0]["data"]["packets_sent"], 600)
+
+    def test_window_and_resolution(self):
+        start = int(self.start.timestamp())
+        response = self.get("?start=%d&end=%d&resolution=1" % (start + 10, start + 20))
+        body = response.json()
+        self.assertEqual(body["resolution"], 1)
+        self.assertEqual(len(body["stats"]), 10)
+        # ISO 8601 without an offset is UTC
+        iso = "%Y-%m-%dT%H:%M:%S"
+        response = self.get("?start=%s&end=%s" % ((self.start + datetime.timedelta(seconds=100)).strftime(iso),
+                                                  (self.start + datetime.timedelta(seconds=200)).strftime(iso)))
+        body = response.json()
+        self.assertEqual((body["resolution"], len(body["stats"])), (1, 20))
+
+    def test_other_kind(self):
+        response = self.client.get("/api/v1/TCPTraffics/7/stats/")
+        self.assertEqual(response.json()["stats"], [])
+
+    def test_bad_requests(self):
+        for query in ("?start=yesterday", "?start=inf", "?resolution=5", "?resolution=x",
+                      "?start=2000&end=1000"):
+            with self.subTest(query=query):
+                self.assertEqual(self.get(query).status_code, 400)